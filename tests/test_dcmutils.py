@@ -0,0 +1,275 @@
+"""
+test_dcmutils.py — pytest suite for dcmutils.patch_dicom_header and the multiframe helpers
+
+Every patched file is read back with pydicom and compared against the same
+updates applied through a full pydicom decode/re-encode. Multiframe files are built
+with native and RLE-encapsulated pixel data and per-frame functional groups, and
+decoded frame by frame through multiframe_to_arrays.
+"""
+
+import io
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.sequence import Sequence
+from pydicom.uid import (ExplicitVRLittleEndian, ImplicitVRLittleEndian,
+                         ExplicitVRBigEndian, RLELossless, generate_uid)
+
+from pydicom.pixel_data_handlers.rle_handler import rle_encode_frame
+
+from dcmutils import MAX_FRAMES, frame_count, multiframe_to_arrays, patch_dicom_header
+
+
+UPDATES = {'PatientID': 'anon_mrn', 'PatientName': 'redacted_anon_mrn',
+           'AccessionNumber': 'ACC1', 'PhotometricInterpretation': 'MONOCHROME2'}
+
+
+# ── Fixtures ───────────────────────────────────────────────────────────────────
+
+def make_dicom(transfer_syntax=ExplicitVRLittleEndian, with_sequence=False, drop=(), pixels=None):
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = transfer_syntax
+    ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.is_little_endian = transfer_syntax != ExplicitVRBigEndian
+    ds.is_implicit_VR = transfer_syntax == ImplicitVRLittleEndian
+
+    ds.SOPClassUID = ds.file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.AccessionNumber = 'REAL_ACC'
+    ds.PatientName = 'Doe^John'
+    ds.PatientID = 'MRN12345'
+    ds.StudyInstanceUID = '1.2.3.4'
+    ds.SeriesDescription = 'SAX'
+    if with_sequence:
+        item = Dataset()
+        item.ReferencedSOPClassUID = '1.2.3'
+        item.ReferencedSOPInstanceUID = '1.2.3.4.5'
+        ds.ReferencedStudySequence = Sequence([item])
+    ds.Rows, ds.Columns = 8, 8
+    ds.SamplesPerPixel = 1
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 16, 15
+    ds.PixelRepresentation = 0
+    ds.PhotometricInterpretation = 'RGB'
+    ds.PixelData = pixels if pixels is not None else np.arange(64, dtype=np.uint16).tobytes()
+    for keyword in drop:
+        delattr(ds, keyword)
+
+    buffer = io.BytesIO()
+    ds.save_as(buffer, write_like_original=False)
+    return buffer.getvalue()
+
+
+def reencoded(data, implicit_vr=False):
+    ds = pydicom.dcmread(io.BytesIO(data))
+    for keyword, value in UPDATES.items():
+        setattr(ds, keyword, value)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = implicit_vr
+    buffer = io.BytesIO()
+    ds.save_as(buffer, write_like_original=False)
+    return pydicom.dcmread(io.BytesIO(buffer.getvalue()))
+
+
+def assert_same_dataset(patched, expected):
+    ds = pydicom.dcmread(io.BytesIO(patched))
+    assert [e.tag for e in ds] == [e.tag for e in expected]
+    for elem in expected:
+        assert ds[elem.tag].value == elem.value, elem.keyword
+
+
+# ── Fast path ──────────────────────────────────────────────────────────────────
+
+@pytest.mark.parametrize('implicit', [False, True])
+def test_patch_matches_reencode(implicit):
+    data = make_dicom(ImplicitVRLittleEndian if implicit else ExplicitVRLittleEndian)
+    patched = patch_dicom_header(data, UPDATES, implicit_vr=implicit)
+    assert patched is not None
+    assert_same_dataset(patched, reencoded(data, implicit))
+
+
+def test_pixel_data_copied_verbatim():
+    pixels = np.random.default_rng(0).integers(0, 4096, 64, dtype=np.uint16).tobytes()
+    data = make_dicom(pixels=pixels)
+    patched = patch_dicom_header(data, UPDATES)
+    assert patched.endswith(pixels)
+
+
+def test_missing_elements_are_inserted_in_order():
+    data = make_dicom(drop=('AccessionNumber', 'PatientName'))
+    patched = patch_dicom_header(data, UPDATES)
+    ds = pydicom.dcmread(io.BytesIO(patched))
+    assert ds.AccessionNumber == 'ACC1' and ds.PatientName == 'redacted_anon_mrn'
+    tags = [e.tag for e in ds]
+    assert tags == sorted(tags)
+
+
+def test_undefined_length_sequence_is_skipped():
+    # pydicom writes sequences and items with undefined length
+    data = make_dicom(with_sequence=True)
+    patched = patch_dicom_header(data, UPDATES)
+    assert patched is not None
+    assert_same_dataset(patched, reencoded(data))
+
+
+def test_encapsulated_pixel_data():
+    frame = b'\x01\x02' * 20
+    data = make_dicom(RLELossless, pixels=encapsulate([frame]))
+    patched = patch_dicom_header(data, UPDATES)
+    ds = pydicom.dcmread(io.BytesIO(patched))
+    assert ds.file_meta.TransferSyntaxUID == RLELossless
+    assert ds.PatientID == 'anon_mrn' and ds.PixelData == pydicom.dcmread(io.BytesIO(data)).PixelData
+
+
+def test_odd_length_values_are_space_padded():
+    patched = patch_dicom_header(make_dicom(), {'PatientID': 'ABC'})
+    assert b'ABC ' in patched
+    assert pydicom.dcmread(io.BytesIO(patched)).PatientID == 'ABC'
+
+
+# ── Fallbacks ──────────────────────────────────────────────────────────────────
+
+@pytest.mark.parametrize('transfer_syntax, implicit', [
+    (ExplicitVRLittleEndian, True),     # VR conversion needs a re-encode
+    (ImplicitVRLittleEndian, False),
+    (ExplicitVRBigEndian, False),
+])
+def test_encoding_mismatch_falls_back(transfer_syntax, implicit):
+    assert patch_dicom_header(make_dicom(transfer_syntax), UPDATES, implicit_vr=implicit) is None
+
+
+def test_non_ascii_value_falls_back():
+    assert patch_dicom_header(make_dicom(), {'PatientName': 'Müller'}) is None
+
+
+def test_non_text_vr_falls_back():
+    assert patch_dicom_header(make_dicom(), {'Rows': 16}) is None
+
+
+def test_missing_preamble_falls_back():
+    assert patch_dicom_header(make_dicom()[128:], UPDATES) is None
+
+
+def test_implicit_body_under_explicit_syntax_falls_back():
+    # meta says explicit VR little endian, the body is encoded implicit VR
+    ds = pydicom.dcmread(io.BytesIO(make_dicom(ImplicitVRLittleEndian)))
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    buffer = io.BytesIO()
+    ds.save_as(buffer, write_like_original=True)
+    assert patch_dicom_header(buffer.getvalue(), UPDATES) is None
+
+
+def test_pydicom_mismatched_syntax_sample_falls_back():
+    path = get_testdata_file('SC_rgb_jpeg.dcm')
+    if path is None:
+        pytest.skip('sample not shipped with this pydicom version')
+    assert patch_dicom_header(open(path, 'rb').read(), UPDATES) is None
+
+
+def test_truncated_file_falls_back():
+    data = make_dicom(with_sequence=True)
+    assert patch_dicom_header(data[:300], UPDATES) is None
+
+
+# ── Multiframe ─────────────────────────────────────────────────────────────────
+
+def position_item(position):
+    item = Dataset()
+    item.ImagePositionPatient = position
+    return item
+
+
+def make_multiframe(frames, transfer_syntax=ExplicitVRLittleEndian, per_frame=True, shared_timing=False):
+    n_frames, rows, cols = frames.shape
+    ds = pydicom.dcmread(io.BytesIO(make_dicom()))
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = transfer_syntax
+    ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4.1'     # Enhanced MR
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.Rows, ds.Columns = rows, cols
+    ds.NumberOfFrames = n_frames
+
+    shared = Dataset()
+    orientation = Dataset()
+    orientation.ImageOrientationPatient = [1, 0, 0, 0, 0, -1]                 # slice normal (0, 1, 0)
+    shared.PlaneOrientationSequence = Sequence([orientation])
+    if shared_timing:
+        stack, cardiac = Dataset(), Dataset()
+        stack.InStackPositionNumber = 7
+        cardiac.NominalCardiacTriggerDelayTime = 42
+        shared.FrameContentSequence = Sequence([stack])
+        shared.CardiacSynchronizationSequence = Sequence([cardiac])
+    ds.SharedFunctionalGroupsSequence = Sequence([shared])
+    if per_frame:
+        groups = []
+        for i in range(n_frames):
+            item, content = Dataset(), Dataset()
+            item.PlanePositionSequence = Sequence([position_item([0, 10 * (i // 2) + 0.5, 3])])
+            content.TemporalPositionIndex = i % 2 + 1
+            item.FrameContentSequence = Sequence([content])
+            groups.append(item)
+        ds.PerFrameFunctionalGroupsSequence = Sequence(groups)
+
+    if transfer_syntax == RLELossless:
+        ds.PixelData = encapsulate([rle_encode_frame(frame) for frame in frames])
+        ds['PixelData'].is_undefined_length = True
+    else:
+        ds.PixelData = frames.tobytes()
+    buffer = io.BytesIO()
+    ds.save_as(buffer, write_like_original=False)
+    return buffer.getvalue()
+
+
+def frames_of(data):
+    ds = pydicom.dcmread(io.BytesIO(data), defer_size='1 KB')
+    return list(multiframe_to_arrays(ds, int(ds.NumberOfFrames)))
+
+
+@pytest.mark.parametrize('transfer_syntax', [ExplicitVRLittleEndian, RLELossless])
+def test_multiframe_frames_and_positions(transfer_syntax):
+    frames = np.random.default_rng(0).integers(0, 4096, (4, 6, 5), dtype=np.uint16)
+    out = frames_of(make_multiframe(frames, transfer_syntax))
+    assert len(out) == 4
+    for i, (array, series, frame_loc, accession, mrn, index) in enumerate(out):
+        assert array.shape == (3, 6, 5)
+        assert np.array_equal(array[0], frames[i]) and np.array_equal(array[2], frames[i])
+        assert (series, accession, mrn) == ('SAX', 'REAL_ACC', 'MRN12345')
+        assert frame_loc == 10 * (i // 2) + 0.5                       # position projected onto the normal
+        assert index == str(i % 2 + 1)                                # TemporalPositionIndex
+
+
+def test_multiframe_shared_group_fallbacks():
+    frames = np.arange(3 * 4 * 4, dtype=np.uint16).reshape(3, 4, 4)
+    out = frames_of(make_multiframe(frames, per_frame=False, shared_timing=True))
+    assert [(loc, index) for _, _, loc, _, _, index in out] == [(7, '42.0')] * 3   # InStackPositionNumber, trigger delay (FD)
+
+    out = frames_of(make_multiframe(frames, per_frame=False))
+    assert [(loc, index) for _, _, loc, _, _, index in out] == [(0, '1'), (0, '2'), (0, '3')]
+
+
+def test_multiframe_truncated_pixel_data_yields_none():
+    frames = np.ones((3, 4, 4), dtype=np.uint16)
+    ds = pydicom.dcmread(io.BytesIO(make_multiframe(frames)))
+    ds.PixelData = ds.PixelData[:2 * 4 * 4 * 2]                       # only two frames stored
+    out = list(multiframe_to_arrays(ds, 3))
+    assert len(out) == 3 and out[2] is None and all(np.array_equal(o[0][0], frames[0]) for o in out[:2])
+
+
+def test_frame_count_reads_number_of_frames(tmp_path):
+    classic, multi, broken = tmp_path / 'classic.dcm', tmp_path / 'multi.dcm', tmp_path / 'broken.dcm'
+    classic.write_bytes(make_dicom())
+    multi.write_bytes(make_multiframe(np.zeros((5, 4, 4), dtype=np.uint16)))
+    broken.write_bytes(b'not a dicom')
+    assert [frame_count(str(f)) for f in (classic, multi, broken)] == [1, 5, 1]
+
+
+def test_multiframe_over_cap_is_skipped():
+    ds = pydicom.dcmread(io.BytesIO(make_multiframe(np.zeros((2, 4, 4), dtype=np.uint16))))
+    assert list(multiframe_to_arrays(ds, MAX_FRAMES + 1)) == []
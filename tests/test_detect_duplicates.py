@@ -0,0 +1,257 @@
+"""
+test_detect_duplicates.py — pytest suite for the fingerprinting and pair search in detect_duplicates.py
+
+The batched fingerprinting is checked bit for bit against the original per-frame
+Pillow chain, and the vectorized candidate_pairs against a straightforward
+dict-of-buckets reference (the original implementation) on random fingerprints
+with planted near-duplicates. Stage 1 is run on a small HDF5 datastore, including
+a resume after an interrupted run.
+"""
+
+import os
+import glob
+from collections import defaultdict
+
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image, ImageFilter, ImageOps
+
+import detect_duplicates as dd
+
+
+# ── Reference implementations ──────────────────────────────────────────────────
+
+def pil_fingerprint(frame):
+    f = frame.astype(np.float64)
+    vmin, vmax = f.min(), f.max()
+    if vmax - vmin < 1e-6:
+        return None
+    img = Image.fromarray((((f - vmin) / (vmax - vmin)) * 255.0).astype(np.uint8))
+    img = img.resize((dd.SAMPLE_SIZE, dd.SAMPLE_SIZE), dd.RESAMPLE)
+    img = img.filter(ImageFilter.BoxBlur(dd.BLUR_RADIUS))
+    img = ImageOps.equalize(ImageOps.autocontrast(img))
+    a = np.asarray(img.resize((dd.GRID, dd.GRID), dd.RESAMPLE), dtype=np.uint8).flatten()
+    return np.packbits(a > np.median(a)).tobytes()
+
+
+def naive_candidate_pairs(fp8, n_bands, max_bucket):
+    fp_bytes = [row.tobytes() for row in fp8]
+    bounds = [round(k * dd.FP_BYTES / n_bands) for k in range(n_bands + 1)]
+    pairs, skipped = set(), 0
+    for k in range(n_bands):
+        s, e = bounds[k], bounds[k + 1]
+        if s == e:
+            continue
+        buckets = defaultdict(list)
+        for i, b in enumerate(fp_bytes):
+            buckets[b[s:e]].append(i)
+        for members in buckets.values():
+            if len(members) > max_bucket:
+                skipped += 1
+                continue
+            for a in range(len(members)):
+                for b in range(a + 1, len(members)):
+                    pairs.add((members[a], members[b]))
+    return pairs, skipped
+
+
+def vectorized_pairs(fp8, n_bands, max_bucket, chunk_size=dd.CHUNK_PAIRS):
+    stats = {}
+    chunks = list(dd.candidate_pairs(fp8, n_bands, max_bucket, stats, chunk_size=chunk_size))
+    pairs = [(i, j) for I, J in chunks for i, j in zip(I.tolist(), J.tolist())]
+    return pairs, stats
+
+
+# ── Fixtures ───────────────────────────────────────────────────────────────────
+
+def make_fingerprints(n_base=60, copies=4, max_flips=10, seed=0):
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 256, (n_base, dd.FP_BYTES), dtype=np.uint8)
+    rows = [base]
+    for _ in range(copies):
+        noisy = np.unpackbits(base, axis=1)
+        for row in noisy:
+            flips = rng.choice(dd.FP_BITS, rng.integers(0, max_flips + 1), replace=False)
+            row[flips] ^= 1
+        rows.append(np.packbits(noisy, axis=1))
+    return np.concatenate(rows)
+
+
+def make_frames(seed=0):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:96, :80]
+    frames = []
+    for k in range(6):
+        blob = np.exp(-((yy - 20 - 8 * k) ** 2 + (xx - 40) ** 2) / (50.0 + 30 * k))
+        frames.append(blob + 0.05 * rng.random(blob.shape))
+    frames = [(f / f.max() * 255).astype(np.uint8) for f in frames]
+    frames += [f.astype(np.uint16) * 37 for f in frames[:3]]
+    frames += [f.astype(np.float32) / 7 - 3 for f in frames[:3]]
+    frames.append(rng.integers(0, 256, (64, 128), dtype=np.uint8))
+    frames.append(np.full((96, 80), 9, dtype=np.uint8))            # constant -> None
+    frames.append(np.zeros((40, 40), dtype=np.float32))            # blank -> None
+    return frames
+
+
+# ── fingerprinting ─────────────────────────────────────────────────────────────
+
+def test_fingerprint_frames_match_per_frame_reference(monkeypatch):
+    frames = make_frames()
+    monkeypatch.setattr(dd, 'FP_BATCH', 4)     # several batches per shape/dtype group
+    fps = dd.fingerprint_frames(frames)
+    assert fps == [pil_fingerprint(f) for f in frames]
+    assert fps[-1] is None and fps[-2] is None
+    assert all(len(fp) == dd.FP_BYTES for fp in fps[:-2])
+
+
+def test_fingerprint_single_frame():
+    frame = make_frames()[0]
+    assert dd.fingerprint(frame) == pil_fingerprint(frame)
+
+
+def test_contrast_luts_match_imageops():
+    rng = np.random.default_rng(1)
+    images = [Image.fromarray(rng.integers(lo, hi, (40, 40), dtype=np.uint8))
+              for lo, hi in [(0, 256), (60, 90), (17, 18), (0, 2), (250, 256)]]
+    luts = dd.contrast_luts(np.array([img.histogram() for img in images], dtype=np.int64))
+    for img, lut in zip(images, luts.tolist()):
+        expected = ImageOps.equalize(ImageOps.autocontrast(img))
+        assert img.point(lut).tobytes() == expected.tobytes()
+
+
+# ── Stage 1 ────────────────────────────────────────────────────────────────────
+
+def make_datastore(root, n_files=4):
+    frames = make_frames()[:6]
+    for f in range(n_files):
+        os.makedirs(os.path.join(root, f'mrn{f}'), exist_ok=True)
+        with h5py.File(os.path.join(root, f'mrn{f}', f'acc{f}.h5'), 'w') as h5:
+            for s in range(3):
+                h5.create_dataset(f'series_{s}', data=np.stack([frames[(f + s + k) % 6] for k in range(5)]))
+
+
+@pytest.mark.parametrize('suffix', ['.csv', '.parquet'])
+def test_build_manifest_resumes(tmp_path, monkeypatch, suffix):
+    if suffix == '.parquet':
+        pytest.importorskip('pyarrow')
+    root = str(tmp_path / 'store')
+    make_datastore(root)
+    full_path = str(tmp_path / f'full{suffix}')
+    full = dd.build_fingerprint_manifest(root, 1, ['first', 'last'], None, 'store', full_path)
+    assert len(full) == 4 * 3 * 2 and not os.path.exists(full_path + '.parts')
+    assert full['relpath'].tolist() == sorted(full['relpath'])
+    assert dd.load_manifest(full_path, 'x').equals(full)
+
+    # an interrupted run: the first two files' rows made it into a part file
+    path = str(tmp_path / f'partial{suffix}')
+    os.makedirs(path + '.parts')
+    dd._write_part(path + '.parts', full[full['mrn'].isin(['mrn0', 'mrn1'])].values.tolist(), suffix)
+    open(os.path.join(path + '.parts', '.tmp_part_000001' + suffix), 'w').close()
+
+    scanned = []
+    fingerprint_file = dd.fingerprint_file
+    def counting(path, *args, **kwargs):
+        scanned.append(os.path.basename(path))
+        return fingerprint_file(path, *args, **kwargs)
+    monkeypatch.setattr(dd, 'fingerprint_file', counting)
+    monkeypatch.setattr(dd, 'WRITE_CHUNK_ROWS', 5)
+    resumed = dd.build_fingerprint_manifest(root, 1, ['first', 'last'], None, 'store', path, resume=True)
+    assert scanned == ['acc2.h5', 'acc3.h5']
+    pd.testing.assert_frame_equal(resumed, full)
+    assert not glob.glob(path + '.parts*')
+
+
+# ── candidate_pairs ────────────────────────────────────────────────────────────
+
+@pytest.mark.parametrize('n_bands', [1, 3, 11, 16, 40])
+def test_candidate_pairs_match_reference(n_bands):
+    fp8 = make_fingerprints()
+    expected, _ = naive_candidate_pairs(fp8, n_bands, max_bucket=5000)
+    pairs, stats = vectorized_pairs(fp8, n_bands, max_bucket=5000)
+
+    assert len(pairs) == len(set(pairs)) == stats['candidates']   # each pair emitted once
+    assert all(i < j for i, j in pairs)
+    if dd.FP_BYTES / n_bands <= 8:
+        # bands of <= 8 bytes use exact keys
+        assert set(pairs) == expected
+    else:
+        # wider bands are folded: possibly extra candidates, never missing ones
+        assert set(pairs) >= expected
+
+
+def test_wide_band_folding_never_drops_pairs():
+    # 1 band = whole 128-byte code folded into one key
+    fp8 = make_fingerprints(max_flips=0)
+    expected, _ = naive_candidate_pairs(fp8, 1, max_bucket=5000)
+    pairs, _ = vectorized_pairs(fp8, 1, max_bucket=5000)
+    assert set(pairs) >= expected and expected
+
+
+def test_small_chunks_give_same_pairs():
+    fp8 = make_fingerprints()
+    big, _ = vectorized_pairs(fp8, 11, max_bucket=5000)
+    small, _ = vectorized_pairs(fp8, 11, max_bucket=5000, chunk_size=7)
+    assert sorted(big) == sorted(small)
+
+
+def test_oversized_buckets_are_skipped():
+    fp8 = make_fingerprints(n_base=5, copies=9, max_flips=0)   # buckets of 10 identical codes
+    expected, expected_skipped = naive_candidate_pairs(fp8, 11, max_bucket=6)
+    pairs, stats = vectorized_pairs(fp8, 11, max_bucket=6)
+    assert set(pairs) == expected
+    assert stats['skipped_buckets'] == expected_skipped > 0
+
+
+def test_pair_skipped_in_one_band_is_kept_from_another():
+    # rows 0 and 1 share band 0 with many others (oversized) but also share band 1
+    fp8 = np.zeros((12, dd.FP_BYTES), dtype=np.uint8)
+    fp8[:, 64:] = np.arange(12, dtype=np.uint8)[:, None] + 1
+    fp8[1, 64:] = fp8[0, 64:]
+    pairs, stats = vectorized_pairs(fp8, 2, max_bucket=4)
+    assert pairs == [(0, 1)] and stats['skipped_buckets'] == 1
+
+
+# ── verify_pairs ───────────────────────────────────────────────────────────────
+
+def test_verify_pairs_hamming_and_cross_file():
+    fp8 = make_fingerprints(n_base=20, copies=2, max_flips=6)
+    codes = fp8.view('>u8').astype(np.uint64)
+    file_ids = np.arange(len(fp8)) % 25
+    found = dd.verify_pairs(dd.candidate_pairs(fp8, 11, 5000), codes, file_ids, max_bits=10)
+
+    assert found.dtype == dd.FRAME_PAIR_DTYPE
+    bits = np.unpackbits(fp8, axis=1)
+    for i, j, d in found.tolist():
+        assert d == int((bits[i] != bits[j]).sum()) <= 10
+        assert file_ids[i] != file_ids[j]
+    assert found.tolist() == sorted(found.tolist())
+    # every planted copy (<= 6 flips) of a base row in another file is found
+    found_pairs = {(i, j) for i, j, _ in found.tolist()}
+    for copy in (1, 2):
+        for i in range(20):
+            j = i + 20 * copy
+            if file_ids[i] != file_ids[j]:
+                assert (i, j) in found_pairs
+
+
+def test_verify_pairs_parallel_matches_serial(tmp_path, monkeypatch):
+    fp8 = make_fingerprints(n_base=40, copies=3, max_flips=8)
+    codes = fp8.view('>u8').astype(np.uint64)
+    file_ids = np.arange(len(fp8)) % 30
+    serial = dd.verify_pairs(dd.candidate_pairs(fp8, 11, 5000), codes, file_ids, max_bits=10)
+    monkeypatch.setattr(dd, 'VERIFY_CHUNK', 50)        # many tasks
+    parallel = dd.verify_pairs(dd.candidate_pairs(fp8, 11, 5000, chunk_size=70), codes, file_ids,
+                               max_bits=10, cpus=2)
+    assert len(serial) and np.array_equal(serial, parallel)
+
+    # J indexing a memory-mapped matrix (the fingerprint DB), no file check
+    path = str(tmp_path / 'codes.bin')
+    codes.astype('<u8').tofile(path)
+    other = np.memmap(path, dtype='<u8', mode='r', shape=codes.shape)
+    I, J = np.nonzero(np.ones((len(codes), len(codes)), dtype=bool))
+    chunks = [(I, J)]
+    expected = dd.verify_pairs(chunks, codes, None, max_bits=10)
+    assert np.array_equal(dd.verify_pairs(chunks, codes, None, max_bits=10, cpus=2, other_codes=other), expected)
+    assert (expected['i'] == expected['j']).sum() == len(codes)     # every code matches itself
@@ -0,0 +1,105 @@
+"""
+test_dicom_metadata.py — pytest suite for the dicom_metadata catalog
+
+Builds small study/series/file .tgz archives from the pydicom test data and checks
+that Metadata_Catalog only plans the scans it needs: a new -f tag rescans just that
+tag, a changed archive replaces its old rows, and --rescan reads everything again.
+"""
+
+import io
+import os
+import tarfile
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+from dicom_metadata import Dicom_Metadata_Scanner, Metadata_Catalog
+
+
+def dicom_bytes(patient_id, series_description):
+    ds = pydicom.dcmread(get_testdata_file('CT_small.dcm'))
+    ds.PatientID = patient_id
+    ds.SeriesDescription = series_description
+    buffer = io.BytesIO()
+    ds.save_as(buffer)
+    return buffer.getvalue()
+
+
+def write_archive(path, patient_id, series):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name in series:
+            for k in range(2):
+                data = dicom_bytes(patient_id, name)
+                info = tarfile.TarInfo(f'study/{name}/{k}.dcm')
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+
+def update(catalog, scanner, root_dir, filenames, tags, series_level, rescan=False):
+    todo = catalog.to_scan(root_dir, filenames, tags, series_level, rescan)
+    for f, missing in todo.items():
+        catalog.store(os.path.join(root_dir, f), missing, series_level,
+                      scanner.scan_archive(f, missing, series_level))
+    return todo
+
+
+@pytest.fixture
+def archives(tmp_path):
+    root_dir = tmp_path / 'archives'
+    root_dir.mkdir()
+    write_archive(root_dir / 'a.tgz', 'P1', ['cine', 'lge'])
+    write_archive(root_dir / 'b.tgz', 'P2', ['cine'])
+    catalog = Metadata_Catalog(str(tmp_path / 'catalog.sqlite'))
+    scanner = Dicom_Metadata_Scanner(str(root_dir), str(tmp_path), 'test', {})
+    yield str(root_dir), catalog, scanner
+    catalog.close()
+
+
+def test_new_tag_scans_only_that_tag(archives, monkeypatch):
+    root_dir, catalog, scanner = archives
+    tags = ['PatientID', 'SeriesDescription']
+    assert update(catalog, scanner, root_dir, ['a.tgz', 'b.tgz'], tags, True) == {'a.tgz': tags, 'b.tgz': tags}
+    assert update(catalog, scanner, root_dir, ['a.tgz', 'b.tgz'], tags, True) == {}
+
+    scanned = []
+    scan_archive = scanner.scan_archive
+    monkeypatch.setattr(scanner, 'scan_archive', lambda f, t, s: scanned.append(t) or scan_archive(f, t, s))
+    assert update(catalog, scanner, root_dir, ['a.tgz', 'b.tgz'], tags + ['Modality'], True) == \
+        {'a.tgz': ['Modality'], 'b.tgz': ['Modality']}
+    assert scanned == [['Modality'], ['Modality']]
+    assert catalog.series_values(os.path.join(root_dir, 'a.tgz'), tags + ['Modality'], True) == [
+        {'PatientID': 'P1', 'SeriesDescription': 'cine', 'Modality': 'CT'},
+        {'PatientID': 'P1', 'SeriesDescription': 'lge', 'Modality': 'CT'},
+    ]
+
+    # tags only read from the first series are read again when series-level metadata is requested
+    assert update(catalog, scanner, root_dir, ['b.tgz'], ['Manufacturer'], False) == {'b.tgz': ['Manufacturer']}
+    assert catalog.to_scan(root_dir, ['b.tgz'], ['Manufacturer', 'PatientID'], True) == {'b.tgz': ['Manufacturer']}
+
+
+def test_changed_archive_replaces_old_rows(archives):
+    root_dir, catalog, scanner = archives
+    tags = ['PatientID', 'SeriesDescription']
+    update(catalog, scanner, root_dir, ['a.tgz', 'b.tgz'], tags + ['Modality'], True)
+
+    write_archive(os.path.join(root_dir, 'a.tgz'), 'P9', ['tagging'])
+    assert catalog.to_scan(root_dir, ['a.tgz', 'b.tgz'], tags, True) == {'a.tgz': tags}
+    update(catalog, scanner, root_dir, ['a.tgz', 'b.tgz'], tags, True)
+
+    path = os.path.join(root_dir, 'a.tgz')
+    assert catalog.series_values(path, tags, True) == [{'PatientID': 'P9', 'SeriesDescription': 'tagging'}]
+    assert catalog.conn.execute('SELECT COUNT(*) FROM records WHERE path = ?', (path,)).fetchone()[0] == 2
+    # Modality was only scanned for the old contents, so it is missing again
+    assert catalog.to_scan(root_dir, ['a.tgz', 'b.tgz'], tags + ['Modality'], True) == {'a.tgz': ['Modality']}
+
+
+def test_rescan_reads_every_archive_again(archives):
+    root_dir, catalog, scanner = archives
+    tags = ['PatientID', 'SeriesDescription']
+    update(catalog, scanner, root_dir, ['a.tgz', 'b.tgz'], tags, True)
+    assert catalog.to_scan(root_dir, ['a.tgz', 'b.tgz'], tags, True) == {}
+    assert update(catalog, scanner, root_dir, ['a.tgz', 'b.tgz'], tags, True, rescan=True) == \
+        {'a.tgz': tags, 'b.tgz': tags}
+    assert catalog.series_values(os.path.join(root_dir, 'b.tgz'), tags, True) == \
+        [{'PatientID': 'P2', 'SeriesDescription': 'cine'}]
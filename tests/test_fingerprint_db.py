@@ -0,0 +1,179 @@
+"""
+test_fingerprint_db.py — pytest suite for the append-only binary fingerprint DB
+
+Covers round trips through a reopened DB, skipping files already stored, recovery
+from an interrupted append and the code width check, and checks BandIndex queries
+against a brute-force band comparison across incremental updates.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fingerprint_db import (CODES, TABLES, BandIndex, FingerprintDB, META_COLS, band_bounds, band_keys,
+                            code_bytes, is_fingerprint_db)
+
+
+def make_batch(source, n_files, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for f in range(n_files):
+        for s in range(2):
+            for pos in ('first', 'last'):
+                rows.append([source, f'mrn{f}/acc{f}.h5', f'mrn{f}', f'acc{f}', f'series_{s}', pos, 25])
+    meta = pd.DataFrame(rows, columns=META_COLS)
+    codes = rng.integers(0, 2 ** 63, (len(meta), 16), dtype=np.uint64)
+    return meta, codes
+
+
+def test_round_trip_and_reopen(tmp_path):
+    path = str(tmp_path / 'history.fpdb')
+    meta, codes = make_batch('batch1', 3)
+    db = FingerprintDB(path, 16)
+    assert is_fingerprint_db(path) and len(db) == 0 and db.codes.shape == (0, 16)
+    assert db.append(meta, codes) == len(meta)
+
+    db = FingerprintDB(path, 16)
+    assert isinstance(db.codes, np.memmap)
+    assert np.array_equal(db.codes, codes)
+    pd.testing.assert_frame_equal(db.frame(), meta)
+    pd.testing.assert_frame_equal(db.frame(np.array([1, 5])), meta.iloc[[1, 5]].reset_index(drop=True))
+    assert db.has_file('batch1', 'mrn2/acc2.h5') and not db.has_file('batch2', 'mrn2/acc2.h5')
+    # strings are interned once
+    assert len(db.tables['files']) == 3 and len(db.tables['series']) == 2 and len(db.tables['positions']) == 2
+
+
+def test_append_skips_stored_files(tmp_path):
+    path = str(tmp_path / 'history.fpdb')
+    meta1, codes1 = make_batch('batch1', 2)
+    meta2, codes2 = make_batch('batch2', 2, seed=1)
+    db = FingerprintDB(path, 16)
+    db.append(meta1, codes1)
+    assert db.append(meta1, codes1) == 0
+    assert db.append(pd.concat([meta1, meta2], ignore_index=True), np.concatenate([codes1, codes2])) == len(meta2)
+
+    db = FingerprintDB(path, 16)
+    assert np.array_equal(db.codes, np.concatenate([codes1, codes2]))
+    assert db.frame()['source'].tolist() == ['batch1'] * len(meta1) + ['batch2'] * len(meta2)
+
+
+def test_interrupted_append_is_invisible(tmp_path):
+    path = str(tmp_path / 'history.fpdb')
+    meta1, codes1 = make_batch('batch1', 2)
+    meta2, codes2 = make_batch('batch2', 1, seed=1)
+    FingerprintDB(path, 16).append(meta1, codes1)
+
+    # a crashed append leaves bytes behind without committing the header
+    for name in [CODES, TABLES['files']]:
+        with open(os.path.join(path, name), 'ab') as f:
+            f.write(b'partial')
+
+    db = FingerprintDB(path, 16)
+    assert len(db) == len(meta1) and len(db.tables['files']) == 2
+    db.append(meta2, codes2)
+    db = FingerprintDB(path, 16)
+    assert np.array_equal(db.codes, np.concatenate([codes1, codes2]))
+    assert [f[0] for f in db.tables['files']] == ['batch1', 'batch1', 'batch2']
+
+
+def test_width_mismatch_raises(tmp_path):
+    path = str(tmp_path / 'history.fpdb')
+    FingerprintDB(path, 16)
+    with pytest.raises(ValueError, match='GRID'):
+        FingerprintDB(path, 4)
+
+
+# ── BandIndex ──────────────────────────────────────────────────────────────────
+
+def near_copies(codes, max_flips, rng):
+    bits = np.unpackbits(code_bytes(codes), axis=1)
+    for row in bits:
+        row[rng.choice(bits.shape[1], rng.integers(0, max_flips + 1), replace=False)] ^= 1
+    return np.packbits(bits, axis=1).view('>u8').astype(np.uint64)
+
+
+def naive_query(query_fp8, db_fp8, n_bands, db_files=None, skip_file_ids=()):
+    bounds = band_bounds(query_fp8.shape[1], n_bands)
+    pairs = set()
+    for s, e in zip(bounds[:-1], bounds[1:]):
+        q, d = band_keys(query_fp8, s, e), band_keys(db_fp8, s, e)
+        for i, r in zip(*np.nonzero(q[:, None] == d[None, :])):
+            if db_files is None or db_files[r] not in skip_file_ids:
+                pairs.add((int(i), int(r)))
+    return pairs
+
+
+def query_pairs(index, fp8, **kwargs):
+    stats = {}
+    chunks = list(index.query(fp8, max_bucket=5000, stats=stats, **kwargs))
+    pairs = [(i, r) for I, R in chunks for i, r in zip(I.tolist(), R.tolist())]
+    return pairs, stats
+
+
+@pytest.mark.parametrize('n_bands', [11, 16])
+def test_index_query_matches_brute_force(tmp_path, n_bands):
+    rng = np.random.default_rng(2)
+    db = FingerprintDB(str(tmp_path / 'history.fpdb'), 16)
+    index = BandIndex(db, n_bands)
+    for batch in range(5):                         # incremental updates -> several segments and merges
+        meta, codes = make_batch(f'batch{batch}', 3 + batch, seed=batch)
+        if batch:
+            codes[::3] = near_copies(codes[::3], 8, rng)
+            codes[1::3] = near_copies(db.codes[:len(codes[1::3])], 8, rng)
+        db.append(meta, codes)
+        assert index.update() == len(meta)
+        assert index.update() == 0
+    assert len(index) == len(db) and 1 <= len(index.header['segments']) <= 3
+
+    query = near_copies(db.codes[::2], 6, rng)
+    query_fp8 = code_bytes(query)
+    pairs, stats = query_pairs(BandIndex(FingerprintDB(db.path, 16), n_bands), query_fp8, chunk_size=5)
+    expected = naive_query(query_fp8, code_bytes(db.codes), n_bands)
+    assert len(pairs) == len(set(pairs)) == stats['candidates']
+    if 128 / n_bands <= 8:
+        assert set(pairs) == expected              # exact band keys
+    else:
+        assert set(pairs) >= expected              # folded keys may only add candidates
+    for k in range(len(query)):                    # every query finds the DB row it was copied from
+        assert (k, 2 * k) in set(pairs)
+
+
+def test_index_query_skips_files(tmp_path):
+    db = FingerprintDB(str(tmp_path / 'history.fpdb'), 16)
+    meta, codes = make_batch('batch1', 4)
+    db.append(meta, codes)
+    index = BandIndex(db, 16)
+    index.update()
+    query_fp8 = code_bytes(codes)
+    pairs, _ = query_pairs(index, query_fp8, skip_file_ids=[0, 2])
+    files = db.rows['file']
+    assert set(pairs) == naive_query(query_fp8, code_bytes(codes), 16, files, (0, 2))
+    assert pairs and all(files[r] not in (0, 2) for _, r in pairs)
+
+
+def test_index_skips_oversized_buckets(tmp_path):
+    db = FingerprintDB(str(tmp_path / 'history.fpdb'), 16)
+    meta, codes = make_batch('batch1', 3)
+    codes[:, :8] = 7                               # every row shares the first half of the code
+    db.append(meta, codes)
+    index = BandIndex(db, 2)
+    index.update()
+    pairs, stats = query_pairs(index, code_bytes(codes[:1]))
+    assert stats['skipped_buckets'] == 0 and len(pairs) == len(codes)
+    stats = {}
+    pairs = [p for chunk in index.query(code_bytes(codes[:1]), max_bucket=4, stats=stats) for p in zip(*chunk)]
+    assert stats['skipped_buckets'] == 1 and pairs == [(0, 0)]   # found again through band 1 only
+
+
+
+def test_index_query_skipping_every_file(tmp_path):
+    db = FingerprintDB(str(tmp_path / 'history.fpdb'), 16)
+    meta, codes = make_batch('batch1', 2)
+    db.append(meta, codes)
+    index = BandIndex(db, 16)
+    index.update()
+    assert code_bytes(codes[:0]).shape == (0, 128)
+    pairs, stats = query_pairs(index, code_bytes(codes), skip_file_ids=[0, 1])   # the whole batch rescanned
+    assert pairs == [] and stats['candidates'] == 0
@@ -0,0 +1,230 @@
+"""
+test_tar_compressor.py — pytest suite for tar_compressor.py
+
+tar_compressor reads local_config.yaml at import, so the module is imported with
+get_cfg/get_global_cfg patched to a scratch TMP_DIR. Covers archives only reaching
+their final name once they are complete, failed jobs cleaning up after themselves,
+the scheduler's ordering, huge-job cap and timeout for workers that never report back,
+and the ledger behind --resume.
+"""
+
+import importlib
+import io
+import os
+import tarfile
+import threading
+import time
+import types
+import zipfile
+from multiprocessing.pool import ThreadPool
+from unittest.mock import patch
+
+import pydicom
+import pytest
+from pydicom.data import get_testdata_file
+
+
+@pytest.fixture(scope='module')
+def tc(tmp_path_factory):
+    tmp_dir = str(tmp_path_factory.mktemp('tmp_dir'))
+    with patch('local_config.get_cfg', return_value=types.SimpleNamespace(tmp_dir=tmp_dir)), \
+         patch('local_config.get_global_cfg', return_value=types.SimpleNamespace(bucket_name='bucket')):
+        return importlib.import_module('tar_compressor')
+
+
+def write_zip(path, members):
+    with zipfile.ZipFile(path, 'w') as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+
+
+def test_ukb_stream_failed_instance_leaves_no_archive(tc, tmp_path, monkeypatch):
+    root_dir, output_dir = tmp_path / 'raw', tmp_path / 'out'
+    root_dir.mkdir()
+    output_dir.mkdir()
+    ds = pydicom.dcmread(get_testdata_file('CT_small.dcm'))
+    ds.SeriesDescription = 'CT'
+    buffer = io.BytesIO()
+    ds.save_as(buffer)
+    good = buffer.getvalue()
+    write_zip(root_dir / '1001_20209_2_0.zip', [('a.dcm', good)])
+    write_zip(root_dir / '1001_20209_3_0.zip', [('a.dcm', good), ('b.dcm', b'not a dicom file')])
+    monkeypatch.setattr(tc, '_crosswalk', {'eid': {'1001': 'M1'},
+                                           'eid_instance': {('1001', '2'): 'A2', ('1001', '3'): 'A3'}})
+
+    with pytest.raises(RuntimeError, match='instance 3'):
+        tc.ukb_stream_tarcompress(str(root_dir), '1001', str(output_dir), None)
+    assert sorted(os.listdir(output_dir)) == ['M1-A2.tgz']
+    with tarfile.open(output_dir / 'M1-A2.tgz') as tar:
+        assert tar.getnames() == ['1001_A2/CT/a.dcm']
+    assert not tc._open_outputs
+
+
+def test_failed_job_removes_unfinished_archive(tc, tmp_path, monkeypatch):
+    root_dir, output_dir = tmp_path / 'raw', tmp_path / 'out'
+    (root_dir / 'study').mkdir(parents=True)
+    (root_dir / 'study' / 'a.dcm').write_bytes(b'x' * 1000)
+    output_dir.mkdir()
+
+    def crash_mid_stream(root_dir, filename, output_dir, stream):
+        tar = tc.open_output_tar(output_dir, filename)
+        tar.add(os.path.join(root_dir, filename), arcname=filename)
+        raise OSError('disk full')
+
+    monkeypatch.setitem(tc.MODES, 'crash', (crash_mid_stream, False, True))
+    row = tc.run_job('crash', str(root_dir), 'study', str(output_dir), None, True, bytes_in=1000)
+    assert row['status'] == 'failed' and row['error'] == 'OSError: disk full'
+    assert os.listdir(output_dir) == [] and not tc._open_outputs
+
+    row = tc.run_job('simple', str(root_dir), 'study', str(output_dir), None, False, bytes_in=1000)
+    assert row['status'] == 'ok' and row['outputs'] == str(output_dir / 'study.tgz')
+    assert os.listdir(output_dir) == ['study.tgz'] and row['bytes_out'] == os.path.getsize(row['outputs'])
+
+
+# ── schedule_jobs ──────────────────────────────────────────────────────────────
+
+class RecordingPool(ThreadPool):
+    '''Thread pool that records the folders in the order they are submitted.'''
+    def __init__(self, processes):
+        super().__init__(processes)
+        self.submitted = []
+
+    def apply_async(self, func, args=(), **kwargs):
+        self.submitted.append(args[0][2])
+        return super().apply_async(func, args, **kwargs)
+
+
+def fake_job(log, lock, sizes, huge_bytes, blocked=()):
+    running = {'all': 0, 'huge': 0}
+
+    def run(task):
+        folder, size = task[2], task[-1]
+        if folder in blocked:
+            blocked[folder].wait()                 # a worker that never reports back
+        with lock:
+            running['all'] += 1
+            running['huge'] += size >= huge_bytes
+            log.append((running['all'], running['huge']))
+        time.sleep(0.02)
+        with lock:
+            running['all'] -= 1
+            running['huge'] -= size >= huge_bytes
+        return {'folder': folder, 'status': 'ok', 'bytes_in': size}
+    return run
+
+
+def test_schedule_largest_first_with_huge_cap(tc, monkeypatch):
+    sizes = {'h1': 900, 'h2': 800, 'h3': 700, 's1': 30, 's2': 20, 's3': 10}
+    tasks = [('simple', 'root', f, 'out', None, False) for f in ['s2', 'h3', 's1', 'h1', 's3', 'h2']]
+    log, lock = [], threading.Lock()
+    monkeypatch.setattr(tc, '_run_job_star', fake_job(log, lock, sizes, 500))
+
+    pool = RecordingPool(3)
+    rows = list(tc.schedule_jobs(pool, tasks, sizes, 3, huge_bytes=500, max_huge=1))
+    pool.close()
+    pool.join()
+
+    assert sorted(r['folder'] for r in rows) == sorted(sizes)
+    assert all(r['status'] == 'ok' for r in rows)
+    # one huge job at a time; small jobs fill the other slots in size order
+    assert pool.submitted[:3] == ['h1', 's1', 's2']
+    assert [f for f in pool.submitted if f.startswith('h')] == ['h1', 'h2', 'h3']
+    assert max(n for n, _ in log) <= 3 and max(h for _, h in log) == 1
+
+    rows = list(tc.schedule_jobs(None, tasks, sizes, 1, huge_bytes=500, max_huge=1))
+    assert [r['folder'] for r in rows] == ['h1', 'h2', 'h3', 's1', 's2', 's3']
+
+
+def test_schedule_fails_job_that_never_reports(tc, monkeypatch):
+    sizes = {'lost': 300, 'a': 200, 'b': 100}
+    tasks = [('simple', 'root', f, 'out', None, False) for f in sizes]
+    release = threading.Event()
+    monkeypatch.setattr(tc, '_run_job_star', fake_job([], threading.Lock(), sizes, 1000, {'lost': release}))
+
+    pool = RecordingPool(3)
+    rows = {r['folder']: r for r in tc.schedule_jobs(pool, tasks, sizes, 2, huge_bytes=1000, max_huge=1,
+                                                     job_timeout=0.5)}
+    release.set()
+    pool.close()
+    pool.join()
+
+    assert rows['a']['status'] == rows['b']['status'] == 'ok'
+    assert rows['lost']['status'] == 'failed' and rows['lost']['error'].startswith('TimeoutError')
+    assert rows['lost']['bytes_in'] == 300
+
+
+# ── ledger and --resume ────────────────────────────────────────────────────────
+
+@pytest.fixture
+def studies(tmp_path):
+    root_dir, output_dir = tmp_path / 'raw', tmp_path / 'out'
+    for study in ['a', 'b', 'c', 'd']:
+        (root_dir / study).mkdir(parents=True)
+        (root_dir / study / 'image.dcm').write_bytes(os.urandom(5000))
+    output_dir.mkdir()
+    return str(root_dir), str(output_dir), str(output_dir / 'ledger.csv')
+
+
+def test_resume_skips_only_valid_finished_jobs(tc, studies):
+    root_dir, output_dir, ledger_path = studies
+    for study in ['a', 'b', 'c']:
+        tc.append_ledger(ledger_path, tc.run_job('simple', root_dir, study, output_dir, None, False))
+    tc.append_ledger(ledger_path, tc.run_job('simple', root_dir, 'missing', output_dir, None, False))
+    with open(os.path.join(output_dir, 'b.tgz'), 'r+b') as f:        # b's archive was truncated since
+        f.truncate(100)
+    os.remove(os.path.join(output_dir, 'c.tgz'))                     # c's archive was deleted
+
+    ledger = tc.load_ledger(ledger_path)
+    assert ledger['a']['status'] == 'ok' and tc.output_is_valid(ledger['a'])
+    assert ledger['missing']['status'] == 'failed' and not tc.output_is_valid(ledger['missing'])
+    assert not tc.output_is_valid(ledger['b']) and not tc.output_is_valid(ledger['c'])
+
+    todo, n_done = tc.pending_folders(['a', 'b', 'c', 'd', 'missing'], 'simple', ledger_path)
+    assert todo == ['b', 'c', 'd', 'missing'] and n_done == 1
+    todo, n_done = tc.pending_folders(['a', 'b'], 'dicom', ledger_path)   # done in another mode
+    assert todo == ['a', 'b'] and n_done == 0
+
+    # a redone job's latest row wins
+    tc.append_ledger(ledger_path, tc.run_job('simple', root_dir, 'b', output_dir, None, False))
+    assert tc.pending_folders(['a', 'b'], 'simple', ledger_path) == ([], 2)
+
+
+def test_truncated_ledger_line_is_tolerated(tc, studies):
+    root_dir, output_dir, ledger_path = studies
+    tc.append_ledger(ledger_path, tc.run_job('simple', root_dir, 'a', output_dir, None, False))
+    row = tc.run_job('simple', root_dir, 'b', output_dir, None, False)
+    row['error'] = 'line one,\n"quoted" line two'
+    tc.append_ledger(ledger_path, row)
+    with open(ledger_path, 'a') as f:
+        f.write('c,simple,ok,0.1,5000,"12')                           # crash mid-append
+    assert set(tc.load_ledger(ledger_path)) == {'a', 'b'}
+    assert tc.load_ledger(ledger_path)['b']['error'] == 'line one, "quoted" line two'
+
+    tc.append_ledger(ledger_path, tc.run_job('simple', root_dir, 'd', output_dir, None, False))
+    ledger = tc.load_ledger(ledger_path)
+    assert set(ledger) == {'a', 'b', 'd'} and tc.output_is_valid(ledger['d'])
+    assert tc.pending_folders(['a', 'b', 'c', 'd'], 'simple', ledger_path) == (['c'], 3)
+
+
+def test_crosswalk_drops_non_numeric_accessions(tc, tmp_path):
+    csv_path = tmp_path / 'crosswalk.csv'
+    csv_path.write_text('accession,anon_mrn,anon_accession\n'
+                        '1001,M1,A1\n'
+                        'ACC-X,M2,A2\n'
+                        '1003.0,M3,A3\n')
+
+    crosswalk = tc.load_crosswalk(str(csv_path), 'anonymize')
+    assert crosswalk == {'accession': {'1001': ('M1', 'A1'), '1003': ('M3', 'A3')}}
+
+
+def test_size_cache_notices_changes_in_subfolders(tc, tmp_path):
+    root_dir = tmp_path / 'raw'
+    series = root_dir / 'study' / 'series'
+    series.mkdir(parents=True)
+    (series / 'a.dcm').write_bytes(b'x' * 10)
+    cache_path = str(tmp_path / 'sizes.json')
+    assert tc.job_sizes(str(root_dir), ['study'], 'simple', cache_path) == {'study': 10}
+
+    (series / 'b.dcm').write_bytes(b'x' * 5)
+    os.utime(series, ns=(time.time_ns() + 10**9,) * 2)
+    assert tc.job_sizes(str(root_dir), ['study'], 'simple', cache_path) == {'study': 15}
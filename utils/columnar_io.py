@@ -0,0 +1,180 @@
+'''
+Shared table I/O for the metadata, checksum and fingerprint manifests.
+
+Tables are described by a schema dict of column → kind:
+    'text'       string (None for missing)
+    'int'        int64
+    'float'      float64
+    'binary:N'   fixed-size binary of N bytes (fingerprints, digests); python bytes
+                 in memory, b'' for missing
+
+The format follows the file extension: .parquet writes typed columns (binary
+columns as Arrow fixed_size_binary, so a 1024-bit fingerprint is 128 raw bytes
+instead of 256 hex chars) and needs the optional pyarrow package; anything else is
+CSV with binary columns hex-encoded, kept as the human-readable export.
+
+Both writers take DataFrame chunks, so callers can stream rows out as they are
+produced (Parquet row groups / CSV appends) instead of building one big table.
+'''
+
+import csv
+
+import numpy as np
+import pandas as pd
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+
+PARQUET_AVAILABLE = pa is not None
+
+
+def default_suffix():
+	'''
+	Preferred manifest extension: .parquet when pyarrow is installed, else .csv.
+	'''
+	return '.parquet' if PARQUET_AVAILABLE else '.csv'
+
+
+def is_parquet(path):
+	return str(path).endswith('.parquet')
+
+
+def _binary_width(kind):
+	'''
+	N for a 'binary:N' kind, None for any other kind.
+	'''
+	return int(kind.split(':')[1]) if kind.startswith('binary:') else None
+
+
+def _arrow_schema(schema):
+	types = {'text': pa.string(), 'int': pa.int64(), 'float': pa.float64()}
+	fields = []
+	for column, kind in schema.items():
+		width = _binary_width(kind)
+		fields.append((column, pa.binary(width) if width else types[kind]))
+	return pa.schema(fields)
+
+
+def hex_to_bytes(values):
+	'''
+	Decode hex strings to bytes; empty, missing or malformed entries become b''.
+	'''
+	out = []
+	for value in values:
+		try:
+			out.append(bytes.fromhex(value) if isinstance(value, str) else b'')
+		except ValueError:
+			out.append(b'')
+	return out
+
+
+def binary_matrix(values, width):
+	'''
+	Stack a sequence of bytes objects, all exactly width long, into a uint8 [N, width] array.
+	'''
+	if len(values) == 0:
+		return np.zeros((0, width), dtype=np.uint8)
+	return np.frombuffer(b''.join(values), dtype=np.uint8).reshape(-1, width)
+
+
+class TableWriter:
+	'''
+	Chunked table writer: Parquet row groups for .parquet paths, CSV appends otherwise.
+
+	Args:
+		path:   Output path; the extension selects the format.
+		schema: Dict of column → kind (see module docstring), in output order.
+
+	Use as a context manager or call close(); write() takes DataFrames holding at
+	least the schema columns.
+	'''
+	def __init__(self, path, schema):
+		self.path = path
+		self.schema = schema
+		self.rows = 0
+		self.parquet = is_parquet(path)
+		if self.parquet:
+			if not PARQUET_AVAILABLE:
+				raise ImportError(f'Writing {path} requires the pyarrow package (pip install pyarrow); use a .csv path instead')
+			self.arrow_schema = _arrow_schema(schema)
+			self.writer = pq.ParquetWriter(path, self.arrow_schema)
+		else:
+			self.file = open(path, 'w', newline='')
+			csv.writer(self.file).writerow(list(schema))
+
+	def write(self, df):
+		'''
+		Append a DataFrame as one row group / CSV chunk.
+		'''
+		if len(df) == 0:
+			return
+		df = df[list(self.schema)]
+		binary = {column: _binary_width(kind) for column, kind in self.schema.items() if _binary_width(kind)}
+		if binary:
+			df = df.copy()
+		for column, width in binary.items():
+			if self.parquet:
+				df[column] = [v if v is not None and len(v) == width else None for v in df[column]]
+			else:
+				df[column] = [v.hex() if v else '' for v in df[column]]
+
+		if self.parquet:
+			self.writer.write_table(pa.Table.from_pandas(df, schema=self.arrow_schema, preserve_index=False))
+		else:
+			df.to_csv(self.file, header=False, index=False)
+		self.rows += len(df)
+
+	def close(self):
+		if self.parquet:
+			self.writer.close()
+		else:
+			self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+def write_table(df, path, schema):
+	'''
+	Write a whole DataFrame in the format given by the path extension.
+	'''
+	with TableWriter(path, schema) as writer:
+		writer.write(df)
+
+
+def read_table(path, schema=None, columns=None):
+	'''
+	Read a table written by TableWriter (or a plain CSV).
+
+	Args:
+		path:    .parquet or CSV path.
+		schema:  Optional column → kind dict. For CSV it types the columns: text
+		         columns stay strings and binary columns are hex-decoded. Columns not
+		         in the file are ignored.
+		columns: Subset of columns to read (Parquet reads only those column chunks).
+
+	Returns:
+		DataFrame; binary columns hold bytes (b'' for missing) in either format.
+	'''
+	schema = schema or {}
+	if is_parquet(path):
+		if not PARQUET_AVAILABLE:
+			raise ImportError(f'Reading {path} requires the pyarrow package (pip install pyarrow)')
+		df = pq.read_table(path, columns=columns).to_pandas()
+		for column, kind in schema.items():
+			if _binary_width(kind) and column in df.columns:
+				df[column] = [b'' if v is None else v for v in df[column]]
+		return df
+
+	dtypes = {column: str for column, kind in schema.items() if kind == 'text' or _binary_width(kind)}
+	df = pd.read_csv(path, usecols=columns, dtype=dtypes)
+	for column, kind in schema.items():
+		if _binary_width(kind) and column in df.columns:
+			df[column] = hex_to_bytes(df[column])
+	return df
@@ -9,7 +9,7 @@ same study hash differently.
 
 This tool instead compares the *imagery*. It ports the findimagedupes perceptual
 fingerprint (160 -> grey -> blur -> normalize -> equalize -> 32x32 -> threshold
-= 1024-bit hash, compared by Hamming distance) to pure Python, fingerprints the
+= 1024-bit hash, compared by Hamming distance) to Python/NumPy, fingerprints the
 first / middle / last frame of every series of every accession (single-frame, non
 -cine series are handled too), then finds pairs/clusters of accession files whose
 imagery is near-identical and writes a CSV manifest of the flagged
@@ -26,7 +26,16 @@ discriminates CMR views far better, cutting false positives at a given percentag
 
 The full fingerprint manifest is always written to disk so future datasets can be
 checked against it WITHOUT recomputing — scan a new batch and pass the prior
-manifest with --reference-csv to find cross-dataset overlap.
+manifest with --reference-csv to find cross-dataset overlap. Manifests are Parquet
+(fingerprints as 128-byte fixed-size binary) when pyarrow is installed and CSV
+(hex) otherwise; both load interchangeably, as do CSVs from older versions (fp_hex).
+
+For a growing history, --db keeps an append-only binary fingerprint DB
+(fingerprint_db.py): memory-mapped uint64 codes plus interned file/series ids, and a
+persisted band index over them. Each run looks up only the scanned batch in the
+index, then appends the batch to the DB and the index, so the cost of a run follows
+the batch size rather than the history size. An existing manifest is imported by loading it as
+the primary set (--fingerprint-csv old.parquet --db history.fpdb).
 
 Outputs default to dedup_scan_outs/ created next to this script.
 
@@ -36,27 +45,41 @@ Usage:
 
     # check a NEW batch against a previously saved fingerprint DB (no recompute of the DB)
     python detect_duplicates.py -i /path/to/new_batch -c 12 \
-        --reference-csv dedup_scan_outs/jun20_2026_fingerprint_db.csv
+        --reference-csv dedup_scan_outs/jun20_2026_fingerprint_db.parquet
+
+    # check a new batch against the binary DB, then add it to the DB
+    python detect_duplicates.py -i /path/to/new_batch -c 12 --db dedup_scan_outs/history.fpdb
+
+    # continue a scan that was interrupted during fingerprinting
+    python detect_duplicates.py -i /path/to/datastore -c 12 --resume \
+        --fingerprint-csv dedup_scan_outs/jun20_2026_dup_fingerprints.parquet
 
     # re-run matching on an existing manifest only (skip fingerprinting)
-    python detect_duplicates.py --fingerprint-csv dedup_scan_outs/jun20_2026_dup_fingerprints.csv
+    python detect_duplicates.py --fingerprint-csv dedup_scan_outs/jun20_2026_dup_fingerprints.parquet
 
 Created by Rohan Shad, MD (perceptual dedup utility)
 '''
 
 import os
 import glob
+import mmap
 import math
 import time
+import shutil
 import argparse as ap
+import functools
+import itertools
 import multiprocessing
-from collections import defaultdict
+from multiprocessing import shared_memory
+from collections import defaultdict, deque
 
 import h5py
 import numpy as np
 import pandas as pd
-from PIL import Image, ImageOps, ImageFilter
+from PIL import Image, ImageFilter
 import bcolors
+from columnar_io import read_table, write_table, default_suffix, binary_matrix, hex_to_bytes
+from fingerprint_db import FingerprintDB, BandIndex, band_bounds, band_keys
 
 # --- Fingerprint constants (chosen for internal consistency, not ImageMagick bit-fidelity) ---
 SAMPLE_SIZE = 160          # findimagedupes: Sample 160x160!
@@ -66,12 +89,20 @@ FP_BITS = GRID * GRID           # 1024
 FP_BYTES = FP_BITS // 8         # 128 bytes
 FP_WORDS = FP_BYTES // 8        # 16 uint64 lanes
 BITS_PER_PCT = FP_BITS / 100.0  # findimagedupes' 2.56 generalized to the hash width: allowed_bits = floor(BITS_PER_PCT*(100-pct))
+CHUNK_PAIRS = 1 << 22           # candidate pairs emitted per chunk (two int64 arrays of this length)
+VERIFY_CHUNK = 1 << 18          # candidate pairs verified per task (bounds the (P, FP_WORDS) gathers to 32 MB)
+FRAME_PAIR_DTYPE = np.dtype([('i', '<i8'), ('j', '<i8'), ('d', '<u2')])   # confirmed frame pair, d = Hamming bits
 RESAMPLE = Image.Resampling.BILINEAR
+FP_BATCH = 64             # frames fingerprinted per fingerprint_batch call
+WRITE_CHUNK_ROWS = 50000  # manifest rows buffered before a part file is written
+PROGRESS_SECONDS = 30     # Stage 1 progress line interval
 ALL_POSITIONS = ('first', 'middle', 'last')
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 DEFAULT_OUTDIR = os.path.join(SCRIPT_DIR, 'dedup_scan_outs')
-MANIFEST_COLS = ['source', 'relpath', 'mrn', 'accession', 'series', 'frame_pos', 'n_frames', 'fp_hex']
+MANIFEST_COLS = ['source', 'relpath', 'mrn', 'accession', 'series', 'frame_pos', 'n_frames', 'fp']
+MANIFEST_SCHEMA = {col: 'text' for col in MANIFEST_COLS}
+MANIFEST_SCHEMA.update({'n_frames': 'int', 'fp': f'binary:{FP_BYTES}'})
 
 # Vectorized popcount over (P, FP_WORDS) uint64 rows; falls back for numpy < 2.0 (no bitwise_count).
 if hasattr(np, 'bitwise_count'):
@@ -86,25 +117,133 @@ else:
 # ----------------------------------------------------------------------------- #
 #  Stage 1: fingerprinting                                                       #
 # ----------------------------------------------------------------------------- #
+def _equalize_divisor():
+	'''
+	Divisor of ImageOps.equalize's step: older Pillow releases use 256, newer ones
+	255. Probed once on the installed Pillow so fingerprints keep matching manifests
+	built with the per-frame ImageOps chain.
+	'''
+	from PIL import ImageOps
+	probe = Image.frombytes('L', (256, 1), bytes(255) + b'\x01')   # step = 255 // divisor
+	return 255 if ImageOps.equalize(probe).getpixel((255, 0)) == 255 else 256
+
+
+EQUALIZE_DIVISOR = _equalize_divisor()
+
+
+def _normalized_images(frames, indices, vmin, vmax):
+	'''
+	Yield the min/max-scaled mode 'L' image of each selected frame, identical to
+	Image.fromarray((((f - vmin) / (vmax - vmin)) * 255.0).astype(np.uint8)) in float64.
+
+	uint8 / uint16 frames (the datastore stores uint8) evaluate that expression once
+	per possible value and map the pixels through the resulting LUT (Image.point for
+	uint8), which gives the same bytes without a float64 pass over every pixel.
+	'''
+	if frames.dtype in (np.uint8, np.uint16):
+		values = np.arange(np.iinfo(frames.dtype).max + 1, dtype=np.float64)
+		for i, lo, hi in zip(indices, vmin, vmax):
+			with np.errstate(invalid='ignore'):          # values outside [lo, hi] are never looked up
+				lut = (((values - lo) / (hi - lo)) * 255.0).astype(np.uint8)
+			if frames.dtype == np.uint8:
+				yield Image.fromarray(np.ascontiguousarray(frames[i])).point(lut.tolist())
+			else:
+				yield Image.fromarray(lut[frames[i]])
+		return
+
+	for i, lo, hi in zip(indices, vmin, vmax):
+		f = frames[i].astype(np.float64)
+		f -= lo                                  # in place; same operations as ((f - vmin) / range) * 255
+		f /= hi - lo
+		f *= 255.0
+		yield Image.fromarray(f.astype(np.uint8))
+
+
+def contrast_luts(hist):
+	'''
+	ImageOps.autocontrast (cutoff 0) followed by ImageOps.equalize, as one composed
+	LUT per image, computed for a whole batch of histograms at once. The equalize
+	histogram is derived from the autocontrast LUT, so the pixels are mapped once.
+
+	Args:
+		hist: int64 [B, 256] histograms of the blurred images.
+
+	Returns:
+		int64 [B, 256] LUTs (values 0..255).
+	'''
+	B = len(hist)
+	identity = np.tile(np.arange(256, dtype=np.int64), (B, 1))
+
+	# autocontrast: stretch the occupied range [lo, hi] to [0, 255]
+	present = hist > 0
+	lo = present.argmax(axis=1)
+	hi = 255 - present[:, ::-1].argmax(axis=1)
+	stretch = identity.copy()
+	rows = hi > lo
+	if rows.any():
+		scale = 255.0 / (hi[rows] - lo[rows])[:, None]
+		offset = -lo[rows][:, None] * scale
+		stretch[rows] = np.clip(np.trunc(np.arange(256, dtype=np.float64) * scale + offset), 0, 255).astype(np.int64)
+
+	# histogram of the stretched images, then equalize
+	offsets = (np.arange(B) * 256)[:, None]
+	hist = np.bincount((stretch + offsets).ravel(), weights=hist.ravel(), minlength=B * 256).reshape(B, 256).astype(np.int64)
+	present = hist > 0
+	last = hist[np.arange(B), 255 - present[:, ::-1].argmax(axis=1)]
+	step = (hist.sum(axis=1) - last) // EQUALIZE_DIVISOR
+	equalize = identity.copy()
+	rows = (present.sum(axis=1) > 1) & (step > 0)
+	if rows.any():
+		cum = np.cumsum(hist[rows], axis=1) - hist[rows]         # exclusive cumulative count
+		equalize[rows] = ((step[rows] // 2)[:, None] + cum) // step[rows][:, None]
+
+	return np.take_along_axis(np.clip(equalize, 0, 255), stretch, axis=1)
+
+
+def fingerprint_batch(frames):
+	'''
+	Compute the 1024-bit findimagedupes-style perceptual fingerprints of a stack of
+	2D frames of one shape (B, H, W).
+
+	Same chain and same bits as the per-frame version (normalize -> resize 160
+	BILINEAR -> BoxBlur(3) -> autocontrast -> equalize -> resize 32 BILINEAR ->
+	threshold at the median). The resampling and blur stay in Pillow's C kernels,
+	which a NumPy reimplementation does not beat; everything around them is done
+	for the whole stack at once: min/max and normalization LUTs, the composed
+	autocontrast + equalize LUTs (one pixel pass instead of two) and the median
+	threshold and bit packing.
+
+	Returns:
+		List of FP_BYTES-byte fingerprints, None for degenerate (near-constant) frames.
+	'''
+	frames = np.asarray(frames)
+	vmin = frames.min(axis=(1, 2)).astype(np.float64)
+	vmax = frames.max(axis=(1, 2)).astype(np.float64)
+	ok = np.flatnonzero(vmax - vmin >= 1e-6)     # blank / constant -> not hashable
+	out = [None] * len(frames)
+	if not len(ok):
+		return out
+
+	blurred = [img.resize((SAMPLE_SIZE, SAMPLE_SIZE), RESAMPLE).filter(ImageFilter.BoxBlur(BLUR_RADIUS))
+	           for img in _normalized_images(frames, ok, vmin[ok], vmax[ok])]     # heavy low-pass
+	luts = contrast_luts(np.array([img.histogram() for img in blurred], dtype=np.int64))   # Normalize + Equalize
+	a = np.stack([np.asarray(img.point(lut).resize((GRID, GRID), RESAMPLE), dtype=np.uint8)
+	              for img, lut in zip(blurred, luts.tolist())]).reshape(len(ok), -1)
+
+	bits = a > np.median(a, axis=1, keepdims=True)               # threshold at median (== IM 50% post-equalize)
+	packed = np.packbits(bits, axis=1)                           # FP_BYTES bytes (1024 bits) per frame
+	for i, row in zip(ok.tolist(), packed):
+		out[i] = row.tobytes()
+	return out
+
+
 def fingerprint(frame2d):
 	'''
 	Compute the 1024-bit findimagedupes-style perceptual fingerprint of a single
 	2D frame. Returns 128 raw bytes, or None for a degenerate (near-constant)
 	frame that cannot be normalized.
 	'''
-	f = np.asarray(frame2d, dtype=np.float64)
-	vmin, vmax = float(f.min()), float(f.max())
-	if vmax - vmin < 1e-6:                       # blank / constant -> not hashable
-		return None
-
-	g = (((f - vmin) / (vmax - vmin)) * 255.0).astype(np.uint8)
-	img = Image.fromarray(g).resize((SAMPLE_SIZE, SAMPLE_SIZE), RESAMPLE)   # 2D uint8 -> mode 'L'
-	img = img.filter(ImageFilter.BoxBlur(BLUR_RADIUS))   # heavy low-pass
-	img = ImageOps.equalize(ImageOps.autocontrast(img))  # Normalize + Equalize
-	a = np.asarray(img.resize((GRID, GRID), RESAMPLE), dtype=np.uint8)
-
-	bits = (a > np.median(a)).flatten()          # threshold at median (== IM 50% post-equalize)
-	return np.packbits(bits).tobytes()           # FP_BYTES bytes (1024 bits)
+	return fingerprint_batch(np.asarray(frame2d)[None])[0]
 
 
 def _attr_int(dset, key):
@@ -177,8 +316,8 @@ def read_plane(dset, layout, fi):
 	return dset[0, fi]                           # (c,f,h,w)
 
 
-def fingerprint_series(dset, positions):
-	'''Yield (position, n_frames, fingerprint_bytes_or_None) for the requested frames.'''
+def series_frames(dset, positions):
+	'''Return [(position, n_frames, 2D frame)] for the requested frames of a series.'''
 	layout = series_layout(dset.shape, _attr_int(dset, 'total_images'))
 	n = layout[2]
 	wanted = {'first': 0, 'middle': n // 2, 'last': n - 1}
@@ -189,21 +328,39 @@ def fingerprint_series(dset, positions):
 		if fi in seen:                           # collapse when n < 3 (incl. single frame)
 			continue
 		seen.add(fi)
-		plane = np.asarray(read_plane(dset, layout, fi))
-		out.append((pos, n, fingerprint(plane)))
+		out.append((pos, n, np.asarray(read_plane(dset, layout, fi))))
 	return out
 
 
+def fingerprint_frames(frames):
+	'''
+	Fingerprint a list of 2D frames of any shapes: frames of one shape and dtype are
+	stacked and fingerprinted FP_BATCH at a time. Returns fingerprints in input order.
+	'''
+	groups = defaultdict(list)
+	for k, frame in enumerate(frames):
+		groups[(frame.shape, frame.dtype.str)].append(k)
+
+	fps = [None] * len(frames)
+	for members in groups.values():
+		for c in range(0, len(members), FP_BATCH):
+			chunk = members[c:c + FP_BATCH]
+			for k, fp in zip(chunk, fingerprint_batch(np.stack([frames[k] for k in chunk]))):
+				fps[k] = fp
+	return fps
+
+
 def fingerprint_file(path, input_dir, positions, source):
 	'''
 	Worker: open one .h5 accession file and fingerprint the requested frames of
-	every series. Returns a list of rows matching MANIFEST_COLS. Degenerate frames
-	get an empty fp_hex (kept for transparency, dropped later).
+	every series (all frames of the file batched together). Returns a list of rows
+	matching MANIFEST_COLS. Degenerate frames get an empty fp (kept for
+	transparency, dropped later).
 	'''
 	relpath = os.path.relpath(path, input_dir)
 	mrn = os.path.split(os.path.dirname(path))[1]
 	accession = os.path.basename(path)[:-3]
-	rows = []
+	rows, frames = [], []
 	try:
 		with h5py.File(path, 'r') as f:
 			for series in list(f.keys()):
@@ -211,19 +368,45 @@ def fingerprint_file(path, input_dir, positions, source):
 					dset = f[series]
 					if not isinstance(dset, h5py.Dataset):
 						continue
-					for pos, n, fp in fingerprint_series(dset, positions):
-						rows.append([source, relpath, mrn, accession, series, pos, n,
-						             fp.hex() if fp is not None else ''])
+					for pos, n, frame in series_frames(dset, positions):
+						rows.append([source, relpath, mrn, accession, series, pos, n])
+						frames.append(frame)
 				except Exception as ex:
 					print(f'WARN: {relpath}::{series} skipped -> {ex}')
+
+		for row, fp in zip(rows, fingerprint_frames(frames)):
+			row.append(fp if fp is not None else b'')
 	except Exception as ex:
 		print(f'{bcolors.FAIL}FAIL{bcolors.ENDC}: {relpath} -> {ex}')
 		return []
 	return rows
 
 
-def build_fingerprint_manifest(input_dir, cpus, positions, institution_prefix, source):
-	'''Walk the datastore (anon_mrn/anon_accession.h5) and fingerprint everything.'''
+def _write_part(parts_dir, rows, suffix):
+	'''
+	Write buffered manifest rows as the next part file; written under a temporary
+	name and renamed, so a part file on disk is always complete.
+	'''
+	name = f'part_{len(glob.glob(os.path.join(parts_dir, "part_*"))):06d}{suffix}'
+	tmp = os.path.join(parts_dir, '.tmp_' + name)
+	write_table(pd.DataFrame(rows, columns=MANIFEST_COLS), tmp, MANIFEST_SCHEMA)
+	os.replace(tmp, os.path.join(parts_dir, name))
+
+
+def build_fingerprint_manifest(input_dir, cpus, positions, institution_prefix, source, manifest_path, resume=False):
+	'''
+	Walk the datastore (anon_mrn/anon_accession.h5), fingerprint everything and
+	write the manifest to manifest_path.
+
+	Files are fingerprinted with Pool.imap_unordered and rows are flushed every
+	WRITE_CHUNK_ROWS rows to part files in <manifest_path>.parts/, so Stage 1 memory
+	does not grow with the datastore. When all files are done the parts are combined
+	into the manifest (sorted by relpath) and removed. With resume, files already in
+	the part files of an interrupted run are skipped.
+
+	Returns:
+		The manifest as a DataFrame.
+	'''
 	if institution_prefix:
 		filelist = glob.glob(os.path.join(input_dir, f'{institution_prefix}*', '*h5'))
 	else:
@@ -231,33 +414,74 @@ def build_fingerprint_manifest(input_dir, cpus, positions, institution_prefix, s
 	filelist.sort()
 	print(f'Found {len(filelist)} accession files under {input_dir}  (source label: {source})')
 
-	rows = []
+	suffix = os.path.splitext(manifest_path)[1] or '.csv'
+	parts_dir = manifest_path + '.parts'
+	if os.path.isdir(parts_dir) and not resume:
+		shutil.rmtree(parts_dir)
+	if resume and not os.path.isdir(parts_dir):
+		print(f'{bcolors.WARN}Nothing to resume: no partial manifest at {parts_dir}, fingerprinting from scratch{bcolors.END}')
+	os.makedirs(parts_dir, exist_ok=True)
+	for tmp in glob.glob(os.path.join(parts_dir, '.tmp_*')):
+		os.remove(tmp)                           # part interrupted while being written
+
+	done = set()
+	for part in glob.glob(os.path.join(parts_dir, 'part_*')):
+		done.update(read_table(part, MANIFEST_SCHEMA, columns=['relpath'])['relpath'].tolist())
+	todo = [f for f in filelist if os.path.relpath(f, input_dir) not in done]
+	if resume:
+		print(f'Resuming: {len(filelist) - len(todo)} files already fingerprinted, {len(todo)} to go')
+
+	worker = functools.partial(fingerprint_file, input_dir=input_dir, positions=positions, source=source)
 	if cpus > 1:
 		p = multiprocessing.Pool(processes=cpus)
-		async_results = [p.apply_async(fingerprint_file, [fp, input_dir, positions, source]) for fp in filelist]
+		results = p.imap_unordered(worker, todo, chunksize=max(1, min(16, len(todo) // (cpus * 8))))
+	else:
+		results = map(worker, todo)
+
+	start = last_report = time.time()
+	rows, n_frames = [], 0
+	for k, file_rows in enumerate(results):
+		rows.extend(file_rows)
+		n_frames += len(file_rows)
+		if len(rows) >= WRITE_CHUNK_ROWS:
+			_write_part(parts_dir, rows, suffix)
+			rows = []
+		now = time.time()
+		if now - last_report >= PROGRESS_SECONDS or k + 1 == len(todo):
+			last_report = now
+			rate = (k + 1) / max(now - start, 1e-9)
+			print(f'  ...fingerprinted {k + 1}/{len(todo)} files  ({rate:.1f} files/s, '
+			      f'{n_frames / max(now - start, 1e-9):.0f} frames/s, ETA {(len(todo) - k - 1) / rate:.0f}s)')
+	if rows:
+		_write_part(parts_dir, rows, suffix)
+	if cpus > 1:
 		p.close()
 		p.join()
-		for k, r in enumerate(async_results):
-			rows.extend(r.get())
-			if (k + 1) % 500 == 0:
-				print(f'  ...fingerprinted {k + 1}/{len(filelist)} files')
-	else:
-		for k, fp in enumerate(filelist):
-			rows.extend(fingerprint_file(fp, input_dir, positions, source))
-			if (k + 1) % 500 == 0:
-				print(f'  ...fingerprinted {k + 1}/{len(filelist)} files')
 
-	return pd.DataFrame(rows, columns=MANIFEST_COLS)
+	parts = sorted(glob.glob(os.path.join(parts_dir, 'part_*')))
+	if parts:
+		df = pd.concat([read_table(part, MANIFEST_SCHEMA) for part in parts], ignore_index=True)
+		df = df[MANIFEST_COLS].sort_values('relpath', kind='stable', ignore_index=True)
+	else:
+		df = pd.DataFrame(columns=MANIFEST_COLS)
+	write_table(df, manifest_path, MANIFEST_SCHEMA)
+	shutil.rmtree(parts_dir)
+	return df
 
 
 def load_manifest(path, default_label):
-	'''Load a saved fingerprint manifest, tolerating older schemas (no source column).'''
-	df = pd.read_csv(path, dtype={'fp_hex': str})
+	'''
+	Load a saved fingerprint manifest (.parquet or .csv), tolerating older schemas
+	(no source column, hex fingerprints in fp_hex).
+	'''
+	df = read_table(path, {**MANIFEST_SCHEMA, 'fp_hex': 'text'})
+	if 'fp' not in df.columns and 'fp_hex' in df.columns:
+		df['fp'] = hex_to_bytes(df['fp_hex'])
 	if 'source' not in df.columns:
 		df['source'] = default_label
 	for col in MANIFEST_COLS:
 		if col not in df.columns:
-			df[col] = 0 if col == 'n_frames' else ''
+			df[col] = 0 if col == 'n_frames' else (b'' if col == 'fp' else '')
 	return df[MANIFEST_COLS]
 
 
@@ -266,78 +490,222 @@ def load_manifest(path, default_label):
 # ----------------------------------------------------------------------------- #
 def load_codes(df):
 	'''
-	Keep only rows with a fingerprint of the current width (FP_BYTES*2 hex chars);
-	return (clean_df, fp_bytes list, codes uint64[N, FP_WORDS]). Empty fp_hex
+	Keep only rows with a fingerprint of the current width (FP_BYTES bytes);
+	return (clean_df, fp8 uint8[N, FP_BYTES], codes uint64[N, FP_WORDS]). Empty fp
 	(degenerate frames) are dropped silently; fingerprints of a *different* width
 	(a manifest built with another GRID) raise a clear error rather than vanishing.
 	'''
-	s = df['fp_hex'].astype(str)
-	valid = s.str.fullmatch(r'[0-9a-fA-F]{%d}' % (FP_BYTES * 2)).fillna(False)
-	wrong_width = s.str.fullmatch(r'[0-9a-fA-F]+').fillna(False) & ~valid
+	lengths = np.fromiter((len(fp) for fp in df['fp']), dtype=np.int64, count=len(df))
+	valid = lengths == FP_BYTES
+	wrong_width = (lengths > 0) & ~valid
 	if wrong_width.any():
-		bad_len = int(s[wrong_width].str.len().iloc[0])
+		bad_len = int(lengths[wrong_width][0]) * 2
 		raise SystemExit(
 			f'Incompatible fingerprint manifest: {int(wrong_width.sum())} fingerprints have '
 			f'{bad_len} hex chars, but this build uses GRID={GRID} ({FP_BYTES * 2} hex chars). '
 			f'Manifests/DBs built with a different GRID must be regenerated from the source HDF5.')
 	clean = df[valid].reset_index(drop=True)
-	fp_bytes = [bytes.fromhex(h) for h in clean['fp_hex']]
-	codes = np.zeros((len(fp_bytes), FP_WORDS), dtype=np.uint64)
-	for i, b in enumerate(fp_bytes):
-		codes[i] = np.frombuffer(b, dtype='>u8')
-	return clean, fp_bytes, codes
+	fp8 = binary_matrix(clean['fp'].tolist(), FP_BYTES)
+	codes = fp8.view('>u8').astype(np.uint64)
+	return clean, fp8, codes
 
 
-def candidate_pairs(fp_bytes, n_bands, max_bucket):
+def candidate_pairs(fp8, n_bands, max_bucket, stats=None, chunk_size=CHUNK_PAIRS):
 	'''
 	Multi-index hashing (pigeonhole): split each fingerprint into n_bands
 	byte-boundary segments. Two codes within Hamming d agree on >=1 band when
-	n_bands = d + 1, so any near-duplicate pair shares a bucket. Returns the set
-	of candidate (i,j) index pairs (i<j) plus a count of oversized buckets skipped.
+	n_bands = d + 1, so any near-duplicate pair shares a bucket.
+
+	Buckets are found per band by argsorting the band keys; all pairs inside a
+	bucket are generated with triu_indices, batched over buckets of equal size. A
+	pair is only emitted for the first band it collides in (earlier bands' keys are
+	compared), so chunks never repeat a pair and no global pair set is kept.
+
+	Args:
+		fp8:        uint8[N, FP_BYTES] fingerprints (from load_codes).
+		n_bands:    Number of bands.
+		max_bucket: Buckets larger than this are skipped and logged.
+		stats:      Optional dict; 'candidates' and 'skipped_buckets' are added to.
+		chunk_size: Approximate number of pairs per yielded chunk.
+
+	Yields:
+		(I, J) int64 arrays of candidate index pairs with I < J.
 	'''
-	N = len(fp_bytes)
-	bounds = [round(k * FP_BYTES / n_bands) for k in range(n_bands + 1)]
-	pairs = set()
-	skipped = 0
+	stats = stats if stats is not None else {}
+	stats.setdefault('candidates', 0)
+	stats.setdefault('skipped_buckets', 0)
+	N = len(fp8)
+	bounds = band_bounds(FP_BYTES, n_bands)
+	prev_keys = []                               # (keys, in_skipped_bucket) of earlier bands
+
 	for k in range(n_bands):
 		s, e = bounds[k], bounds[k + 1]
-		if s == e:
+		if s == e or N < 2:
 			continue
-		buckets = defaultdict(list)
-		for i in range(N):
-			buckets[fp_bytes[i][s:e]].append(i)
-		for members in buckets.values():
-			m = len(members)
-			if m < 2:
-				continue
-			if m > max_bucket:
-				skipped += 1
-				print(f'WARN: band bucket of {m} codes exceeds --max-bucket={max_bucket}; '
-				      f'skipping (likely a large genuine duplicate set — review manually)')
-				continue
-			for a in range(m):
-				for b in range(a + 1, m):
-					ia, ib = members[a], members[b]
-					pairs.add((ia, ib) if ia < ib else (ib, ia))
-	return pairs, skipped
-
-
-def verify_pairs(pairs, codes, fids, max_bits):
-	'''Exact-Hamming verification of candidate pairs; keep cross-file pairs within max_bits.'''
-	if not pairs:
-		return []
-	I = np.fromiter((p[0] for p in pairs), dtype=np.int64, count=len(pairs))
-	J = np.fromiter((p[1] for p in pairs), dtype=np.int64, count=len(pairs))
-	xor = codes[I] ^ codes[J]
-	dist = _popcount_rows(xor)
-	keep = dist <= max_bits
-	out = []
-	for i, j, d in zip(I[keep].tolist(), J[keep].tolist(), dist[keep].tolist()):
-		if fids[i] != fids[j]:                   # never a duplicate of itself (source+relpath)
-			out.append((i, j, int(d)))
+		keys = band_keys(fp8, s, e)
+		order = np.argsort(keys, kind='stable')
+		sorted_keys = keys[order]
+		starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+		sizes = np.diff(np.r_[starts, N])
+
+		skipped = np.zeros(N, dtype=bool)
+		for start, m in zip(starts[sizes > max_bucket].tolist(), sizes[sizes > max_bucket].tolist()):
+			stats['skipped_buckets'] += 1
+			skipped[order[start:start + m]] = True
+			print(f'WARN: band bucket of {m} codes exceeds --max-bucket={max_bucket}; '
+			      f'skipping (likely a large genuine duplicate set — review manually)')
+
+		usable = (sizes >= 2) & (sizes <= max_bucket)
+		for m in np.unique(sizes[usable]).tolist():
+			group_starts = starts[usable & (sizes == m)]
+			tri_a, tri_b = np.triu_indices(m, 1)
+			per_chunk = max(1, chunk_size // len(tri_a))
+			for c in range(0, len(group_starts), per_chunk):
+				base = group_starts[c:c + per_chunk, None]
+				A = order[(base + tri_a).ravel()]
+				B = order[(base + tri_b).ravel()]
+				I, J = np.minimum(A, B), np.maximum(A, B)
+
+				first = np.ones(len(I), dtype=bool)
+				for prev, prev_skipped in prev_keys:
+					first &= (prev[I] != prev[J]) | prev_skipped[I]
+				I, J = I[first], J[first]
+				if len(I):
+					stats['candidates'] += len(I)
+					yield I, J
+
+		prev_keys.append((keys, skipped))
+
+
+_VERIFY = {}                       # per-process verification state, set by _init_verify
+
+
+def _share(array):
+	'''
+	Picklable description of a code matrix that worker processes re-open without a
+	copy: memory-mapped files (the fingerprint DB) by path, anything else through a
+	shared memory block. Returns (spec, SharedMemory or None).
+	'''
+	if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.offset == 0:
+		return ('mmap', array.filename, array.dtype.str, array.shape), None
+	array = np.ascontiguousarray(array)
+	shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+	np.ndarray(array.shape, array.dtype, buffer=shm.buf)[:] = array
+	return ('shm', shm.name, array.dtype.str, array.shape), shm
+
+
+def _attach(spec):
+	kind, name, dtype, shape = spec
+	if kind == 'mmap':
+		return np.memmap(name, dtype=dtype, mode='r', shape=shape)
+	shm = shared_memory.SharedMemory(name=name)
+	_VERIFY.setdefault('shm', []).append(shm)    # the array is only valid while the block stays open
+	return np.ndarray(shape, dtype, buffer=shm.buf)
+
+
+def _init_verify(codes_spec, other_spec, file_ids, max_bits):
+	'''Pool initializer: attach the shared code matrices.'''
+	codes = _attach(codes_spec)
+	_VERIFY.update(codes=codes, other=_attach(other_spec) if other_spec else codes,
+	               file_ids=file_ids, max_bits=max_bits)
+
+
+def _verify_chunk(chunk):
+	'''
+	Hamming-check one chunk of candidate pairs; returns the confirmed ones as a
+	FRAME_PAIR_DTYPE array.
+	'''
+	I, J = chunk
+	dist = _popcount_rows(_VERIFY['codes'][I] ^ _VERIFY['other'][J])
+	keep = dist <= _VERIFY['max_bits']
+	if _VERIFY['file_ids'] is not None:
+		keep &= _VERIFY['file_ids'][I] != _VERIFY['file_ids'][J]    # never a duplicate of itself
+	out = np.empty(int(keep.sum()), dtype=FRAME_PAIR_DTYPE)
+	out['i'], out['j'], out['d'] = I[keep], J[keep], dist[keep]
 	return out
 
 
+def _split_chunks(pair_chunks, size):
+	for I, J in pair_chunks:
+		for c in range(0, len(I), size):
+			yield I[c:c + size], J[c:c + size]
+
+
+def verify_pairs(pair_chunks, codes, file_ids, max_bits, cpus=1, other_codes=None):
+	'''
+	Exact-Hamming verification of candidate pair chunks (from candidate_pairs or
+	BandIndex.query), VERIFY_CHUNK pairs at a time.
+
+	With cpus > 1 and more than one chunk of work, chunks are verified by a worker
+	pool that shares the code matrices (shared memory, or the DB's memory map) and
+	returns only the confirmed pairs; at most 2 * cpus chunks are in flight, so
+	candidates are generated while earlier chunks are verified.
+
+	Args:
+		pair_chunks: Iterable of (I, J) int64 index arrays.
+		codes:       uint64 [N, FP_WORDS] codes indexed by I (and by J without other_codes).
+		file_ids:    int [N] file id of every code; pairs within one file are dropped.
+		             None skips the check (the two sides never share a file).
+		max_bits:    Largest Hamming distance kept.
+		cpus:        Worker processes.
+		other_codes: Codes indexed by J when J refers to another matrix (the fingerprint DB).
+
+	Returns:
+		FRAME_PAIR_DTYPE array of confirmed pairs, sorted by (i, j).
+	'''
+	pieces = _split_chunks(pair_chunks, VERIFY_CHUNK)
+	head = list(itertools.islice(pieces, 2))
+	pieces = itertools.chain(head, pieces)
+	found = []
+
+	if cpus <= 1 or len(head) < 2:
+		_VERIFY.update(codes=codes, other=other_codes if other_codes is not None else codes,
+		               file_ids=file_ids, max_bits=max_bits)
+		try:
+			found = [_verify_chunk(chunk) for chunk in pieces]
+		finally:
+			_VERIFY.clear()
+	else:
+		codes_spec, codes_shm = _share(codes)
+		other_spec, other_shm = _share(other_codes) if other_codes is not None else (None, None)
+		p = multiprocessing.Pool(processes=cpus, initializer=_init_verify,
+		                         initargs=(codes_spec, other_spec, file_ids, max_bits))
+		try:
+			pending = deque()
+			for chunk in pieces:
+				pending.append(p.apply_async(_verify_chunk, (chunk,)))
+				if len(pending) >= 2 * cpus:
+					found.append(pending.popleft().get())
+			found.extend(result.get() for result in pending)
+		finally:
+			p.close()
+			p.join()
+			for shm in (codes_shm, other_shm):
+				if shm is not None:
+					shm.close()
+					shm.unlink()
+
+	pairs = np.concatenate(found) if found else np.empty(0, dtype=FRAME_PAIR_DTYPE)
+	return pairs[np.lexsort((pairs['j'], pairs['i']))]     # independent of band / chunk order
+
+
+def merge_db_matches(clean, frame_pairs, db, db_pairs):
+	'''
+	Add the DB rows of every DB file with a confirmed match to clean (all of the
+	file's rows, so its series count is right) and append db_pairs (j = DB row),
+	re-indexed into the merged frame, to frame_pairs. Returns (merged_df, frame_pairs).
+	'''
+	if not len(db_pairs):
+		return clean, frame_pairs
+	file_of = db.rows['file']
+	rows = np.flatnonzero(np.isin(file_of, np.unique(file_of[db_pairs['j']])))
+	merged = pd.concat([clean.drop(columns='fp'), db.frame(rows)], ignore_index=True)
+	db_pairs = db_pairs.copy()
+	db_pairs['j'] = len(clean) + np.searchsorted(rows, db_pairs['j'])
+	frame_pairs = np.concatenate([frame_pairs, db_pairs])
+	return merged, frame_pairs[np.lexsort((frame_pairs['j'], frame_pairs['i']))]
+
+
 class UnionFind:
 	def __init__(self):
 		self.parent = {}
@@ -371,7 +739,7 @@ def aggregate_to_files(frame_pairs, df, min_series, new_sources):
 	n_series = df.groupby(['source', 'relpath'])['series'].nunique().to_dict()
 
 	agg = {}
-	for i, j, d in frame_pairs:
+	for i, j, d in zip(frame_pairs['i'].tolist(), frame_pairs['j'].tolist(), frame_pairs['d'].tolist()):
 		ka, sa = (src[i], rel[i]), ser[i]
 		kb, sb = (src[j], rel[j]), ser[j]
 		if ka == kb:
@@ -438,7 +806,7 @@ if __name__ == "__main__":
 	                    help='Datastore root containing anon_mrn/anon_accession.h5 (omit only with --fingerprint-csv)')
 	parser.add_argument('-o', '--output_dir', default=None,
 	                    help='Output directory (default: dedup_scan_outs/ next to this script)')
-	parser.add_argument('-c', '--cpus', type=int, default=12, help='Number of CPUs for fingerprinting')
+	parser.add_argument('-c', '--cpus', type=int, default=12, help='Number of CPUs for fingerprinting and pair verification')
 	parser.add_argument('--threshold', type=float, default=99.0,
 	                    help='Similarity %% of the 1024-bit hash; allowed_bits = floor((1024/100)*(100-thr)). 99 -> <=10 bits')
 	parser.add_argument('--frames', default='first,middle,last',
@@ -449,13 +817,22 @@ if __name__ == "__main__":
 	parser.add_argument('--max-bucket', type=int, default=5000,
 	                    help='Skip+log band buckets larger than this (guards against pathological blowups)')
 	parser.add_argument('--fingerprint-csv', default=None,
-	                    help='Load this manifest as the PRIMARY set and skip Stage 1 if it exists; else write it here')
+	                    help='Load this manifest (.parquet or .csv) as the PRIMARY set and skip Stage 1 if it exists; else write it here')
 	parser.add_argument('--reference-csv', default=None,
-	                    help='Comma list of previously saved fingerprint manifests to match against (not recomputed)')
+	                    help='Comma list of previously saved fingerprint manifests (.parquet or .csv) to match against (not recomputed)')
+	parser.add_argument('--db', default=None,
+	                    help='Binary fingerprint DB directory (created if missing): the scanned batch is looked up in its '
+	                         'band index, then appended to it')
 	parser.add_argument('--source-label', default=None,
 	                    help='Label for the scanned dataset in the manifest (default: input dir basename)')
+	parser.add_argument('--resume', action='store_true', default=False,
+	                    help='Continue an interrupted Stage 1: skip files already in the partial manifest '
+	                         '(requires the same --fingerprint-csv path as the interrupted run)')
 	parser.add_argument('--institution_prefix', default=None, help='Only scan anon_mrn dirs starting with this prefix')
 	args = parser.parse_args()
+	if args.resume and not args.fingerprint_csv:
+		# the default manifest name is date-stamped, so it cannot find a run from another day
+		raise SystemExit('--resume requires --fingerprint-csv, the manifest path of the interrupted run')
 
 	start = time.time()
 	output_dir = args.output_dir or DEFAULT_OUTDIR
@@ -477,7 +854,7 @@ if __name__ == "__main__":
 	print('------------------------------------')
 
 	# Stage 1 — PRIMARY fingerprint manifest (compute fresh, or load to skip fingerprinting)
-	fp_manifest_path = args.fingerprint_csv or os.path.join(output_dir, f'{date}_dup_fingerprints.csv')
+	fp_manifest_path = args.fingerprint_csv or os.path.join(output_dir, f'{date}_dup_fingerprints{default_suffix()}')
 	if args.fingerprint_csv and os.path.exists(args.fingerprint_csv):
 		print(f'Loading PRIMARY fingerprint manifest (skipping Stage 1): {args.fingerprint_csv}')
 		default_label = args.source_label or os.path.splitext(os.path.basename(args.fingerprint_csv))[0]
@@ -488,8 +865,8 @@ if __name__ == "__main__":
 		if not args.input_dir:
 			raise SystemExit('--input_dir is required unless --fingerprint-csv points at an existing manifest')
 		source_label = args.source_label or os.path.basename(os.path.normpath(args.input_dir)) or 'scan'
-		primary = build_fingerprint_manifest(args.input_dir, args.cpus, positions, args.institution_prefix, source_label)
-		primary.to_csv(fp_manifest_path, index=False)
+		primary = build_fingerprint_manifest(args.input_dir, args.cpus, positions, args.institution_prefix,
+		                                     source_label, fp_manifest_path, args.resume)
 		print(f'Fingerprint manifest written: {fp_manifest_path}')
 
 	new_sources = set(primary['source'].unique())
@@ -505,17 +882,19 @@ if __name__ == "__main__":
 			      f'sources={sorted(ref_df["source"].unique())})')
 			ref_frames.append(ref_df)
 
+	db = FingerprintDB(args.db, FP_WORDS) if args.db else None
+
 	df = pd.concat([primary] + ref_frames, ignore_index=True) if ref_frames else primary
-	use_new_filter = None if not ref_frames else new_sources   # only restrict to new data when a reference is used
+	use_new_filter = None if not ref_frames and not db else new_sources   # only restrict to new data when a reference is used
 
 	# Persist a combined DB snapshot so the union can be referenced next time without recompute
 	if ref_frames:
-		db_path = os.path.join(output_dir, f'{date}_fingerprint_db.csv')
-		df.drop_duplicates(subset=['source', 'relpath', 'series', 'frame_pos']).to_csv(db_path, index=False)
+		db_path = os.path.join(output_dir, f'{date}_fingerprint_db{default_suffix()}')
+		write_table(df.drop_duplicates(subset=['source', 'relpath', 'series', 'frame_pos']), db_path, MANIFEST_SCHEMA)
 		print(f'Combined fingerprint DB written (pass as --reference-csv next time): {db_path}')
 
 	# Stage 2 — near-duplicate search
-	clean, fp_bytes, codes = load_codes(df)
+	clean, fp8, codes = load_codes(df)
 	n_total, n_valid = len(df), len(clean)
 	n_degenerate = n_total - n_valid
 	n_files = clean[['source', 'relpath']].drop_duplicates().shape[0]
@@ -523,9 +902,21 @@ if __name__ == "__main__":
 	print(f'Fingerprints: {n_valid} valid frames across {n_files} files '
 	      f'({n_series_total} series); {n_degenerate} degenerate frames skipped')
 
-	fids = list(zip(clean['source'].tolist(), clean['relpath'].tolist()))
-	pairs, skipped_buckets = candidate_pairs(fp_bytes, n_bands, args.max_bucket)
-	frame_pairs = verify_pairs(pairs, codes, fids, max_bits)
+	file_ids = clean.groupby(['source', 'relpath'], sort=False).ngroup().to_numpy()
+	pair_stats = {}
+	frame_pairs = verify_pairs(candidate_pairs(fp8, n_bands, args.max_bucket, pair_stats),
+	                           codes, file_ids, max_bits, args.cpus)
+	if db is not None and len(db):
+		index = BandIndex(db, n_bands)
+		indexed = index.update()                     # rows appended without this band count (all, on first use)
+		print(f'Fingerprint DB: {args.db}  ({len(db)} rows of {len(db.tables["files"])} files; '
+		      f'{n_bands}-band index, {indexed} rows newly indexed, {len(index.header["segments"])} segments)')
+		local_files = set(zip(clean['source'], clean['relpath']))
+		skip_ids = [k for k, f in enumerate(db.tables['files']) if f[:2] in local_files]
+		db_pairs = verify_pairs(index.query(fp8, args.max_bucket, pair_stats, skip_ids, CHUNK_PAIRS),
+		                        codes, None, max_bits, args.cpus, other_codes=db.codes)
+		clean, frame_pairs = merge_db_matches(clean, frame_pairs, db, db_pairs)
+	n_candidates, skipped_buckets = pair_stats['candidates'], pair_stats['skipped_buckets']
 	pair_rows, flagged_rows, n_clusters = aggregate_to_files(frame_pairs, clean, args.min_series, use_new_filter)
 
 	# Outputs
@@ -538,6 +929,18 @@ if __name__ == "__main__":
 	).to_csv(dup_path, index=False)
 	pd.DataFrame(flagged_rows, columns=['source', 'relpath', 'cluster_id', 'n_partners']).to_csv(flag_path, index=False)
 
+	if db is not None:
+		primary_clean, _, primary_codes = load_codes(primary)
+		primary_files = set(zip(primary_clean['source'], primary_clean['relpath']))
+		n_stored = sum(db.has_file(source, relpath) for source, relpath in primary_files)
+		added = db.append(primary_clean, primary_codes)
+		BandIndex(db, n_bands).update()
+		print(f'Appended {added} fingerprints of {len(primary_files) - n_stored} new files to {args.db} (now {len(db)} rows)')
+		if n_stored:
+			# the DB is append-only: a reprocessed file is matched against, not replaced
+			print(f'{bcolors.WARN}Skipped {n_stored} files already stored in the DB under the same source and relpath: '
+			      f'they keep the fingerprints of their first scan, even if they were reprocessed since{bcolors.END}')
+
 	elapsed = round(time.time() - start, 2)
 	log_path = os.path.join(output_dir, f'{date}_dedup_run.log')
 	with open(log_path, 'a') as log:
@@ -545,17 +948,20 @@ if __name__ == "__main__":
 		log.write(f'# input:     {args.input_dir}\n')
 		log.write(f'# output:    {output_dir}\n')
 		log.write(f'# reference: {args.reference_csv}\n')
+		log.write(f'# db:        {args.db}\n')
 		log.write(f'# params:    threshold={args.threshold}% allowed_bits<={max_bits} bands={n_bands} '
 		          f'frames={",".join(positions)} min_series={args.min_series} max_bucket={args.max_bucket}\n')
 		log.write(f'files={n_files} series={n_series_total} valid_frames={n_valid} degenerate={n_degenerate} '
-		          f'candidate_pairs={len(pairs)} confirmed_frame_pairs={len(frame_pairs)} '
+		          f'candidate_pairs={n_candidates} confirmed_frame_pairs={len(frame_pairs)} '
 		          f'flagged_file_pairs={len(pair_rows)} clusters={n_clusters} '
 		          f'oversized_buckets_skipped={skipped_buckets} elapsed={elapsed}s\n')
+		if db is not None:
+			log.write(f'db_appended_rows={added} db_files_already_stored={n_stored}\n')
 
 	print('------------------------------------')
 	print(f'{bcolors.BLUE}Flagged file pairs:{bcolors.ENDC} {len(pair_rows)}  '
 	      f'across {n_clusters} clusters  ({len(flagged_rows)} distinct files)')
-	print(f'candidate pairs={len(pairs)}  confirmed frame pairs={len(frame_pairs)}  '
+	print(f'candidate pairs={n_candidates}  confirmed frame pairs={len(frame_pairs)}  '
 	      f'oversized buckets skipped={skipped_buckets}')
 	print(f'Duplicate manifest: {dup_path}')
 	print(f'Flagged files:      {flag_path}')
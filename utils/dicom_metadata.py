@@ -19,35 +19,56 @@ Usage:
         -f mrn:PatientID accession:AccessionNumber scanner:Manufacturer  # custom fields
 '''
 
-import torch
-import matplotlib
-import matplotlib.pyplot as plt
-import random
-import os 
-import numpy as np
-import argparse as ap
-import glob
-import pydicom as dcm
+import os
+import io
+import csv
 import time
-import multiprocessing
+import sqlite3
 import tarfile
-from shutil import rmtree
-import pandas as pd
+import argparse as ap
+import multiprocessing
 from collections import Counter
-from local_config import get_cfg
-
-_cfg     = get_cfg()
-ATTN_DIR = _cfg.attn_dir
-TMP_DIR  = _cfg.tmp_dir
+from pydicom.datadict import tag_for_keyword
+from pydicom.multival import MultiValue
+from dcmutils import read_dicom_header
+
+# Workers only need the imports above; pandas is imported in __main__ so spawned
+# workers (which re-import this module) do not load it.
+
+# Leading bytes of a tar member read for the header; the rest is only read when the
+# Pixel Data tag is not in this prefix (very large headers)
+HEADER_PREFIX_BYTES = 1 << 18
+_PIXEL_DATA_TAG = b'\xe0\x7f\x10\x00'
+
+# Output rows buffered before each CSV write
+WRITE_CHUNK_ROWS = 10000
+
+# --deep profiling: numeric tags (→ number of values kept) aggregated as min/max/nunique
+# per series, and text tags aggregated as nunique plus the '|'-joined unique values
+DEEP_NUMERIC_TAGS = {
+	'RepetitionTime':        1,
+	'EchoTime':              1,
+	'FlipAngle':             1,
+	'TriggerTime':           1,
+	'CardiacNumberOfImages': 1,
+	'SliceThickness':        1,
+	'SpacingBetweenSlices':  1,
+	'SliceLocation':         1,
+	'InstanceNumber':        1,
+	'PixelSpacing':          2,
+	'Rows':                  1,
+	'Columns':               1,
+}
+DEEP_TEXT_TAGS = ['TransferSyntaxUID', 'SOPClassUID', 'SeriesDescription', 'ImageType']
 
 
 class Dicom_Metadata_Scanner:
 	'''
 	Extract metadata from DICOM series stored in tar.gz archives.
 
-	For each archive, extracts to TMP_DIR, iterates series subfolders,
-	reads metadata from a sample DICOM per subfolder, and returns structured
-	records for downstream CSV export. Cleans up extracted files after processing.
+	For each archive, streams the tar members, picks the first DICOM of every
+	series subfolder and parses only its header, returning structured records for
+	downstream CSV export. Nothing is extracted to disk.
 
 	The set of extracted fields is configurable via the `fields` dict, which maps
 	output column names to DICOM tag attribute names. This determines both what is
@@ -67,121 +88,413 @@ class Dicom_Metadata_Scanner:
 		self.institution_prefix = institution_prefix
 		self.fields = fields
 
-	def dcm_reader(self, dcm_subfolder):
+
+	def read_tags(self, dcm_file, tags):
 		'''
-		Read metadata from the first DICOM file in a series subfolder.
+		Read raw header values for a list of DICOM keywords.
 
-		Iterates self.fields to extract each requested DICOM tag. All values are
-		cast to str to handle pydicom types (PersonName, DS, IS, etc.) that do not
-		serialize cleanly as raw objects. Tags absent on a given DICOM are recorded
-		as None. SeriesDescription values are sanitized (spaces and slashes replaced
-		with underscores). Applies institution-specific overrides for medstar, segmed,
+		Values are cast to str to handle pydicom types (PersonName, DS, IS, etc.)
+		that do not serialize cleanly as raw objects. Tags absent on the DICOM (or
+		unknown keywords) are returned as None.
+
+		Args:
+			dcm_file: Path or binary file-like object of a DICOM in the series.
+			tags:     DICOM keywords to read.
+
+		Returns:
+			Dict of {keyword: str value or None}.
+		'''
+		df = read_dicom_header(dcm_file, [tag for tag in tags if tag_for_keyword(tag) is not None])
+		values = {}
+		for tag in tags:
+			value = df.get(tag) if tag_for_keyword(tag) is not None else None
+			values[tag] = None if value is None else str(value)
+		return values
+
+	def make_record(self, tag_values, filename):
+		'''
+		Turn raw header values into an output record keyed by self.fields columns.
+
+		SeriesDescription values are sanitized (spaces and slashes replaced with
+		underscores). Applies institution-specific overrides for medstar, segmed,
 		and ukbiobank on the 'mrn' and 'accession' keys, which are always present
-		via FIXED_FIELDS.
+		via FIXED_FIELDS, using the archive filename (mrn-accession.tgz).
+
+		Args:
+			tag_values: Dict of {keyword: value} as returned by read_tags().
+			filename:   Basename of the archive the values came from.
+
+		Returns:
+			Dict of {column_name: value} for all fields in self.fields.
+		'''
+		record = {}
+		for col_name, tag in self.fields.items():
+			value = tag_values.get(tag)
+			if value is not None and tag == 'SeriesDescription':
+				value = value.replace(' ', '_').replace('/', '_')
+			record[col_name] = value
+
+		# Institution-specific MRN/accession overrides
+		if self.institution_prefix in ('medstar', 'segmed', 'ukbiobank'):
+			if 'mrn' in record:
+				record['mrn'] = filename.split('-')[0]
+			if 'accession' in record:
+				record['accession'] = filename.split('-')[1][:-4]
+
+		return record
+
+	def dcm_reader(self, dcm_file):
+		'''
+		Read metadata from the header of a sample DICOM file of a series.
 
 		Args:
-			dcm_subfolder: Path to a single series directory containing .dcm files.
+			dcm_file: Path or binary file-like object of a DICOM in the series.
 
 		Returns:
 			Dict of {column_name: value} for all fields in self.fields,
 			or None if the DICOM is corrupted or unreadable.
 		'''
-		dicom_list = os.listdir(dcm_subfolder)
-
 		try:
-			df = dcm.dcmread(os.path.join(dcm_subfolder, dicom_list[1]))
-			df.PhotometricInterpretation = 'MONOCHROME2'
-
-			record = {}
-			for col_name, tag in self.fields.items():
-				try:
-					value = getattr(df, tag)
-					# Cast to str to handle pydicom types (PersonName, DS, IS, etc.)
-					# that do not serialize cleanly as raw objects
-					value = str(value)
-					if tag == 'SeriesDescription':
-						value = value.replace(' ', '_').replace('/', '_')
-					record[col_name] = value
-				except AttributeError:
-					record[col_name] = None
-
-			# Institution-specific MRN/accession overrides
-			if self.institution_prefix in ('medstar', 'segmed', 'ukbiobank'):
-				if 'mrn' in record:
-					record['mrn'] = self.filename.split('-')[0]
-				if 'accession' in record:
-					record['accession'] = self.filename.split('-')[1][:-4]
-
-			return record
+			return self.make_record(self.read_tags(dcm_file, list(self.fields.values())), self.filename)
 
 		except Exception as ex:
 			print("DICOM corrupted! Skipping...")
 			print(ex)
 
 
-	def process_dicoms(self, filename):
+	@staticmethod
+	def read_member_header(tar, member):
 		'''
-		Extract a single .tgz archive and collect metadata from all series subfolders.
+		Return the leading bytes of a tar member that hold its DICOM header.
 
-		Extracts to TMP_DIR, globs all second-level subdirectories (series folders),
-		and returns a flat list of metadata records. Cleans up the extracted
-		directory after processing. Designed to be called via
-		multiprocessing.Pool.apply_async().
+		Reads HEADER_PREFIX_BYTES, and the whole member only when the Pixel Data tag
+		is not within that prefix.
+		'''
+		fileobj = tar.extractfile(member)
+		data = fileobj.read(HEADER_PREFIX_BYTES)
+		if len(data) < member.size and _PIXEL_DATA_TAG not in data:
+			data += fileobj.read()
+		return io.BytesIO(data)
+
+	def scan_archive(self, filename, tags, series_level):
+		'''
+		Stream a single .tgz archive and read raw header values from every series.
+
+		Iterates the tar members in archive order without extracting anything. The
+		first file member of every second-level directory (study/series/file) is the
+		series sample, and only its header bytes are parsed. With series_level False
+		reading stops at the first DICOM and the rest of the archive is never
+		decompressed.
+
+		Args:
+			filename:     Basename of the .tgz archive within root_dir.
+			tags:         DICOM keywords to read.
+			series_level: Read every series (True) or only the first (False).
+
+		Returns:
+			List of (series_dir, {keyword: value}) in archive order; series whose
+			sample DICOM cannot be parsed are skipped.
+		'''
+		series_values = []
+		seen_series = set()
+		with tarfile.open(os.path.join(self.root_dir, filename), 'r|*') as tar:
+			for member in tar:
+				parts = [p for p in member.name.split('/') if p not in ('', '.')]
+				if not member.isfile() or len(parts) != 3:
+					continue
+
+				series_dir = '/'.join(parts[:2])
+				if series_dir in seen_series:
+					continue
+				seen_series.add(series_dir)
+
+				try:
+					series_values.append((series_dir, self.read_tags(self.read_member_header(tar, member), tags)))
+				except Exception as ex:
+					print("DICOM corrupted! Skipping...")
+					print(ex)
+					continue
+
+				if not series_level:
+					break
+
+		print('Completed processing', filename)
+		return series_values
+
+	def process_dicoms(self, filename):
+		'''
+		Collect metadata records from all series subfolders of a single .tgz archive.
 
 		If SeriesDescription is among the requested tags, the user wants
-		series-level metadata, so dcm_reader() is called on every non-empty
-		series subfolder (one record per series). Otherwise the requested fields
-		(PatientID, Manufacturer, etc.) are constant across the whole study, so a
-		single sample DICOM from the first non-empty series is read.
+		series-level metadata, so one record per series subfolder is returned.
+		Otherwise the requested fields (PatientID, Manufacturer, etc.) are
+		constant across the whole study, so only the first DICOM is read (see
+		scan_archive). Designed to be called via multiprocessing.Pool.apply_async().
 
 		Args:
 			filename: Basename of the .tgz archive within root_dir.
 
 		Returns:
 			List of dicts, one per series subfolder, with keys matching self.fields.
-			Entries for corrupted DICOMs are None and filtered out by the caller.
 		'''
 		self.filename = filename
-		tar = tarfile.open(os.path.join(self.root_dir, self.filename))
-		tar_extract_path = os.path.join(TMP_DIR, self.filename[:-4])
-		tar.extractall(tar_extract_path)
-		tar.close()
+		series_level = 'SeriesDescription' in self.fields.values()
+		series_values = self.scan_archive(filename, list(self.fields.values()), series_level)
+		return [self.make_record(values, filename) for _, values in series_values]
 
-		# List series folders and iterate over them all one by one 
+	def scan_for_catalog(self, task):
+		'''
+		Pool task for catalog updates (Pool.imap_unordered): scan_archive() results
+		tagged with the archive name so the parent can store them as they arrive.
 
-		print("Extracted tarfile for", self.filename[:-4], "...")
+		Args:
+			task: (filename, tags, series_level) tuple.
 
-		dcm_directory = glob.glob(os.path.join(tar_extract_path, '*', '*'))
+		Returns:
+			(filename, series_values, error); error is None unless the archive could
+			not be read, so one bad archive does not stop the results iterator.
+		'''
+		filename, tags, series_level = task
+		try:
+			return filename, self.scan_archive(filename, tags, series_level), None
+		except Exception as ex:
+			return filename, None, ex
 
-		# SeriesDescription varies per series, so requesting it signals the user
-		# wants series-level metadata (one record per series subfolder). Without
-		# it the requested fields are constant across the study, so a single
-		# sample DICOM suffices and we stop after the first non-empty series.
-		series_level = 'SeriesDescription' in self.fields.values()
 
-		metadata_minilist = []
-		for dcm_subfolder in dcm_directory:
-			if len(glob.glob(os.path.join(glob.escape(dcm_subfolder), '*'))) > 0:
-				metadata_minilist.append(self.dcm_reader(dcm_subfolder))
-				if not series_level:
-					break
-			else:
-				print('Skipped empty dir series')
+	@staticmethod
+	def profile_columns():
+		'''
+		Ordered output columns of a --deep profile, mapped to their type
+		('text', 'int' or 'float', see columnar_io).
+		'''
+		columns = {'archive': 'text', 'series': 'text', 'n_files': 'int', 'n_frames': 'int', 'pixel_bytes': 'int'}
+		for tag, n_values in DEEP_NUMERIC_TAGS.items():
+			for name in ([tag] if n_values == 1 else [f'{tag}_{i}' for i in range(n_values)]):
+				columns.update({f'{name}_min': 'float', f'{name}_max': 'float', f'{name}_nunique': 'int'})
+		for tag in DEEP_TEXT_TAGS:
+			columns.update({f'{tag}_nunique': 'int', f'{tag}_values': 'text'})
+		return columns
+
+	@staticmethod
+	def profile_file(fileobj, size):
+		'''
+		Read the --deep profile tags from one DICOM header.
+
+		Args:
+			fileobj: Binary file-like object holding at least the DICOM header.
+			size:    Size of the full file in bytes.
+
+		Returns:
+			Dict with frames, pixel_bytes (size of the stored Pixel Data value, from
+			the header end to the end of the file), one float per numeric tag value
+			and one str per text tag.
+		'''
+		ds = read_dicom_header(fileobj, list(DEEP_NUMERIC_TAGS) + DEEP_TEXT_TAGS + ['NumberOfFrames'])
+		header_end = fileobj.tell()
+		row = {
+			'frames': int(ds.get('NumberOfFrames') or 1),
+			'pixel_bytes': max(0, size - header_end - (8 if ds.is_implicit_VR else 12)) if header_end < size else 0,
+		}
+
+		for tag, n_values in DEEP_NUMERIC_TAGS.items():
+			value = ds.get(tag)
+			values = list(value) if isinstance(value, MultiValue) else [value]
+			names = [tag] if n_values == 1 else [f'{tag}_{i}' for i in range(n_values)]
+			for i, name in enumerate(names):
+				try:
+					row[name] = float(values[i])
+				except (IndexError, TypeError, ValueError):
+					row[name] = float('nan')
+
+		for tag in DEEP_TEXT_TAGS:
+			value = getattr(ds, 'file_meta', {}).get(tag) if tag == 'TransferSyntaxUID' else ds.get(tag)
+			if isinstance(value, MultiValue):
+				value = '\\'.join(str(v) for v in value)
+			row[tag] = None if value is None else str(value)
+		return row
+
+	def profile_archive(self, filename):
+		'''
+		Header-only profile of every DICOM in an archive, aggregated per series.
+
+		Streams the archive like scan_archive() but reads the header of every file
+		member, then aggregates all files of a series with a single pandas groupby.
+		Pool task for Pool.imap_unordered; pandas is imported here so the plain
+		metadata workers never load it.
+
+		Args:
+			filename: Basename of the .tgz archive within root_dir.
+
+		Returns:
+			(filename, DataFrame with profile_columns() columns or None, error).
+		'''
+		import pandas as pd
 
-		# Clean up after to save space	
 		try:
-			rmtree(tar_extract_path, ignore_errors=True)
+			rows = []
+			with tarfile.open(os.path.join(self.root_dir, filename), 'r|*') as tar:
+				for member in tar:
+					parts = [p for p in member.name.split('/') if p not in ('', '.')]
+					if not member.isfile() or len(parts) != 3:
+						continue
+					try:
+						row = self.profile_file(self.read_member_header(tar, member), member.size)
+					except Exception as ex:
+						print(f'DICOM corrupted! Skipping {member.name}: {ex}')
+						continue
+					row['series'] = '/'.join(parts[:2])
+					rows.append(row)
 		except Exception as ex:
-			print('Failed to purge TMP_DIR')
-		
-		print('Completed processing', filename)
-		
-		return metadata_minilist
+			return filename, None, ex
+
+		columns = self.profile_columns()
+		if not rows:
+			return filename, pd.DataFrame(columns=list(columns)), None
+
+		df = pd.DataFrame(rows)
+		aggregations = {'n_files': ('series', 'size'), 'n_frames': ('frames', 'sum'), 'pixel_bytes': ('pixel_bytes', 'sum')}
+		for column, kind in columns.items():
+			if column in aggregations or column in ('archive', 'series'):
+				continue
+			name, stat = column.rsplit('_', 1)
+			if stat in ('min', 'max', 'nunique'):
+				aggregations[column] = (name, stat)
+			else:
+				aggregations[column] = (name, lambda v: '|'.join(sorted(v.dropna().unique())) or None)
+
+		profile = df.groupby('series', sort=False).agg(**aggregations).reset_index()
+		profile.insert(0, 'archive', filename)
+		print('Completed profiling', filename)
+		return filename, profile[list(columns)], None
+
+
+class Metadata_Catalog:
+	'''
+	Persistent SQLite catalog of DICOM header values per archive and series.
+
+	Archives are identified by path + size + mtime; a changed archive is dropped
+	and rescanned. Values are stored per DICOM keyword rather than per output
+	column, so renaming columns or adding -f fields reuses everything already
+	scanned. scanned_tags records which keywords were read for an archive and
+	whether every series was covered, so tags that are absent from the DICOMs are
+	not rescanned on every run.
+
+	Args:
+		db_path: Path of the SQLite file (created if missing).
+	'''
+	SCHEMA = '''
+		CREATE TABLE IF NOT EXISTS archives (
+			path     TEXT PRIMARY KEY,
+			size     INTEGER NOT NULL,
+			mtime_ns INTEGER NOT NULL,
+			scanned  TEXT NOT NULL
+		);
+		CREATE TABLE IF NOT EXISTS scanned_tags (
+			path       TEXT NOT NULL,
+			tag        TEXT NOT NULL,
+			all_series INTEGER NOT NULL,
+			PRIMARY KEY (path, tag)
+		);
+		CREATE TABLE IF NOT EXISTS records (
+			path    TEXT NOT NULL,
+			series  TEXT NOT NULL,
+			ordinal INTEGER NOT NULL,
+			tag     TEXT NOT NULL,
+			value   TEXT,
+			PRIMARY KEY (path, series, tag)
+		);
+	'''
+
+	def __init__(self, db_path):
+		self.db_path = db_path
+		self.conn = sqlite3.connect(db_path)
+		self.conn.executescript(self.SCHEMA)
+
+	@staticmethod
+	def identity(archive_path):
+		'''
+		(size, mtime_ns) of an archive, the key that decides whether it changed.
+		'''
+		stat = os.stat(archive_path)
+		return stat.st_size, stat.st_mtime_ns
+
+	def missing_tags(self, archive_path, tags, series_level):
+		'''
+		Keywords that still need to be read from an archive.
+
+		Returns every tag for new or changed archives; otherwise the tags never
+		scanned, plus tags only scanned on the first series when series-level
+		metadata is now requested.
+		'''
+		row = self.conn.execute('SELECT size, mtime_ns FROM archives WHERE path = ?', (archive_path,)).fetchone()
+		if row is None or tuple(row) != self.identity(archive_path):
+			return list(tags)
+
+		scanned = dict(self.conn.execute('SELECT tag, all_series FROM scanned_tags WHERE path = ?', (archive_path,)))
+		return [tag for tag in tags if tag not in scanned or (series_level and not scanned[tag])]
+
+	def to_scan(self, root_dir, filenames, tags, series_level, rescan=False):
+		'''
+		Plan a catalog update: the archives of root_dir that need scanning, with the
+		keywords each still needs (see missing_tags; every tag when rescan is set).
+
+		Returns:
+			Dict of filename → list of keywords to read.
+		'''
+		todo = {}
+		for f in filenames:
+			archive_path = os.path.join(root_dir, f)
+			missing = list(tags) if rescan else self.missing_tags(archive_path, tags, series_level)
+			if missing:
+				todo[f] = missing
+		return todo
+
+	def store(self, archive_path, tags, series_level, series_values):
+		'''
+		Record the values scan_archive() read for an archive in one transaction,
+		replacing the archive's previous rows when its identity changed.
+		'''
+		size, mtime_ns = self.identity(archive_path)
+		with self.conn:
+			row = self.conn.execute('SELECT size, mtime_ns FROM archives WHERE path = ?', (archive_path,)).fetchone()
+			if row is not None and tuple(row) != (size, mtime_ns):
+				for table in ('records', 'scanned_tags', 'archives'):
+					self.conn.execute(f'DELETE FROM {table} WHERE path = ?', (archive_path,))
+
+			self.conn.execute('INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?)',
+			                  (archive_path, size, mtime_ns, time.strftime('%Y-%m-%d %H:%M:%S')))
+			self.conn.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)',
+			                      [(archive_path, series, ordinal, tag, values.get(tag))
+			                       for ordinal, (series, values) in enumerate(series_values) for tag in tags])
+			self.conn.executemany('INSERT OR REPLACE INTO scanned_tags VALUES (?, ?, ?)',
+			                      [(archive_path, tag, int(series_level)) for tag in tags])
+
+	def series_values(self, archive_path, tags, series_level):
+		'''
+		Cached values for an archive, one {keyword: value} dict per series in
+		archive order (only the first series when series_level is False).
+		'''
+		placeholders = ','.join('?' * len(tags))
+		rows = self.conn.execute(
+			f'SELECT series, tag, value FROM records WHERE path = ? AND tag IN ({placeholders}) ORDER BY ordinal',
+			[archive_path] + list(tags))
+
+		series_values = {}
+		for series, tag, value in rows:
+			series_values.setdefault(series, {})[tag] = value
+		series_values = list(series_values.values())
+		return series_values if series_level else series_values[:1]
+
+	def close(self):
+		self.conn.close()
 
 
 
 if __name__ == '__main__':
 
+	import pandas as pd
+	from columnar_io import TableWriter, default_suffix, PARQUET_AVAILABLE
+
 	# Always extracted — institution-specific overrides depend on these being present.
 	FIXED_FIELDS = {
 		'mrn':       'PatientID',
@@ -211,6 +524,9 @@ if __name__ == '__main__':
 	parser.add_argument('-i', '--institution', metavar='', required=True, help='institution name')
 	parser.add_argument('-f', '--fields', metavar='', nargs='+', default=None,
 		help='Override metadata fields as column_name:DicomTag pairs, e.g. mrn:PatientID scanner:Manufacturer')
+	parser.add_argument('--rescan', action='store_true', default=False, help='Ignore the metadata catalog and rescan every archive')
+	parser.add_argument('--deep', action='store_true', default=False, help='Also profile the header of every DICOM, aggregated per series (parquet, or csv without pyarrow)')
+	parser.add_argument('--output_format', metavar='', choices=['csv', 'parquet'], default='csv', help='Format of the metadata table: csv (default) or parquet (needs pyarrow)')
 
 	args = vars(parser.parse_args())
 	print(args)
@@ -221,7 +537,12 @@ if __name__ == '__main__':
 	summarize        = args['summarize']
 	output_dir       = args['output_dir']
 	institution_prefix = args['institution']
+	rescan           = args['rescan']
+	deep             = args['deep']
+	output_format    = args['output_format']
 	os.makedirs(output_dir, exist_ok=True)
+	if output_format == 'parquet' and not PARQUET_AVAILABLE:
+		raise SystemExit('--output_format parquet requires the pyarrow package (pip install pyarrow)')
 
 	# -f appends to FIELDS (cannot override FIXED_FIELDS)
 	if args['fields'] is not None:
@@ -249,73 +570,142 @@ if __name__ == '__main__':
 	else:
 		filenames = os.listdir(root_dir)
 
-	async_results = []
 	start_time = time.time()
 	dicom_metadata_scanner = Dicom_Metadata_Scanner(root_dir, output_dir, institution_prefix, all_fields)
-	for f in filenames:
-		if f[-3:] == 'tgz':
-			if cpus > 1:
-				async_results.append(p.apply_async(dicom_metadata_scanner.process_dicoms, [f]))
-			else:
-				async_results.append(dicom_metadata_scanner.process_dicoms(f))
-		else:
+	filenames = [f for f in filenames if f[-3:] == 'tgz']
+
+	# SeriesDescription varies per series, so requesting it signals series-level
+	# metadata (one record per series); otherwise one sample DICOM per archive.
+	series_level = 'SeriesDescription' in all_fields.values()
+	tags = list(dict.fromkeys(all_fields.values()))
+
+	# Only new/changed archives, or archives missing some of the requested tags, are scanned
+	catalog = Metadata_Catalog(os.path.join(output_dir, f'{institution_prefix}_metadata_catalog.sqlite'))
+	todo = catalog.to_scan(root_dir, filenames, tags, series_level, rescan)
+	print(f'Catalog: {len(filenames) - len(todo)} archives up to date, scanning {len(todo)}')
+
+	# Results are stored in the catalog as each archive finishes; nothing is held until join
+	tasks = [(f, missing, series_level) for f, missing in todo.items()]
+	if cpus > 1:
+		results = p.imap_unordered(dicom_metadata_scanner.scan_for_catalog, tasks,
+		                           chunksize=max(1, min(16, len(tasks) // (cpus * 8))))
+	else:
+		results = map(dicom_metadata_scanner.scan_for_catalog, tasks)
+
+	print('------------------------------------')
+	print('Collecting results...')
+	for f, series_values, error in results:
+		if error is not None:
+			print(f'Failed to scan archive {f}: {error}')
 			continue
+		catalog.store(os.path.join(root_dir, f), todo[f], series_level, series_values)
+
+	# Per-series profile of every file header, written one chunk of archives at a time
+	if deep:
+		print('------------------------------------')
+		print('Profiling every DICOM header...')
+		profile_writer = TableWriter(os.path.join(output_dir, f'{institution_prefix}_series_profile{default_suffix()}'),
+		                             dicom_metadata_scanner.profile_columns())
+		if cpus > 1:
+			profiles = p.imap_unordered(dicom_metadata_scanner.profile_archive, filenames,
+			                            chunksize=max(1, min(16, len(filenames) // (cpus * 8))))
+		else:
+			profiles = map(dicom_metadata_scanner.profile_archive, filenames)
+
+		chunk, chunk_rows = [], 0
+		for f, profile, error in profiles:
+			if error is not None:
+				print(f'Failed to profile archive {f}: {error}')
+				continue
+			chunk.append(profile)
+			chunk_rows += len(profile)
+			if chunk_rows >= WRITE_CHUNK_ROWS:
+				profile_writer.write(pd.concat(chunk, ignore_index=True))
+				chunk, chunk_rows = [], 0
+		if chunk:
+			profile_writer.write(pd.concat(chunk, ignore_index=True))
+		profile_writer.close()
+		print(f'Wrote {profile_writer.rows} series profiles to {profile_writer.path}')
 
 	p.close()
 	p.join()
 
-	print('------------------------------------')
-	print('Collecting results...')
-	final_list = []
-	for i in async_results:
-		sublist = i.get()
-		for item in sublist:
-			if item is not None:
-				final_list.append(item)
-
-	# Column names are derived directly from all_fields keys
-	metadata_df = pd.DataFrame(final_list)
 	# Series-level intent (SeriesDescription requested) means every series row
 	# is meaningful, so write them all. Otherwise the fields are constant within
-	# MRN, so collapse to one row per MRN.
-	series_level = 'SeriesDescription' in all_fields.values()
+	# MRN, so collapse to one row per MRN. Rows are written in chunks straight
+	# from the catalog and the summaries are kept as running counts.
+	summarize_cols = [c for c in ('accession', 'field_strength', 'scanner') if c in all_fields]
+	if 'mrn' in all_fields and summarize_cols:
+		summarize_cols = ['parent_folder'] + summarize_cols
+	series_freq = Counter()
+	summary_counts = {col: Counter() for col in ('scanner', 'field_strength') if col in all_fields}
+	seen_mrns, seen_accessions = set(), set()
+	n_rows, n_written = 0, 0
+
+	writer = TableWriter(os.path.join(output_dir, f'{institution_prefix}_metadata.{output_format}'),
+	                     {col: 'text' for col in all_fields})
+	summary_file, summary_writer = None, None
+	if summarize and summarize_cols:
+		summary_file = open(f'{institution_prefix}_meta_df_summarized.csv', 'w', newline='')
+		summary_writer = csv.DictWriter(summary_file, fieldnames=summarize_cols + ['institution'])
+		summary_writer.writeheader()
+
+	rows, summary_rows = [], []
+	for f in filenames:
+		for tag_values in catalog.series_values(os.path.join(root_dir, f), tags, series_level):
+			record = dicom_metadata_scanner.make_record(tag_values, f)
+			n_rows += 1
+			# Missing values are skipped, as value_counts() dropped NaN
+			if record.get('series_description') is not None:
+				series_freq[record['series_description']] += 1
+
+			if series_level or record['mrn'] not in seen_mrns:
+				seen_mrns.add(record['mrn'])
+				rows.append(record)
+
+			if record.get('accession') not in seen_accessions:
+				seen_accessions.add(record.get('accession'))
+				for col, counts in summary_counts.items():
+					if record[col] is not None:
+						counts[record[col]] += 1
+				if summary_writer is not None:
+					row = {'parent_folder': record.get('mrn'), **record, 'institution': institution_prefix}
+					summary_rows.append({col: row.get(col) for col in summary_writer.fieldnames})
+
+		if len(rows) >= WRITE_CHUNK_ROWS:
+			writer.write(pd.DataFrame(rows, columns=list(all_fields)))
+			n_written += len(rows)
+			rows = []
+		if len(summary_rows) >= WRITE_CHUNK_ROWS:
+			summary_writer.writerows(summary_rows)
+			summary_rows = []
+
+	writer.write(pd.DataFrame(rows, columns=list(all_fields)))
+	n_written += len(rows)
+	writer.close()
+	if summary_writer is not None:
+		summary_writer.writerows(summary_rows)
+		summary_file.close()
+	catalog.close()
+
 	if series_level:
-		print(f'{len(metadata_df)} series rows across {metadata_df["mrn"].nunique()} unique MRNs')
-		print(metadata_df)
-		metadata_df.to_csv(os.path.join(output_dir,f'{institution_prefix}_metadata.csv'), index=False)
+		print(f'{n_written} series rows across {len(seen_mrns)} unique MRNs')
 	else:
-		mrn_df = metadata_df.drop_duplicates(subset=['mrn'])
-		print(f'Grouped to {len(mrn_df)} unique MRNs (from {len(metadata_df)} rows)')
-		print(mrn_df)
-		mrn_df.to_csv(os.path.join(output_dir,f'{institution_prefix}_metadata.csv'), index=False)
+		print(f'Grouped to {n_written} unique MRNs (from {n_rows} rows)')
 
 	if summarize:
-		if 'series_description' in metadata_df.columns:
-			freq = metadata_df['series_description'].value_counts().reset_index()
-			freq.columns = ['series_description', 'frequency']
+		if series_freq:
+			freq = pd.DataFrame(series_freq.most_common(), columns=['series_description', 'frequency'])
 			print(freq)
 			freq.to_csv(f'{institution_prefix}_metadata_freq.csv', index=False)
 
-		summarize_cols = ['accession', 'field_strength', 'scanner']
-		available = [c for c in summarize_cols if c in metadata_df.columns]
-		if available:
-			meta_df = metadata_df.drop_duplicates('accession') if 'accession' in metadata_df.columns else metadata_df
-			if 'mrn' in meta_df.columns:
-				meta_df = meta_df.copy()
-				meta_df['parent_folder'] = meta_df['mrn']
-				available = ['parent_folder'] + available
-			meta_df['institution'] = institution_prefix
-			meta_df = meta_df[available + ['institution']]
-			meta_df.to_csv(f'{institution_prefix}_meta_df_summarized.csv', index=False)
-
-			for col in ('scanner', 'field_strength'):
-				if col in meta_df.columns:
-					print('------------------------------------')
-					print(meta_df[col].value_counts(dropna=False))
+		for col, counts in summary_counts.items():
+			print('------------------------------------')
+			print(pd.Series(counts, name='count').rename_axis(col).sort_values(ascending=False))
 
 	print()
-	print('Saved metadata from', len(async_results), 'files (Accession numbers)')
-	print('Total number of views:', len(final_list))
+	print('Saved metadata from', len(filenames), 'files (Accession numbers)', f'({len(todo)} scanned this run)')
+	print('Total number of views:', n_rows)
 	print('Elapsed time:', round((time.time() - start_time), 2))
 	print('------------------------------------')
 
@@ -0,0 +1,435 @@
+'''
+fingerprint_db.py — append-only binary fingerprint database for detect_duplicates.py
+
+A DB is a directory:
+    header.json    format version, code width and the committed size of every file
+    codes.bin      uint64 [N, words] fingerprint codes (little endian), memory-mapped
+    rows.bin       one ROW_DTYPE record per code: interned file / series / frame_pos ids
+                   and the series frame count, memory-mapped
+    files.jsonl    interned files, one JSON [source, relpath, mrn, accession] per line
+    series.jsonl   interned series names, one JSON string per line
+    positions.jsonl  interned frame positions (first / middle / last)
+
+Opening a DB reads the header and the string tables only; codes and row records
+are memory-mapped, so referencing a large history does not parse or copy it.
+
+Appends only ever add bytes at the end of each file and then atomically replace
+header.json. Readers trust the sizes in the header, so an interrupted append is
+invisible and its partial tail is truncated by the next append.
+
+BandIndex persists the multi-index hash (per-band bucket keys) of the DB codes in
+index_<n>bands/ inside the DB, so a new batch is matched against the history by
+binary search instead of re-bucketing every stored code. The index is a list of
+segments, each covering a contiguous range of DB rows and holding, per band, the
+sorted band keys and the DB row of each key (the posting lists). Indexing new rows
+writes one new segment; adjacent segments are merged when the older one is at
+most twice the size of the newer, so there are O(log N) segments and each row is
+rewritten O(log N) times overall.
+'''
+
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+DB_VERSION = 1
+HEADER = 'header.json'
+CODES = 'codes.bin'
+ROWS = 'rows.bin'
+TABLES = {'files': 'files.jsonl', 'series': 'series.jsonl', 'positions': 'positions.jsonl'}
+ROW_DTYPE = np.dtype([('file', '<u4'), ('series', '<u4'), ('frame_pos', '<u2'), ('n_frames', '<u4')])
+FILE_COLS = ['source', 'relpath', 'mrn', 'accession']
+META_COLS = FILE_COLS + ['series', 'frame_pos', 'n_frames']
+INDEX_HEADER = 'index.json'
+KEY_BLOCK = 1 << 20            # codes converted to band keys per block when indexing
+_KEY_MIX = np.uint64(0x9E3779B97F4A7C15)   # odd multiplier folding bands wider than 8 bytes into one uint64 key
+
+
+def code_bytes(codes):
+	'''
+	uint8 [N, 8 * words] byte view of uint64 [N, words] codes (the fingerprint bytes,
+	most significant first).
+	'''
+	codes = np.asarray(codes)
+	return codes.astype('>u8').view(np.uint8).reshape(len(codes), 8 * codes.shape[-1])
+
+
+def band_bounds(n_bytes, n_bands):
+	'''
+	Byte offsets splitting an n_bytes fingerprint into n_bands contiguous bands.
+	'''
+	return [round(k * n_bytes / n_bands) for k in range(n_bands + 1)]
+
+
+def band_keys(fp8, s, e):
+	'''
+	One uint64 key per fingerprint for the byte band [s, e). Bands of up to 8 bytes
+	are packed exactly; wider bands (few bands, i.e. strict thresholds) are folded
+	8 bytes at a time. Folding can only merge buckets, never split them, so it adds
+	candidates that the exact Hamming check rejects but never loses a true pair.
+	'''
+	band = fp8[:, s:e]
+	pad = -(e - s) % 8
+	if pad:
+		band = np.concatenate([np.zeros((len(band), pad), dtype=np.uint8), band], axis=1)
+	words = np.ascontiguousarray(band).view('>u8').astype(np.uint64)
+	keys = words[:, 0].copy()
+	for c in range(1, words.shape[1]):
+		keys = keys * _KEY_MIX ^ words[:, c]
+	return keys
+
+
+def is_fingerprint_db(path):
+	'''
+	True when path is a fingerprint DB directory.
+	'''
+	return os.path.isfile(os.path.join(path, HEADER))
+
+
+class FingerprintDB:
+	'''
+	Append-only fingerprint database (see module docstring for the layout).
+
+	Args:
+		path:  DB directory; created (with an empty DB) when it does not exist.
+		words: Code width in uint64 words. An existing DB with a different width
+		       raises ValueError, as its fingerprints cannot be compared.
+	'''
+	def __init__(self, path, words):
+		self.path = path
+		if not is_fingerprint_db(path):
+			os.makedirs(path, exist_ok=True)
+			for name in [CODES, ROWS] + list(TABLES.values()):
+				open(os.path.join(path, name), 'ab').close()
+			self.header = {'version': DB_VERSION, 'words': words, 'rows': 0,
+			               'sizes': {name: 0 for name in [CODES, ROWS] + list(TABLES.values())}}
+			self._commit()
+
+		with open(os.path.join(path, HEADER)) as f:
+			self.header = json.load(f)
+		if self.header['version'] != DB_VERSION:
+			raise ValueError(f'{path}: unsupported fingerprint DB version {self.header["version"]}')
+		if self.header['words'] != words:
+			raise ValueError(f'{path}: fingerprints are {self.header["words"] * 64} bits wide, this build uses '
+			                 f'{words * 64}; DBs built with a different GRID must be regenerated from the source HDF5')
+		self.words = words
+
+		self.tables = {table: self._read_lines(name) for table, name in TABLES.items()}
+		self.tables['files'] = [tuple(f) for f in self.tables['files']]
+		self.ids = {table: {value: i for i, value in enumerate(values)} for table, values in self.tables.items()}
+		self.file_keys = {f[:2] for f in self.tables['files']}    # (source, relpath) of every stored file
+		self._maps = {}
+
+	def __len__(self):
+		return self.header['rows']
+
+	def _read_lines(self, name):
+		with open(os.path.join(self.path, name), 'rb') as f:
+			data = f.read(self.header['sizes'][name])
+		return [json.loads(line) for line in data.splitlines()]
+
+	def _map(self, name, dtype, shape):
+		'''
+		Read-only memory map of the committed part of a binary file (cached until the next append).
+		'''
+		if name not in self._maps:
+			if len(self) == 0:
+				self._maps[name] = np.zeros(shape, dtype=dtype)
+			else:
+				self._maps[name] = np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=shape)
+		return self._maps[name]
+
+	@property
+	def codes(self):
+		'''uint64 [N, words] fingerprint codes (memory-mapped).'''
+		return self._map(CODES, np.dtype('<u8'), (len(self), self.words))
+
+	@property
+	def rows(self):
+		'''ROW_DTYPE [N] row records (memory-mapped).'''
+		return self._map(ROWS, ROW_DTYPE, (len(self),))
+
+	def has_file(self, source, relpath):
+		return (source, relpath) in self.file_keys
+
+	def frame(self, rows=None):
+		'''
+		Metadata of the given rows (default: all) as a DataFrame with META_COLS,
+		strings resolved from the interned tables.
+		'''
+		records = self.rows if rows is None else self.rows[rows]
+		files = np.empty((len(self.tables['files']), len(FILE_COLS)), dtype=object)
+		if len(files):
+			files[:] = self.tables['files']
+		series = np.array(self.tables['series'], dtype=object)
+		positions = np.array(self.tables['positions'], dtype=object)
+
+		file_ids = np.asarray(records['file'], dtype=np.int64)
+		df = pd.DataFrame({col: files[file_ids, k] for k, col in enumerate(FILE_COLS)})
+		df['series'] = series[np.asarray(records['series'], dtype=np.int64)]
+		df['frame_pos'] = positions[np.asarray(records['frame_pos'], dtype=np.int64)]
+		df['n_frames'] = np.asarray(records['n_frames'], dtype=np.int64)
+		return df
+
+	def _intern(self, table, values):
+		'''
+		Ids of values in an interned table, adding new ones. Returns (ids, new_lines).
+		'''
+		lookup, known = self.ids[table], self.tables[table]
+		ids = np.empty(len(values), dtype=np.int64)
+		lines = []
+		for k, value in enumerate(values):
+			i = lookup.get(value)
+			if i is None:
+				i = lookup[value] = len(known)
+				known.append(value)
+				lines.append(json.dumps(list(value) if isinstance(value, tuple) else value) + '\n')
+			ids[k] = i
+		return ids, ''.join(lines).encode()
+
+	def append(self, meta, codes):
+		'''
+		Append fingerprints of files not yet in the DB.
+
+		Args:
+			meta:  DataFrame with at least META_COLS, one row per code.
+			codes: uint64 [len(meta), words] codes.
+
+		Returns:
+			Number of rows appended; rows of files already in the DB are skipped, so
+			re-appending a batch is a no-op.
+		'''
+		codes = np.asarray(codes, dtype=np.uint64).reshape(-1, self.words)
+		file_keys = list(zip(meta['source'].tolist(), meta['relpath'].tolist()))
+		new = np.array([key not in self.file_keys for key in file_keys], dtype=bool)
+		if not new.any():
+			return 0
+		meta = meta[new]
+		codes = codes[new]
+
+		files = list(zip(*(meta[col].astype(str).tolist() for col in FILE_COLS)))
+		records = np.empty(len(meta), dtype=ROW_DTYPE)
+		file_ids, file_lines = self._intern('files', files)
+		series_ids, series_lines = self._intern('series', meta['series'].astype(str).tolist())
+		pos_ids, pos_lines = self._intern('positions', meta['frame_pos'].astype(str).tolist())
+		records['file'] = file_ids
+		records['series'] = series_ids
+		records['frame_pos'] = pos_ids
+		records['n_frames'] = meta['n_frames'].astype(np.int64).to_numpy()
+		self.file_keys.update(f[:2] for f in files)
+
+		self._maps = {}                              # maps must not outlive the file sizes they were made for
+		self._append_bytes(CODES, codes.astype('<u8').tobytes())
+		self._append_bytes(ROWS, records.tobytes())
+		self._append_bytes(TABLES['files'], file_lines)
+		self._append_bytes(TABLES['series'], series_lines)
+		self._append_bytes(TABLES['positions'], pos_lines)
+		self.header['rows'] += len(meta)
+		self._commit()
+		return len(meta)
+
+	def _append_bytes(self, name, data):
+		with open(os.path.join(self.path, name), 'ab') as f:
+			f.truncate(self.header['sizes'][name])   # drop the tail of an interrupted append
+			f.write(data)
+			f.flush()
+			os.fsync(f.fileno())
+		self.header['sizes'][name] += len(data)
+
+	def _commit(self):
+		tmp = os.path.join(self.path, HEADER + '.tmp')
+		with open(tmp, 'w') as f:
+			json.dump(self.header, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, os.path.join(self.path, HEADER))
+
+
+class BandIndex:
+	'''
+	Persisted multi-index hash over the codes of a FingerprintDB for one band count
+	(see module docstring). Each band count (i.e. --threshold) has its own index,
+	built on first use.
+
+	Args:
+		db:      FingerprintDB to index.
+		n_bands: Number of fingerprint bands.
+	'''
+	def __init__(self, db, n_bands):
+		self.db = db
+		self.n_bands = n_bands
+		self.bounds = band_bounds(db.words * 8, n_bands)
+		self.path = os.path.join(db.path, f'index_{n_bands}bands')
+		os.makedirs(self.path, exist_ok=True)
+		header = os.path.join(self.path, INDEX_HEADER)
+		if os.path.isfile(header):
+			with open(header) as f:
+				self.header = json.load(f)
+		else:
+			self.header = {'n_bands': n_bands, 'segments': []}
+
+	def __len__(self):
+		'''Number of DB rows indexed.'''
+		segments = self.header['segments']
+		return segments[-1][1] if segments else 0
+
+	def _files(self, start, stop):
+		base = os.path.join(self.path, f'seg_{start}_{stop}')
+		return base + '.keys', base + '.rows'
+
+	def _segment(self, start, stop, mode='r'):
+		'''
+		(keys uint64 [n_bands, n], rows uint32 [n_bands, n]) memory maps of a segment.
+		'''
+		keys_path, rows_path = self._files(start, stop)
+		shape = (self.n_bands, stop - start)
+		return (np.memmap(keys_path, dtype='<u8', mode=mode, shape=shape),
+		        np.memmap(rows_path, dtype='<u4', mode=mode, shape=shape))
+
+	def band_keys(self, codes, k):
+		'''
+		Keys of band k for uint64 [N, words] codes, KEY_BLOCK codes at a time.
+		'''
+		s, e = self.bounds[k], self.bounds[k + 1]
+		keys = np.zeros(len(codes), dtype=np.uint64)
+		if s < e:
+			for c in range(0, len(codes), KEY_BLOCK):
+				keys[c:c + KEY_BLOCK] = band_keys(code_bytes(codes[c:c + KEY_BLOCK]), s, e)
+		return keys
+
+	def update(self):
+		'''
+		Index the DB rows appended since the last update (all rows on first use).
+
+		Returns:
+			Number of rows indexed.
+		'''
+		start, stop = len(self), len(self.db)
+		if stop <= start:
+			return 0
+		codes = self.db.codes[start:stop]
+		keys, rows = self._segment(start, stop, mode='w+')
+		for k in range(self.n_bands):
+			band = self.band_keys(codes, k)
+			order = np.argsort(band, kind='stable')
+			keys[k] = band[order]
+			rows[k] = order + start
+		keys.flush()
+		rows.flush()
+		del keys, rows
+
+		segments = self.header['segments']
+		segments.append([start, stop])
+		while len(segments) >= 2 and segments[-2][1] - segments[-2][0] <= 2 * (segments[-1][1] - segments[-1][0]):
+			segments[-2:] = [self._merge(segments[-2], segments[-1])]
+		self._commit()
+		return stop - start
+
+	def _merge(self, a, b):
+		'''
+		Merge two adjacent segments into one covering [a.start, b.stop).
+		'''
+		keys_a, rows_a = self._segment(*a)
+		keys_b, rows_b = self._segment(*b)
+		keys, rows = self._segment(a[0], b[1], mode='w+')
+		for k in range(self.n_bands):
+			band = np.concatenate([keys_a[k], keys_b[k]])
+			order = np.argsort(band, kind='stable')     # a's rows precede b's, so ties stay in row order
+			keys[k] = band[order]
+			rows[k] = np.concatenate([rows_a[k], rows_b[k]])[order]
+		keys.flush()
+		rows.flush()
+		return [a[0], b[1]]
+
+	def _commit(self):
+		tmp = os.path.join(self.path, INDEX_HEADER + '.tmp')
+		with open(tmp, 'w') as f:
+			json.dump(self.header, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, os.path.join(self.path, INDEX_HEADER))
+		# segment files replaced by a merge (or left by an interrupted update)
+		live = {os.path.basename(p) for seg in self.header['segments'] for p in self._files(*seg)}
+		for name in os.listdir(self.path):
+			if name.startswith('seg_') and name not in live:
+				os.remove(os.path.join(self.path, name))
+
+	def query(self, fp8, max_bucket, stats=None, skip_file_ids=None, chunk_size=1 << 22):
+		'''
+		Candidate pairs between new fingerprints and the indexed DB rows: a pair is a
+		(new code, DB row) sharing the key of at least one band. Cost grows with the
+		number of new codes and candidates, not with the size of the DB.
+
+		As in detect_duplicates.candidate_pairs, a pair is only emitted for the first
+		band it collides in, and a band bucket holding more than max_bucket DB rows is
+		skipped and logged.
+
+		Args:
+			fp8:           uint8 [Q, 8 * words] new fingerprints.
+			max_bucket:    Largest DB bucket searched.
+			stats:         Optional dict; 'candidates' and 'skipped_buckets' are added to.
+			skip_file_ids: DB file ids whose rows are never returned (e.g. files being rescanned).
+			chunk_size:    Approximate number of pairs per yielded chunk.
+
+		Yields:
+			(I, R) int64 arrays: indices into fp8 and DB row ids.
+		'''
+		stats = stats if stats is not None else {}
+		stats.setdefault('candidates', 0)
+		stats.setdefault('skipped_buckets', 0)
+		segments = [self._segment(*seg) for seg in self.header['segments']]
+		Q = len(fp8)
+		qkeys = np.zeros((self.n_bands, Q), dtype=np.uint64)
+		qskipped = np.zeros((self.n_bands, Q), dtype=bool)
+		if not Q or not segments:
+			return
+		skip_file_ids = np.asarray(skip_file_ids if skip_file_ids is not None else [], dtype=np.int64)
+
+		for k in range(self.n_bands):
+			s, e = self.bounds[k], self.bounds[k + 1]
+			if s == e:
+				continue
+			qk = qkeys[k] = band_keys(fp8, s, e)
+			spans = [(np.searchsorted(keys[k], qk, 'left'), np.searchsorted(keys[k], qk, 'right'))
+			         for keys, _ in segments]
+			sizes = sum(hi - lo for lo, hi in spans)
+
+			over = sizes > max_bucket
+			if over.any():
+				_, first = np.unique(qk[over], return_index=True)
+				for m in sizes[over][first].tolist():
+					stats['skipped_buckets'] += 1
+					print(f'WARN: DB band bucket of {m} codes exceeds --max-bucket={max_bucket}; '
+					      f'skipping (likely a large genuine duplicate set — review manually)')
+			qskipped[k] = over
+			usable = ~over
+
+			for (lo, hi), (_, seg_rows) in zip(spans, segments):
+				qi = np.flatnonzero(usable & (hi > lo))
+				if not len(qi):
+					continue
+				counts = (hi - lo)[qi]
+				cum = np.cumsum(counts)
+				edges = np.unique(np.r_[0, np.searchsorted(cum, np.arange(chunk_size, cum[-1], chunk_size)), len(qi)])
+				for a, b in zip(edges[:-1].tolist(), edges[1:].tolist()):
+					c = counts[a:b]
+					I = np.repeat(qi[a:b], c)
+					pos = np.repeat(lo[qi[a:b]] - (np.cumsum(c) - c), c) + np.arange(int(c.sum()))
+					R = np.asarray(seg_rows[k][pos], dtype=np.int64)
+
+					keep = np.ones(len(I), dtype=bool)
+					if len(skip_file_ids):
+						keep &= ~np.isin(self.db.rows['file'][R], skip_file_ids)
+					if k:
+						Ik, db_fp8 = I[keep], code_bytes(self.db.codes[R[keep]])
+						first = np.ones(len(Ik), dtype=bool)
+						for p in range(k):
+							ps, pe = self.bounds[p], self.bounds[p + 1]
+							if ps < pe:
+								first &= (qkeys[p][Ik] != band_keys(db_fp8, ps, pe)) | qskipped[p][Ik]
+						keep[keep] = first
+					I, R = I[keep], R[keep]
+					if len(I):
+						stats['candidates'] += len(I)
+						yield I, R
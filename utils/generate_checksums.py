@@ -1,5 +1,8 @@
 '''
 Generate sha256 checksums for pre-processed hdf5 files 
+
+Manifests are written as CSV (hex digests) or, for a .parquet output path, as
+Parquet with 32-byte binary digests (see columnar_io.py); comparison accepts either.
 '''
 
 import os
@@ -9,6 +12,9 @@ import h5py
 import argparse as ap
 import multiprocessing
 import time
+from columnar_io import read_table, write_table
+
+CHECKSUM_SCHEMA = {'file': 'text', 'checksum': 'binary:32'}
 
 def compute_checksum(hdf5_file):
 	'''
@@ -24,10 +30,9 @@ def compute_checksum(hdf5_file):
 			data = f[dset_name][:]
 			sha256_hash.update(data.tobytes())  # Convert to bytes and hash
 
-		checksum = sha256_hash.hexdigest()
-		print(f'{os.path.basename(hdf5_file)}: {checksum}')
+		print(f'{os.path.basename(hdf5_file)}: {sha256_hash.hexdigest()}')
 
-	return os.path.basename(hdf5_file), checksum
+	return os.path.basename(hdf5_file), sha256_hash.digest()
 
 
 def compare_checksums(new_csv, comparison_checksum_file):
@@ -38,8 +43,8 @@ def compare_checksums(new_csv, comparison_checksum_file):
 	print(f'Comparing checksums...')
 	print('------------------------------------')
 
-	df1 = pd.read_csv(new_csv)
-	df2 = pd.read_csv(comparison_checksum_file)
+	df1 = read_table(new_csv, CHECKSUM_SCHEMA)
+	df2 = read_table(comparison_checksum_file, CHECKSUM_SCHEMA)
 
 	merged_df = df1.merge(df2, on="file", suffixes=('_original', '_new'))
 	mismatches = merged_df[merged_df["checksum_original"] != merged_df["checksum_new"]]
@@ -48,7 +53,8 @@ def compare_checksums(new_csv, comparison_checksum_file):
 	if not mismatches.empty:
 		print("Mismatched files found:")
 		print('------------------------------------')
-		print(mismatches)
+		print(mismatches.assign(checksum_original=[c.hex() for c in mismatches['checksum_original']],
+		                        checksum_new=[c.hex() for c in mismatches['checksum_new']]))
 		print('------------------------------------')
 		raise ValueError("Checksum mismatches present. Terminating push")
 	else:
@@ -60,9 +66,9 @@ def compare_checksums(new_csv, comparison_checksum_file):
 if __name__ == "__main__":
 
 	parser = ap.ArgumentParser(description="Generate checksums for HDF5 files in a directory.")
-	parser.add_argument('-f', '--comparison_checksum_file', required=False, help='csv file that has comparison checksums')
+	parser.add_argument('-f', '--comparison_checksum_file', required=False, help='csv (or .parquet) file that has comparison checksums')
 	parser.add_argument('-i', '--input_directory', required=True, help='Directory containing HDF5 files')
-	parser.add_argument('-o', '--output_csv', required=True, help='Output CSV file to save checksums')
+	parser.add_argument('-o', '--output_csv', required=True, help='Output CSV file to save checksums (.parquet for a binary Parquet manifest)')
 	parser.add_argument('-c', '--cpus', required=True, default=12, type=int, help="Number of CPUs")
 	args = parser.parse_args()
 
@@ -94,12 +100,12 @@ if __name__ == "__main__":
 
 	final_list = []
 	for i in async_results:
-		sublist = i.get()
+		sublist = i.get() if cpus > 1 else i
 		final_list.append(sublist)
 
 	df = pd.DataFrame(final_list, columns=['file', 'checksum'])
-	print(df)
-	df.to_csv(args.output_csv, index=False)
+	print(df.assign(checksum=[c.hex() for c in df['checksum']]))
+	write_table(df, args.output_csv, CHECKSUM_SCHEMA)
 
 	print('------------------------------------')
 	print(f'Checksums saved to {args.output_csv}')
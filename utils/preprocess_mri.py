@@ -22,6 +22,9 @@ Usage:
 '''
 
 import os
+import json
+import hashlib
+import functools
 import numpy as np
 import pydicom as dcm
 import multiprocessing
@@ -39,7 +42,7 @@ import torch
 from torchvision.transforms import v2
 import matplotlib.pyplot as plt
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 from natsort import natsorted, natsort_keygen
 import bcolors
 import pylibjpeg
@@ -49,6 +52,8 @@ from slack_bolt.adapter.socket_mode import SocketModeHandler
 from dotenv import load_dotenv
 from google.cloud import storage
 from gcputils import wait_if_disk_full, GCP_Upload_Manager, mount_gcs_bucket, unmount_gcs_bucket
+import dcmutils
+from dcmutils import read_dicom_header, frame_count, multiframe_to_arrays, MAX_FRAMES
 
 # Read and parse local_config.yaml and .env
 load_dotenv()
@@ -57,6 +62,16 @@ _cfg        = get_cfg()
 TMP_DIR     = _cfg.tmp_dir
 BUCKET_NAME = get_global_cfg().bucket_name
 
+# Root-level HDF5 attributes used to stamp each output with the run that produced it
+STAMP_ATTR  = 'pipeline_fingerprint'
+PARAMS_ATTR = 'pipeline_params'
+SOURCE_ATTR = 'source_archive'
+# JSON {archive: fingerprint} of every archive whose series went into the file
+ARCHIVES_ATTR = 'archive_fingerprints'
+
+
+# Frames per chunk for the streaming greyscale normalizer
+NORMALIZE_CHUNK = 64
 
 ### Global Functions ###
 
@@ -70,6 +85,245 @@ def framesize_arg(value):
 		return 'original'
 	return int(value)
 
+@functools.lru_cache(maxsize=None)
+def code_version():
+	'''
+	SHA256 of the source of this module and dcmutils.py (which decodes the multiframe
+	pixel data), used as the code version in pipeline fingerprints. Any edit to the
+	preprocessing code invalidates previously stamped outputs, which errs on the side
+	of reprocessing rather than silently keeping stale arrays. Read once per process,
+	so every archive of a run is stamped with the same version.
+	'''
+	digest = hashlib.sha256()
+	for module_path in (__file__, dcmutils.__file__):
+		with open(os.path.abspath(module_path), 'rb') as f:
+			digest.update(f.read())
+	return digest.hexdigest()
+
+def pipeline_fingerprint(params):
+	'''
+	Hash a dict of output-determining pipeline parameters into a short stable stamp.
+	'''
+	payload = json.dumps(params, sort_keys=True, default=str).encode()
+	return hashlib.sha256(payload).hexdigest()[:16]
+
+def stamp_h5(h5_path, params, source_archive, created=True):
+	'''
+	Record that source_archive finished writing into an HDF5 file with this pipeline.
+
+	The archive is added to the file's archive_fingerprints map, so an archive that only
+	appended series to an existing file is stamped too. The archive that created the
+	file also writes the pipeline fingerprint, the parameters it was derived from and
+	its name as root attributes.
+	'''
+	fingerprint = pipeline_fingerprint(params)
+	with h5py.File(h5_path, 'a') as h5f:
+		archives = json.loads(h5f.attrs.get(ARCHIVES_ATTR, '{}'))
+		archives[source_archive] = fingerprint
+		h5f.attrs[ARCHIVES_ATTR] = json.dumps(archives, sort_keys=True)
+		if created:
+			h5f.attrs[STAMP_ATTR] = fingerprint
+			h5f.attrs[PARAMS_ATTR] = json.dumps(params, sort_keys=True, default=str)
+			h5f.attrs[SOURCE_ATTR] = source_archive
+
+def plan_incremental(filenames, output_dir, institution_prefix, fingerprint):
+	'''
+	Compare the stamps on existing HDF5 outputs against the requested fingerprint and
+	decide which archives need (re)processing.
+
+	Outputs are attributed to every archive recorded in their archive_fingerprints map,
+	or to the source_archive stamp for files from before that map. Unstamped outputs
+	(older runs, or a worker that died mid-archive) fall back to the mrn-accession.tgz
+	naming convention used by debug mode and are treated as stale.
+
+	A stale file is removed as a whole, so every requested archive that wrote into it
+	is reprocessed with it; archives outside this run that lose series that way are
+	reported.
+
+	Args:
+		filenames:          Iterable of .tgz basenames requested for this run.
+		output_dir:         HDF5 output root.
+		institution_prefix: Prefix of the patient folders to inspect.
+		fingerprint:        Stamp the outputs are expected to carry.
+
+	Returns:
+		Tuple of (todo, up_to_date, stale_outputs): archives to process, archives whose
+		outputs are current, and existing HDF5 paths that must be removed before reprocessing.
+	'''
+	outputs = defaultdict(list)
+	for h5_path in glob.glob(os.path.join(glob.escape(output_dir), f'{institution_prefix}_*', '*.h5')):
+		mrn = os.path.basename(os.path.dirname(h5_path))[len(institution_prefix) + 1:]
+		stamps = {f'{mrn}-{os.path.basename(h5_path)[:-3]}.tgz': None}
+		try:
+			with h5py.File(h5_path, 'r') as h5f:
+				if ARCHIVES_ATTR in h5f.attrs:
+					stamps = json.loads(h5f.attrs[ARCHIVES_ATTR])
+				elif SOURCE_ATTR in h5f.attrs:
+					stamps = {str(h5f.attrs[SOURCE_ATTR]): h5f.attrs.get(STAMP_ATTR)}
+		except Exception as ex:
+			print(f'WARN: could not read stamp from {h5_path}: {ex}')
+		for source, stamp in stamps.items():
+			outputs[source].append((h5_path, stamp))
+
+	requested = set(filenames)
+	todo = {f for f in filenames if not outputs.get(f) or any(stamp != fingerprint for _, stamp in outputs[f])}
+	while True:
+		stale_outputs = {path for f in todo for path, _ in outputs.get(f, [])}
+		contributors = {source for source, existing in outputs.items()
+		                if any(path in stale_outputs for path, _ in existing)}
+		if contributors & requested <= todo:
+			break
+		todo |= contributors & requested
+
+	for source in sorted(contributors - requested):
+		print(f'WARN: {source} is not in this run but shares a stale hdf5 file that will be rebuilt without its series')
+
+	return ([f for f in filenames if f in todo], [f for f in filenames if f not in todo],
+	        sorted(stale_outputs))
+
+# Per-process state for pool workers, populated once by init_worker()
+_worker_state = {}
+
+def init_worker(root_dir, output_dir, framesize, institution_prefix, channels, compression, queue=None, grey_window=None):
+	'''
+	multiprocessing.Pool initializer: build the CMRI_PreProcessor (and with it the
+	torchvision transforms) once per worker process, together with the optional
+	GCS upload queue. Tasks then only ship an archive name across the pipe instead
+	of pickling the whole processor, and each worker mutates its own processor.
+	'''
+	_worker_state['processor'] = CMRI_PreProcessor(root_dir, output_dir, framesize, institution_prefix, channels, compression, grey_window)
+	_worker_state['queue'] = queue
+
+def process_archive(filename):
+	'''
+	Pool task: run process_dicoms() for one archive on this worker's processor.
+	'''
+	return _worker_state['processor'].process_dicoms(filename, _worker_state['queue'])
+
+def extract_archive_task(filename):
+	'''
+	Pool task for series-parallel mode: extract one archive on this worker and
+	return (tar_extract_path, jobs) where jobs come from group_series().
+	'''
+	processor = _worker_state['processor']
+	tar_extract_path, dcm_directory = processor.extract_archive(filename, _worker_state['queue'])
+	return tar_extract_path, processor.group_series(dcm_directory)
+
+def collate_series_task(filename, folders, stacked, series_path):
+	'''
+	Pool task for series-parallel mode: collate a single series of an extracted archive,
+	run prepare_array() on it and write it, compressed, to its own HDF5 file at
+	series_path. Only the path and names go back through the pool pipe, never the
+	array; the parent copies the dataset into the accession's file (copy_series_h5).
+
+	Returns:
+		(series_path, series, mrn, accession), or None if the series could not be collated.
+	'''
+	processor = _worker_state['processor']
+	processor.filename = filename
+	collated = processor.collate_arrays(folders, stacked=stacked)
+	if collated is None:
+		return None
+	collated_array, series, slice_indices, total_images, mrn, accession = collated
+	with h5py.File(series_path, 'w') as h5f:
+		processor.write_series(h5f, processor.prepare_array(collated_array), series, slice_indices, total_images)
+	return series_path, series, mrn, accession
+
+def run_series_parallel(p, processor, filenames, queue, timeout, cpus):
+	'''
+	Series-parallel mode: schedule every series of every archive as its own pool task.
+
+	Archives are extracted on the pool; as each extraction finishes its series are
+	submitted as independent collate_series_task() jobs, so a handful of huge
+	accessions still keep all cores busy. Each worker writes its series, compressed, to
+	a scratch HDF5 file in the archive's extraction directory; the parent acts as the
+	per-accession writer: it copies the series of one archive into the accession's
+	HDF5 file with copy_series_h5(), then finalizes the archive (cleanup, stamping,
+	upload queue). Arrays never cross the pool pipe, so the parent's memory does not
+	grow with the size or number of series in flight.
+
+	At most cpus archives are extracted or being processed at a time: the next
+	extraction is submitted only when an archive is finalized (or fails), so TMP_DIR
+	usage is bounded by cpus archives rather than the whole batch. The series of the
+	next archive are queued while the current one is written, keeping the pool busy.
+
+	Args:
+		p:         multiprocessing.Pool initialized with init_worker().
+		processor: CMRI_PreProcessor in the parent used for writing.
+		filenames: .tgz basenames to process.
+		queue:     Optional GCS upload queue.
+		timeout:   Per-task timeout in seconds.
+		cpus:      Number of archives in flight (the pool size).
+
+	Returns:
+		Tuple of (timed_out, failed) in the same shape as the per-archive collection loop.
+	'''
+	timed_out = []
+	failed = []
+	remaining = iter(filenames)
+	extractions = deque()                        # (archive, AsyncResult) submitted, not yet scheduled
+	scheduled = deque()                          # (archive, extract path, series results) awaiting write
+
+	def submit_next():
+		f = next(remaining, None)
+		if f is not None:
+			extractions.append((f, p.apply_async(extract_archive_task, [f])))
+
+	for _ in range(max(1, cpus)):
+		submit_next()
+
+	while extractions or scheduled:
+		# Schedule extracted archives until the next one's series are queued behind the current one
+		if extractions and len(scheduled) < 2:
+			f, result = extractions.popleft()
+			try:
+				tar_extract_path, jobs = result.get(timeout=timeout)
+			except multiprocessing.TimeoutError:
+				print(f'WARN: {f} timed out during extraction after {timeout}s — skipping')
+				timed_out.append(f)
+				submit_next()
+				continue
+			except Exception as ex:
+				print(f'WARN: {f} raised an exception during extraction — skipping')
+				print(ex)
+				failed.append((f, str(ex)))
+				submit_next()
+				continue
+			print(f'Scheduling {len(jobs)} series for {f} ...')
+			scheduled.append((f, tar_extract_path, [
+				(series, p.apply_async(collate_series_task, [f, folders, stacked, os.path.join(tar_extract_path, f'_series_{k}.h5')]))
+				for k, (series, folders, stacked) in enumerate(jobs)]))
+			continue
+
+		f, tar_extract_path, series_results = scheduled.popleft()
+		processor.filename = f
+		processor._h5_outputs = {}
+		h5_path = None
+		complete = True
+		for series, result in series_results:
+			try:
+				collated = result.get(timeout=timeout)
+			except multiprocessing.TimeoutError:
+				print(f'WARN: {f}::{series} timed out after {timeout}s — skipping')
+				if f not in timed_out:
+					timed_out.append(f)
+				complete = False
+				continue
+			except Exception as ex:
+				print(f'WARN: {f}::{series} raised an exception — skipping')
+				print(ex)
+				failed.append((f, f'{series}: {ex}'))
+				complete = False
+				continue
+			if collated is not None:
+				h5_path = processor.copy_series_h5(*collated)
+
+		# Never push None: the upload worker treats it as its stop signal
+		processor.finalize_archive(f, tar_extract_path, h5_path, queue if h5_path is not None else None, complete)
+		submit_next()
+
+	return timed_out, failed
+
 def notify_slack(message: str):
 	'''
 	Send a message to the configured Slack channel via cmr_bot.
@@ -91,6 +345,55 @@ def notify_slack(message: str):
 		print(f'WARN: cmr_bot not configured, skipping...')
 		print(ex)
 
+class StreamingNormalizer:
+	'''
+	Streaming uint8 normalizer for greyscale storage.
+
+	Call update() on consecutive chunks of a tensor to accumulate its global min/max,
+	then bounds() for the normalization window and to_uint8() per chunk to convert.
+	With the default (no window) the result is identical to normalizing the whole
+	tensor at once with its global min/max. With a percentile window, a strided sample
+	of at most sample_size pixels is kept during update() and the window is read off a
+	histogram of that sample, so percentiles cost no extra pass over the data.
+
+	Args:
+		numel:       Number of elements that will be sampled from (sets the sample stride).
+		window:      Optional (low, high) percentiles; None for global min/max.
+		sample_size: Maximum number of pixels sampled for the percentile histogram.
+		bins:        Number of histogram bins between the global min and max.
+	'''
+	def __init__(self, numel, window=None, sample_size=1_000_000, bins=4096):
+		self.window = window
+		self.bins = bins
+		self.stride = max(1, numel // sample_size)
+		self.vmin = None
+		self.vmax = None
+		self.samples = []
+
+	def update(self, chunk):
+		cmin, cmax = torch.aminmax(chunk)
+		self.vmin = cmin if self.vmin is None else torch.minimum(self.vmin, cmin)
+		self.vmax = cmax if self.vmax is None else torch.maximum(self.vmax, cmax)
+		if self.window is not None:
+			self.samples.append(chunk[:,1].reshape(-1)[::self.stride].numpy().copy())
+
+	def bounds(self):
+		'''
+		Return the (low, high) normalization bounds as 0-dim tensors.
+		'''
+		if self.window is None:
+			return self.vmin, self.vmax
+
+		sample = np.concatenate(self.samples)
+		hist, edges = np.histogram(sample, bins=self.bins, range=(float(self.vmin), float(self.vmax)))
+		cdf = np.cumsum(hist) / max(1, hist.sum())
+		lo = edges[min(np.searchsorted(cdf, self.window[0] / 100, side='right'), self.bins - 1)]
+		hi = edges[min(np.searchsorted(cdf, self.window[1] / 100, side='left') + 1, self.bins)]
+		return torch.tensor(lo, dtype=self.vmin.dtype), torch.tensor(hi, dtype=self.vmax.dtype)
+
+	def to_uint8(self, chunk, lo, hi):
+		return torch.clamp((chunk - lo) / (hi - lo + 1e-8) * 255, 0, 255).to(torch.uint8)
+
 class CMRI_PreProcessor:
 	'''
 	Cardiac MRI preprocessing pipeline: tar.gz DICOM archives → compressed HDF5.
@@ -110,14 +413,67 @@ class CMRI_PreProcessor:
 		institution_prefix:  Prefix string for output folders (e.g. 'stanford', 'ucsf').
 		channels:            Storage mode — 'rgb' (3-channel float32) or 'grey' (1-channel uint8).
 		compression:         HDF5 compression algorithm — 'gzip' or 'lzf'.
+		grey_window:         Optional (low, high) percentiles for greyscale windowing instead of
+		                     global min/max normalization, e.g. (0.5, 99.5).
 	'''
-	def __init__(self, root_dir, output_dir, framesize, institution_prefix, channels, compression):
+	def __init__(self, root_dir, output_dir, framesize, institution_prefix, channels, compression, grey_window=None):
 		self.root_dir = root_dir
 		self.output_dir = output_dir
 		self.framesize = framesize
 		self.institution_prefix = institution_prefix
 		self.compression = compression
 		self.channels = channels
+		self.grey_window = tuple(grey_window) if grey_window is not None else None
+
+		# Built once per processor (i.e. once per pool worker) rather than per series
+		if framesize != 'original':
+			self.transforms = v2.Compose([v2.Resize(size=framesize), v2.CenterCrop(round(0.75*framesize))])
+		else:
+			self.transforms = None
+
+	def pipeline_params(self):
+		'''
+		Parameters that determine the HDF5 output content, plus the code version.
+		Hashed by pipeline_fingerprint() to stamp outputs for incremental rebuilds.
+		'''
+		return {
+			'framesize':   self.framesize,
+			'channels':    self.channels,
+			'compression': self.compression,
+			'grey_window': self.grey_window,
+			'code':        code_version(),
+		}
+
+	def iter_frames(self, input_file):
+		'''
+		Yield dcm_to_array()-style frame tuples for every frame stored in a DICOM file.
+
+		Classic single-frame files yield exactly one tuple via dcm_to_array(). Multiframe
+		objects (Enhanced MR and friends, NumberOfFrames > 1) are routed through
+		multiframe_to_arrays() so each frame becomes its own [c, h, w] entry, instead of
+		the whole pixel_array being misread as an RGB video. The file is read once with
+		deferred pixel data so the multiframe path only decodes frames as they are consumed.
+
+		Args:
+			input_file: Path to a single .dcm file.
+
+		Yields:
+			Tuple of (array [c, h, w], series, frame_loc, accession, mrn, unique_frame_index),
+			or None for a corrupted / unreadable frame.
+		'''
+		try:
+			df = dcm.dcmread(input_file, defer_size='1 KB')
+			n_frames = int(getattr(df, 'NumberOfFrames', 1) or 1)
+		except Exception as ex:
+			print("DICOM corrupted! Skipping...")
+			print(ex)
+			yield None
+			return
+
+		if n_frames > 1:
+			yield from multiframe_to_arrays(df, n_frames)
+		else:
+			yield self.dcm_to_array(df)
 
 	def dcm_to_array(self, input_file):
 		'''
@@ -130,14 +486,14 @@ class CMRI_PreProcessor:
 		InstanceNumber as metadata alongside the pixel array.
 
 		Args:
-			input_file: Path to a single .dcm file.
+			input_file: Path to a single .dcm file, or an already read pydicom Dataset.
 
 		Returns:
 			Tuple of (array [c, h, w], series, frame_loc, accession, mrn, unique_frame_index),
 			or None if the DICOM is corrupted or unreadable.
 		'''
 		try:
-			df = dcm.dcmread(input_file)
+			df = input_file if isinstance(input_file, dcm.Dataset) else dcm.dcmread(input_file)
 			# Check if any dicoms have non greyscale 
 			df.PhotometricInterpretation = 'MONOCHROME2'
 
@@ -182,7 +538,8 @@ class CMRI_PreProcessor:
 			'''
 			Combine a folder (or list of folders) of per-frame DICOMs into a single sorted 4D array.
 
-			Each DICOM file in a series represents one frame. Frames are sorted first by
+			Each DICOM file in a series represents one frame, except multiframe (Enhanced MR)
+			files which contribute one entry per stored frame via iter_frames(). Frames are sorted first by
 			SliceLocation then by InstanceNumber using natsort to ensure correct temporal
 			and spatial ordering. Slice boundary indices are computed for multi-slice sequences
 			(e.g. SAX stacks). Torchvision v2 transforms are applied for resize and center crop,
@@ -202,18 +559,20 @@ class CMRI_PreProcessor:
 				Tuple of (collated_array [f, c, h, w], series, slice_frames, total_images, mrn, accession),
 				or None if the array cannot be constructed (ragged frames, invalid size, etc.).
 			'''
-			if stacked:
-				total_images = 0
-				video_list = []
-				slice_location = []
-				unique_frame_index = []
-				# For ukbiobank SAX the 'dcm_subfolder' is a list of 'dcm_subfolders'
-				for folder in dcm_subfolder:
-					dcm_list = natsorted(os.listdir(folder))
-					total_images += len(dcm_list)
-
-					for d in dcm_list:
-						dcm_data = self.dcm_to_array(os.path.join(folder, d))
+			# For ukbiobank SAX the 'dcm_subfolder' is a list of 'dcm_subfolders'
+			folders = dcm_subfolder if stacked else [dcm_subfolder]
+			total_images = 0
+			video_list = []
+			slice_location = []
+			unique_frame_index = []
+
+			for folder in folders:
+				dcm_list = natsorted(os.listdir(folder))
+
+				for d in dcm_list:
+					# One entry per frame: a classic file holds one, a multiframe file many
+					for dcm_data in self.iter_frames(os.path.join(folder, d)):
+						total_images += 1
 						if dcm_data is not None:
 							video_list.append(dcm_data[0])
 							slice_location.append(dcm_data[2])
@@ -221,28 +580,8 @@ class CMRI_PreProcessor:
 							accession = dcm_data[3]
 							mrn = dcm_data[4]
 							unique_frame_index.append(dcm_data[5])
-							
 						else:
 							continue
-			else:
-				dcm_list = natsorted(os.listdir(dcm_subfolder))
-				total_images = len(dcm_list)
-				video_list = []
-				slice_location = []
-				unique_frame_index = []
-
-				for d in dcm_list:
-					dcm_data = self.dcm_to_array(os.path.join(dcm_subfolder, d))
-
-					if dcm_data is not None:
-						video_list.append(dcm_data[0])
-						slice_location.append(dcm_data[2])
-						series = dcm_data[1]
-						accession = dcm_data[3]
-						mrn = dcm_data[4]
-						unique_frame_index.append(dcm_data[5])
-					else:
-						continue
 
 			try:
 				#NEW
@@ -258,9 +597,8 @@ class CMRI_PreProcessor:
 				slice_frames = np.where(np.array(slice_location)[:-1] != np.array(slice_location)[1:])[0]
 				# framesize='original' keeps native resolution so spatial metadata
 				# (e.g. PixelSpacing) stays meaningful; otherwise resize + center crop.
-				if self.framesize != 'original':
-					transforms = v2.Compose([v2.Resize(size=self.framesize), v2.CenterCrop(round(0.75*self.framesize))])
-					collated_array = transforms(collated_array) # returns as [f, c, h, w]
+				if self.transforms is not None:
+					collated_array = self.transforms(collated_array) # returns as [f, c, h, w]
 				#collated_array = collated_array.transpose(1, 0) # returns as [c, f, h, w] for now ##TODO: REMOVE AND SWITCH TO STORING GREYSCALE f, c, h, w	 
 
 				'''
@@ -292,7 +630,44 @@ class CMRI_PreProcessor:
 				return None
 			
 
-	def array_to_h5(self, collated_array, series, slice_indices, total_images, mrn, accession):
+	def prepare_array(self, collated_array):
+		'''
+		Convert a collated tensor into the array stored on disk for the configured channels.
+
+		In greyscale mode, the array is globally normalized and cast to uint8, and the
+		channel dimension is dropped to store as [f, h, w]. RGB arrays are stored as is.
+		Split out of array_to_h5() so series-parallel workers can do this step before
+		handing the array to the per-accession writer.
+
+		Greyscale normalization streams over chunks of frames with StreamingNormalizer:
+		one pass accumulates min/max (and a pixel sample when --grey_window is set), a
+		second converts only the kept channel of each chunk straight into a preallocated
+		uint8 output. No full-size float temporaries are created.
+
+		Args:
+			collated_array: Torch tensor of shape [f, c, h, w].
+
+		Returns:
+			Array ready for h5py.create_dataset().
+		'''
+		if self.channels == "grey":
+			## Normalize globally ##
+			# This requires dtype to be manually set to "uint8" to truly work and yield storage savings # 
+			frames = collated_array if len(collated_array.shape) == 4 else collated_array[None,...]
+			normalizer = StreamingNormalizer(frames[:,1].numel(), self.grey_window)
+			for i in range(0, frames.shape[0], NORMALIZE_CHUNK):
+				normalizer.update(frames[i:i+NORMALIZE_CHUNK])
+
+			lo, hi = normalizer.bounds()
+			grey = np.empty((frames.shape[0],) + tuple(frames.shape[2:]), dtype=np.uint8)
+			for i in range(0, frames.shape[0], NORMALIZE_CHUNK):
+				grey[i:i+NORMALIZE_CHUNK] = normalizer.to_uint8(frames[i:i+NORMALIZE_CHUNK,1,:,:], lo, hi).numpy()
+
+			collated_array = grey if len(collated_array.shape) == 4 else grey[0]
+
+		return collated_array
+
+	def array_to_h5(self, collated_array, series, slice_indices, total_images, mrn, accession, prepared=False):
 		'''
 		Write a collated array to an HDF5 file as a named dataset with metadata attributes.
 
@@ -302,8 +677,8 @@ class CMRI_PreProcessor:
 		same accession are accumulated into a single .h5 file across separate calls.
 
 		In greyscale mode, the array is globally normalized and cast to uint8 before
-		writing, reducing storage by ~50-70% versus float32 RGB. The channel dimension
-		is dropped to store as [f, h, w].
+		writing (see prepare_array), reducing storage by ~50-70% versus float32 RGB.
+		The channel dimension is dropped to store as [f, h, w].
 
 		Duplicate series keys are skipped silently (HDF5 dataset already exists).
 
@@ -314,31 +689,40 @@ class CMRI_PreProcessor:
 			total_images:   Total number of source DICOM frames before collation.
 			mrn:            Patient MRN string used to name the output parent directory.
 			accession:      Accession number string used as the HDF5 filename.
+			prepared:       True if collated_array already went through prepare_array().
 
 		Returns:
 			Full path to the written HDF5 file.
 		'''
-		dytpe_setting = 'f'
-		if self.channels == "grey":
-			## Normalize globally ##
-			# This requires dtype to be manually set to "uint8" to truly work and yield storage savings # 
-			vmin, vmax = torch.min(collated_array), torch.max(collated_array)
-			collated_array = torch.clamp((collated_array - vmin) / (vmax - vmin + 1e-8) * 255, 0, 255).to(torch.uint8)
-			dytpe_setting = 'uint8'
-			
-			if len(collated_array.shape) == 4:
-				collated_array = collated_array[:,1,:,:]
-			elif len(collated_array.shape) == 3:
-				collated_array = collated_array[1,:,:]
-
+		if not prepared:
+			collated_array = self.prepare_array(collated_array)
+		h5_path = self.h5_output_path(mrn, accession)
 
-		os.makedirs(os.path.join(self.output_dir, self.institution_prefix + '_' + mrn), exist_ok=True)
-		new_filename = accession + '.h5'
-		
 		# Create hdf5 file or append to existing if available
-		h5f = h5py.File(os.path.join(self.output_dir, self.institution_prefix + '_' + mrn, new_filename), 'a')
+		h5f = h5py.File(h5_path, 'a')
 		print(f'Exporting {accession}-{series} as hdf5 dataset...')
-		
+		self.write_series(h5f, collated_array, series, slice_indices, total_images)
+		h5f.close()
+		return h5_path
+
+	def h5_output_path(self, mrn, accession):
+		'''
+		Path of an accession's HDF5 file (output_dir/institution_mrn/accession.h5),
+		creating the patient folder and remembering whether this archive created the
+		file (only those are deleted if the archive fails, see finalize_archive).
+		'''
+		os.makedirs(os.path.join(self.output_dir, self.institution_prefix + '_' + mrn), exist_ok=True)
+		h5_path = os.path.join(self.output_dir, self.institution_prefix + '_' + mrn, accession + '.h5')
+		self._h5_outputs.setdefault(h5_path, not os.path.exists(h5_path))
+		return h5_path
+
+	def write_series(self, h5f, collated_array, series, slice_indices, total_images):
+		'''
+		Store one prepared series as a dataset of an open HDF5 file, with its
+		slice_frames and total_images attributes. Existing series are skipped.
+		'''
+		dytpe_setting = 'uint8' if self.channels == "grey" else 'f'
+
 		# Store each series as an array (Skips if series already exists. Might need to rework this 
 		try:
 			dset = h5f.create_dataset(series, data=collated_array, dtype=dytpe_setting, compression=self.compression)
@@ -355,37 +739,62 @@ class CMRI_PreProcessor:
 			print(f'{series} already exists. Skipping...')
 			pass
 
-		h5f.close()
-		return os.path.join(os.path.join(self.output_dir, self.institution_prefix + '_' + mrn, new_filename))
+	def copy_series_h5(self, series_path, series, mrn, accession):
+		'''
+		Append a series that a pool worker wrote to its own HDF5 file (see
+		collate_series_task) to the accession's HDF5 file, then delete the series file.
+		h5py copies the stored (already compressed) chunks as they are, so the parent
+		neither receives the array over the pool pipe nor holds it in memory.
 
+		Returns:
+			Full path to the accession's HDF5 file.
+		'''
+		h5_path = self.h5_output_path(mrn, accession)
+		print(f'Exporting {accession}-{series} as hdf5 dataset...')
+		with h5py.File(series_path, 'r') as src, h5py.File(h5_path, 'a') as h5f:
+			if series in h5f:
+				print(f'{series} already exists. Skipping...')
+			else:
+				src.copy(src[series], h5f, name=series)
+		os.remove(series_path)
+		return h5_path
 
-	def view_disambugator(self, dcm_directory):
+
+	def group_series(self, dcm_directory):
 		'''
-		Group DICOM subfolders by SeriesDescription and route each group through collation.
+		Group DICOM subfolders by SeriesDescription into collation jobs.
 
 		Iterates all subdirectories in a extracted tar archive, reads the SeriesDescription
 		from the first DICOM in each folder, and builds a map of series → [folder, ...].
-		Series split across multiple folders (e.g. UK Biobank SAX stacks) are collated in
-		stacked mode after sorting folders by SliceLocation. Single-folder series are
-		collated normally. InlineVF overlay series and folders with >2500 frames are skipped.
-		Multi-folder series are trimmed to a maximum of 10 slices (500 frames) to prevent
-		memory blowups.
+		Series split across multiple folders (e.g. UK Biobank SAX stacks) become stacked
+		jobs after sorting folders by SliceLocation. InlineVF overlay series and folders
+		with more than MAX_FRAMES stored frames (the file count, or NumberOfFrames summed
+		over the folder's files, read header-only, when its first file is multiframe) are skipped. Multi-folder series are trimmed to a maximum of
+		10 slices (500 frames) to prevent memory blowups.
 
 		Args:
 			dcm_directory: List of subdirectory paths from glob expansion of the extracted tar.
 
 		Returns:
-			Path to the last HDF5 file written (used for optional GCS upload queue).
+			List of (series, folders, stacked) tuples, where folders is a single folder path
+			when stacked is False and a list of folder paths when stacked is True.
 		'''
 
 		series_map = defaultdict(list)
+		folder_frames = {}
 
 		for dcm_subfolder in dcm_directory:
 			files = glob.glob(os.path.join(dcm_subfolder, "*"))
 			if not files:
 				continue
-			
-			if len(files) < 2500:
+
+			# Size the folder in stored frames. Classic files hold one frame each, so the file
+			# count is exact; only a folder of multiframe (Enhanced MR) files, which can hold
+			# thousands of frames each, has every header read
+			n_frames = len(files)
+			if frame_count(files[0]) > 1:
+				n_frames = sum(frame_count(f) for f in files)
+			if n_frames <= MAX_FRAMES:
 				try:
 					df = dcm.dcmread(files[0], stop_before_pixels=True)
 					series = df.SeriesDescription
@@ -395,16 +804,17 @@ class CMRI_PreProcessor:
 						continue
 	 
 					series_map[series].append(dcm_subfolder)
+					folder_frames[dcm_subfolder] = n_frames
 
 				except Exception as e:
 					print(f"Failed to parse DICOM in {dcm_subfolder}: {e}")
 					continue
 
 			else: 
-				print(f"Insane number of frames detected: {len(files)}; skipping...")
+				print(f"Insane number of frames detected: {n_frames}; skipping...")
 				continue
 
-		# upenn_sax_folder_list = [] ### remove line later
+		jobs = []
 		for series, folders in series_map.items():
 			# Sort folders by df.SliceLocation if multiple separate folders present
 			if len(folders) > 1:
@@ -412,7 +822,7 @@ class CMRI_PreProcessor:
 				folders = natsorted(folders)
 				try:
 					folders.sort(
-						key=lambda x: dcm.dcmread(os.path.join(x, os.listdir(x)[0])).SliceLocation,
+						key=lambda x: read_dicom_header(os.path.join(x, os.listdir(x)[0]), ['SliceLocation']).SliceLocation,
 						reverse=True,
 					)
 				except Exception:
@@ -423,49 +833,62 @@ class CMRI_PreProcessor:
 					print("Trimming to first 10 slices")
 					folders = folders[:10]
 
-				# Guard against OOM: per-folder cap is 2500 but stacked series multiply that.
-				# Trim folders until total frame count fits within 2500.
-				total_frames = sum(len(os.listdir(f)) for f in folders)
-				while total_frames > 2500 and len(folders) > 1:
+				# Guard against OOM: per-folder cap is MAX_FRAMES but stacked series multiply that.
+				# Trim folders until total frame count fits within MAX_FRAMES.
+				total_frames = sum(folder_frames[f] for f in folders)
+				while total_frames > MAX_FRAMES and len(folders) > 1:
 					folders = folders[:-1]
-					total_frames = sum(len(os.listdir(f)) for f in folders)
-				if total_frames > 2500:
-					print(f"Stacked series {series} exceeds 2500 frames even as single folder, skipping...")
+					total_frames = sum(folder_frames[f] for f in folders)
+				if total_frames > MAX_FRAMES:
+					print(f"Stacked series {series} exceeds {MAX_FRAMES} frames even as single folder, skipping...")
 					continue
 				print(f"Stacked series {series}: {len(folders)} folders, {total_frames} total frames")
 
-				collated_array = self.collate_arrays(folders, stacked=True)
-				if collated_array is not None:
-					h5_path = self.array_to_h5(*(collated_array))
+				jobs.append((series, folders, True))
 
 			else:
-				collated_array = self.collate_arrays(folders[0], stacked=False)
-				if collated_array is not None:
-					h5_path = self.array_to_h5(*(collated_array))
+				jobs.append((series, folders[0], False))
+
+		return jobs
+
+
+	def view_disambugator(self, dcm_directory):
+		'''
+		Group DICOM subfolders by SeriesDescription and route each group through collation.
+
+		Runs group_series() to build the collation jobs for an extracted archive, then
+		collates each job (stacked or single-folder) and appends it to the accession's
+		HDF5 file, one series after the other.
+
+		Args:
+			dcm_directory: List of subdirectory paths from glob expansion of the extracted tar.
+
+		Returns:
+			Path to the last HDF5 file written (used for optional GCS upload queue).
+		'''
+		for series, folders, stacked in self.group_series(dcm_directory):
+			collated_array = self.collate_arrays(folders, stacked=stacked)
+			if collated_array is not None:
+				h5_path = self.array_to_h5(*(collated_array))
 
 		return h5_path
 
 
-	def process_dicoms(self, filename, queue=None):
+	def extract_archive(self, filename, queue=None):
 		'''
-		Top-level processing function for a single tar.gz DICOM archive.
+		Extract a .tgz archive to TMP_DIR and list its series subfolders.
 
-		Extracts the archive to TMP_DIR, runs view_disambugator() to convert all
-		series to HDF5, then removes the extracted directory to reclaim disk space.
 		Disk usage is throttled before extraction when a GCS upload queue is active
-		(via wait_if_disk_full). The resulting HDF5 path is pushed to the queue for
-		asynchronous GCS upload if provided.
-
-		Designed to be called via multiprocessing.Pool.apply_async() for parallel
-		processing across many tar files.
+		(via wait_if_disk_full).
 
 		Args:
 			filename: Basename of the .tgz file within root_dir.
-			queue:    Optional multiprocessing.Queue for GCP_Upload_Manager. If None,
-			          files are written locally only and no throttling is applied.
+			queue:    Optional GCS upload queue; enables disk throttling when set.
+
+		Returns:
+			Tuple of (tar_extract_path, dcm_directory) where dcm_directory is the list of
+			series subfolder paths inside the extracted archive.
 		'''
-		self.filename = filename
-		
 		if queue is not None:
 			### Throttle function if disk sage > 90% ###
 			wait_if_disk_full(TMP_DIR)
@@ -477,24 +900,82 @@ class CMRI_PreProcessor:
 
 		# List series folders and iterate over them all one by one 
 		# Return arrays for each folder, convert to hdf5 therafter
-		print(f'Extracted tarfile for {self.filename[:-4]} ...')
+		print(f'Extracted tarfile for {filename[:-4]} ...')
 		dcm_directory = glob.glob(os.path.join(tar_extract_path, '*', '*'))
+		return tar_extract_path, dcm_directory
 
-		# Handles separate pipelines based on data source
-		h5_path = self.view_disambugator(dcm_directory)
 
+	def finalize_archive(self, filename, tar_extract_path, h5_path, queue=None, complete=True):
+		'''
+		Clean up an extracted archive, stamp the HDF5 files it created and hand the
+		result to the GCS upload queue.
+
+		Every HDF5 file this archive wrote to is stamped with the pipeline fingerprint
+		and source archive name (see stamp_h5) so --incremental runs can skip it later.
+		Files that already existed record the archive alongside their creator's stamp.
+
+		When some series of the archive failed (complete=False) the HDF5 files it
+		created are deleted instead of stamped and nothing is uploaded, so the next
+		--incremental run redoes the archive rather than skipping a partial output.
+
+		Args:
+			filename:         Basename of the processed .tgz file.
+			tar_extract_path: Extraction directory to remove.
+			h5_path:          HDF5 path pushed to the upload queue.
+			queue:            Optional multiprocessing.Queue for GCP_Upload_Manager.
+			complete:         False when any series of the archive failed.
+		'''
 		# Clean up after to save space  
 		try:
 			rmtree(tar_extract_path, ignore_errors=True)
 
 		except Exception as ex:
 			print('Failed to purge TMP_DIR(s)')
-		
-		print(f'Completed processing {self.filename}')
+
+		if not complete:
+			for path, created in self._h5_outputs.items():
+				if created and os.path.exists(path):
+					os.remove(path)
+			print(f'WARN: {filename} had failed series — removed its partial outputs instead of stamping them')
+			return
+
+		params = self.pipeline_params()
+		for path, created in self._h5_outputs.items():
+			stamp_h5(path, params, filename, created)
+
+		print(f'Completed processing {filename}')
 
 		if queue is not None:
 			queue.put(h5_path)
 
+
+	def process_dicoms(self, filename, queue=None):
+		'''
+		Top-level processing function for a single tar.gz DICOM archive.
+
+		Extracts the archive to TMP_DIR via extract_archive(), runs view_disambugator()
+		to convert all series to HDF5, then finalize_archive() removes the extracted
+		directory, stamps the new HDF5 files and pushes the resulting HDF5 path to the
+		queue for asynchronous GCS upload if provided.
+
+		Called on each pool worker's own processor via process_archive() for parallel
+		processing across many tar files.
+
+		Args:
+			filename: Basename of the .tgz file within root_dir.
+			queue:    Optional multiprocessing.Queue for GCP_Upload_Manager. If None,
+			          files are written locally only and no throttling is applied.
+		'''
+		self.filename = filename
+		self._h5_outputs = {}
+
+		tar_extract_path, dcm_directory = self.extract_archive(filename, queue)
+
+		# Handles separate pipelines based on data source
+		h5_path = self.view_disambugator(dcm_directory)
+
+		self.finalize_archive(filename, tar_extract_path, h5_path, queue)
+
 if __name__ == '__main__':
 
 	parser = ap.ArgumentParser(
@@ -514,6 +995,9 @@ if __name__ == '__main__':
 	parser.add_argument('-i', '--institution', metavar='', required=True, help='institution name to use as prefix for hdf5 files')
 	parser.add_argument('--gcs_bucket_upload', metavar='', default=None, help='gs:bucket destination for files to be directly uploaded to from local tmp_output directory (-o)')
 	parser.add_argument('--channels', metavar='', default="rgb", help='Saves hdf5 array either as 3 channel "rgb" or 1 channel "grey" to optimize storage space')
+	parser.add_argument('--grey_window', metavar='', type=float, nargs=2, default=None, help='Greyscale mode only: window to these low/high percentiles (from a sampled histogram) instead of global min/max, e.g. 0.5 99.5')
+	parser.add_argument('--series_parallel', action='store_true', default=False, help='Schedule each series of an accession as its own task (use when there are few, large archives); each series is staged as a compressed scratch hdf5 in TMP_DIR, not sent through the pool')
+	parser.add_argument('--incremental', action='store_true', default=False, help='Only (re)process archives whose hdf5 outputs are missing or stamped with different pipeline parameters / code version')
 
 	args = vars(parser.parse_args())
 	print(args)
@@ -528,6 +1012,9 @@ if __name__ == '__main__':
 	debug = args['debug']
 	gcs_bucket_upload = args["gcs_bucket_upload"]
 	channels = args["channels"]
+	incremental = args["incremental"]
+	series_parallel = args["series_parallel"]
+	grey_window = args["grey_window"]
 	if gcs_bucket_upload is not None:
 		assert gcs_bucket_upload[:3] == "gs:"
 
@@ -580,8 +1067,6 @@ if __name__ == '__main__':
 	#### Main DCM to HDF5 conversion pipeline ####
 	else:
 		# Main run command to convert dcm files to hdf5
-		p = multiprocessing.Pool(processes=cpus)
-
 		if root_dir[:3] == "gs:":
 			# Split / to ensure mount point doesn't duplicate subdirs if present
 			if mount_gcs_bucket(root_dir, f'{TMP_DIR}/mnt/{root_dir[3:].split("/")[0]}') is True:
@@ -603,7 +1088,20 @@ if __name__ == '__main__':
 			filenames = os.listdir(root_dir)
 
 		start_time = time.time()
-		mri_processor = CMRI_PreProcessor(root_dir, output_dir, framesize, institution_prefix, channels, compression)
+		mri_processor = CMRI_PreProcessor(root_dir, output_dir, framesize, institution_prefix, channels, compression, grey_window)
+
+		if incremental:
+			# Outputs uploaded to GCS are removed locally, so they always plan as missing
+			fingerprint = pipeline_fingerprint(mri_processor.pipeline_params())
+			tgz_files = [f for f in filenames if f[-3:] == 'tgz']
+			filenames, up_to_date, stale_outputs = plan_incremental(tgz_files, output_dir, institution_prefix, fingerprint)
+			for path in stale_outputs:
+				os.remove(path)
+			print('------------------------------------')
+			print(f'Incremental run (fingerprint {fingerprint})')
+			print(f'Up to date:   {len(up_to_date)} scan(s)')
+			print(f'To process:   {len(filenames)} scan(s), {len(stale_outputs)} stale hdf5 file(s) removed')
+			print('------------------------------------')
 		if gcs_bucket_upload is not None:
 			try:
 				manager = multiprocessing.Manager()
@@ -616,36 +1114,48 @@ if __name__ == '__main__':
 		else:
 			shared_queue = None
 
-		async_results = {}
-		for f in filenames:
-			# Only loops through tgz files
-			if f[-3:] == 'tgz':
-				if cpus > 1:
-					async_results[f] = p.apply_async(mri_processor.process_dicoms, [f, shared_queue])
-				else:
-					mri_processor.process_dicoms(f, shared_queue)
-
-			else:
-				print("No tar files here!")
-				continue
-
-		p.close()
+		# Persistent pool: every worker builds its processor once via init_worker()
+		p = multiprocessing.Pool(processes=cpus, initializer=init_worker,
+			initargs=(root_dir, output_dir, framesize, institution_prefix, channels, compression, shared_queue, grey_window))
 
 		# Collect results with per-task timeout so a single hung worker
 		# (e.g. blocked tarfile.extractall or rmtree on a bad mount) cannot stall the pool.
 		TASK_TIMEOUT = 1000  # seconds — adjust if legitimate scans take longer
 		timed_out = []
 		failed = []
-		for f, result in async_results.items():
-			try:
-				result.get(timeout=TASK_TIMEOUT)
-			except multiprocessing.TimeoutError:
-				print(f'WARN: {f} timed out after {TASK_TIMEOUT}s — skipping')
-				timed_out.append(f)
-			except Exception as ex:
-				print(f'WARN: {f} raised an exception — skipping')
-				print(ex)
-				failed.append((f, str(ex)))
+
+		if series_parallel and cpus > 1:
+			# Parallelism at series granularity: useful when there are few, large archives
+			tgz_files = [f for f in filenames if f[-3:] == 'tgz']
+			timed_out, failed = run_series_parallel(p, mri_processor, tgz_files, shared_queue, TASK_TIMEOUT, cpus)
+			p.close()
+
+		else:
+			async_results = {}
+			for f in filenames:
+				# Only loops through tgz files
+				if f[-3:] == 'tgz':
+					if cpus > 1:
+						async_results[f] = p.apply_async(process_archive, [f])
+					else:
+						mri_processor.process_dicoms(f, shared_queue)
+
+				else:
+					print("No tar files here!")
+					continue
+
+			p.close()
+
+			for f, result in async_results.items():
+				try:
+					result.get(timeout=TASK_TIMEOUT)
+				except multiprocessing.TimeoutError:
+					print(f'WARN: {f} timed out after {TASK_TIMEOUT}s — skipping')
+					timed_out.append(f)
+				except Exception as ex:
+					print(f'WARN: {f} raised an exception — skipping')
+					print(ex)
+					failed.append((f, str(ex)))
 
 		# Workers that timed out are still alive and stuck — terminate the pool
 		# before joining, otherwise p.join() hangs waiting for them to exit.
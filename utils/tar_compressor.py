@@ -14,30 +14,256 @@ via mode selection:
     penn            — handle flat DICOM folders with no series subdirectory structure
     reset_dicom_meta — overwrite AccessionNumber in original files before compressing
 
-All modes support multiprocessing via Pool.apply_async().
+Every mode runs through one job runner (run_jobs): results are collected from the pool,
+each folder's status, time and bytes in/out are appended to tar_compressor_ledger.csv in
+the output directory, and --resume skips folders already recorded as done whose outputs
+still validate. Crosswalk CSVs are read once in the parent and shared with workers as
+hash lookup tables via the pool initializer.
 
 Usage:
     python tar_compressor.py -r /path/to/dicoms -o /path/to/output -m anonymize -l crosswalk.csv
 '''
 
 import tarfile
+import io
+import csv
+import json
+import queue
 import os
 import multiprocessing
 import argparse as ap
 import pydicom as dcm
 import time
 import glob
+import itertools
 import pandas as pd 
 import shutil
 import bcolors
 import zipfile
 
+from collections import Counter
 from local_config import get_cfg, get_global_cfg
+from tarutils import open_tar_writer, open_tar_reader, folder_bytes, ENGINES, ENGINE_EXTENSIONS
+from dcmutils import patch_dicom_header, read_dicom_header, IDENTIFIER_TAGS
 
 _cfg        = get_cfg()
 TMP_DIR     = _cfg.tmp_dir
 BUCKET_NAME = get_global_cfg().bucket_name
 
+# Crosswalk lookup tables, loaded once in the parent and handed to workers by init_worker()
+_crosswalk = None
+
+# Output compression engine (see tarutils.py), set for every process by init_worker()
+_engine = 'gzip'
+_compress_threads = 1
+
+# Archives from open_output_tar that are still being written: id(tar) -> (tar, final path)
+_open_outputs = {}
+PARTIAL_SUFFIX = '.partial'
+
+# Force the pydicom decode/re-encode path instead of header patching (see anonymize_dicom)
+_full_reencode = False
+
+def _lookup_table(keys, values):
+	'''
+	Build a dict from key column(s) to value column(s). The first row wins on duplicate
+	keys, matching the .values[0] semantics of the old per-archive DataFrame scans.
+	'''
+	table = {}
+	for k, v in zip(keys, values):
+		table.setdefault(k, v)
+	return table
+
+def load_crosswalk(csv_reference, mode):
+	'''
+	Read a crosswalk CSV once and turn it into hash lookup tables for the given mode.
+
+	Replaces the per-archive pd.read_csv + linear ref_data.loc[... == ...] scans,
+	which are quadratic for large crosswalks and large batches of folders.
+
+	Args:
+		csv_reference: Path to crosswalk CSV.
+		mode:          tar_compressor mode; determines key and value columns.
+
+	Returns:
+		Dict of lookup tables:
+		    anonymize / penn: {'accession': {accession: (anon_mrn, anon_accession)}}
+		    segmed:           {'study_uid': {Study ID: (anon_mrn, anon_uid)}}
+		    dasa:             {'accession': {accession: (anon_mrn, anon_accession)}}
+		    ukbiobank:        {'eid': {f.eid: anon_mrn}, 'eid_instance': {(f.eid, instance): anon_accession}}
+	'''
+	ref_data = pd.read_csv(csv_reference).dropna().reset_index()
+
+	if mode in ('anonymize', 'penn'):
+		# Coerce instead of astype(int) so one malformed accession only fails its own folder
+		accessions = pd.to_numeric(ref_data['accession'], errors='coerce')
+		bad = accessions.isna()
+		if bad.any():
+			print(f'{bcolors.WARN}Dropping {bad.sum()} crosswalk rows with non-numeric accessions: '
+				f'{", ".join(ref_data.loc[bad, "accession"].astype(str).head(10))}{bcolors.END}')
+			ref_data, accessions = ref_data[~bad], accessions[~bad]
+		keys = accessions.astype('int64').astype(str)
+		return {'accession': _lookup_table(keys, zip(ref_data['anon_mrn'], ref_data['anon_accession']))}
+
+	elif mode == 'segmed':
+		keys = ref_data['Study ID'].astype(str)
+		return {'study_uid': _lookup_table(keys, zip(ref_data['anon_mrn'], ref_data['anon_uid']))}
+
+	elif mode == 'dasa':
+		keys = ref_data['accession'].astype(str)
+		return {'accession': _lookup_table(keys, zip(ref_data['anon_mrn'], ref_data['anon_accession']))}
+
+	elif mode == 'ukbiobank':
+		eids = ref_data['f.eid'].astype(str)
+		instances = ref_data['instance'].astype(str)
+		return {
+			'eid':          _lookup_table(eids, ref_data['anon_mrn']),
+			'eid_instance': _lookup_table(zip(eids, instances), ref_data['anon_accession']),
+		}
+
+	raise ValueError(f'No crosswalk lookup defined for mode: {mode}')
+
+def init_worker(crosswalk, engine='gzip', compress_threads=1, full_reencode=False):
+	'''
+	multiprocessing.Pool initializer: install the crosswalk lookup tables built once by
+	the parent, so tasks never re-read the crosswalk CSV, plus the output compression
+	engine and anonymization path.
+	'''
+	global _crosswalk, _engine, _compress_threads, _full_reencode
+	_crosswalk = crosswalk
+	_engine = engine
+	_compress_threads = compress_threads
+	_full_reencode = full_reencode
+
+def get_crosswalk(csv_reference, mode):
+	'''
+	Return the crosswalk lookup tables for this process, loading them on first use
+	when the function is called outside an initialized pool.
+	'''
+	global _crosswalk
+	if _crosswalk is None:
+		_crosswalk = load_crosswalk(csv_reference, mode)
+	return _crosswalk
+
+def open_output_tar(output_dir, stem):
+	'''
+	Open output_dir/stem.<ext> for writing with the configured compression engine
+	(.tgz for gzip/pigz, .tar.zst for zstd).
+
+	The archive is written under a PARTIAL_SUFFIX name and only moved to its final
+	name by close_output_tar, so a job that dies mid-write never leaves a truncated
+	archive that looks finished. discard_output_tars removes whatever is still open.
+	'''
+	path = os.path.join(output_dir, stem + ENGINE_EXTENSIONS[_engine])
+	tar = open_tar_writer(path + PARTIAL_SUFFIX, engine=_engine, threads=_compress_threads)
+	_open_outputs[id(tar)] = (tar, path)
+	return tar
+
+def close_output_tar(tar):
+	'''
+	Finish an archive from open_output_tar and rename it to its final name.
+
+	Returns:
+		Final path of the archive (tar.name is updated to match).
+	'''
+	_, path = _open_outputs.pop(id(tar))
+	tar.close()
+	os.replace(path + PARTIAL_SUFFIX, path)
+	tar.name = os.path.abspath(path)
+	return tar.name
+
+def discard_output_tars(tars=None):
+	'''
+	Close and delete unfinished archives from open_output_tar (all of them by default).
+	'''
+	for key, (tar, path) in list(_open_outputs.items()):
+		if tars is not None and tar not in tars:
+			continue
+		del _open_outputs[key]
+		try:
+			tar.close()
+		except Exception:
+			pass
+		if os.path.exists(path + PARTIAL_SUFFIX):
+			os.remove(path + PARTIAL_SUFFIX)
+			print(f'{bcolors.WARN}Removed unfinished {os.path.basename(path)}{bcolors.END}')
+
+def encode_dicom(df, updates, implicit_vr):
+	'''
+	Apply tag updates to a pydicom Dataset and re-encode it in memory.
+
+	PhotometricInterpretation is forced to MONOCHROME2 and the dataset is written
+	little endian with the requested VR encoding, exactly as the save_as() calls of
+	the anonymizing modes did.
+
+	Args:
+		df:          pydicom Dataset read with pixel data.
+		updates:     Dict of DICOM keyword → new value, e.g. {'PatientID': anon_mrn}.
+		implicit_vr: Encode the dataset with implicit (True) or explicit (False) VR.
+
+	Returns:
+		Encoded DICOM file as bytes.
+	'''
+	# Check if any dicoms have non greyscale 
+	df.PhotometricInterpretation = 'MONOCHROME2'
+	for keyword, value in updates.items():
+		setattr(df, keyword, value)
+	df.is_little_endian = True
+	df.is_implicit_VR = implicit_vr
+
+	buffer = io.BytesIO()
+	df.save_as(buffer, write_like_original=False)
+	return buffer.getvalue()
+
+def anonymize_dicom(dcm_file, updates, implicit_vr):
+	'''
+	Read a DICOM file and return it with updated tags as bytes.
+
+	Tries dcmutils.patch_dicom_header first, which rewrites only the header elements
+	and copies the pixel data verbatim. Falls back to the full pydicom decode and
+	encode_dicom() when the file's encoding does not allow patching (transfer syntax
+	mismatch, big endian, deflated, stale group lengths, ...) or --full_reencode is set.
+
+	Args:
+		dcm_file:    Path to the source DICOM.
+		updates:     Dict of DICOM keyword → new value.
+		implicit_vr: Output VR encoding (see encode_dicom).
+
+	Returns:
+		Encoded DICOM file as bytes.
+	'''
+	with open(dcm_file, 'rb') as f:
+		return anonymize_dicom_bytes(f.read(), updates, implicit_vr)
+
+def anonymize_dicom_bytes(data, updates, implicit_vr):
+	'''
+	anonymize_dicom() for a DICOM file already held in memory (e.g. a zip member).
+	'''
+	updates = {'PhotometricInterpretation': 'MONOCHROME2', **updates}
+	if not _full_reencode:
+		patched = patch_dicom_header(data, updates, implicit_vr)
+		if patched is not None:
+			return patched
+	return encode_dicom(dcm.dcmread(io.BytesIO(data)), updates, implicit_vr)
+
+def add_bytes_to_tar(tar, data, arcname):
+	'''
+	Write an in-memory file straight into an open tar as a regular member.
+	'''
+	info = tarfile.TarInfo(arcname)
+	info.size = len(data)
+	info.mode = 0o644
+	info.mtime = time.time()
+	tar.addfile(info, io.BytesIO(data))
+
+def write_output(data, tmp_path):
+	'''
+	Write an encoded DICOM to its TMP_DIR staging path (non-streaming modes).
+	'''
+	os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+	with open(tmp_path, 'wb') as f:
+		f.write(data)
+
 def csv_tarcompress(root_dir, filename, output_dir, csv_reference):
 	'''
 	Compress a DICOM folder to .tgz, remapping identifiers via a CSV crosswalk.
@@ -51,39 +277,33 @@ def csv_tarcompress(root_dir, filename, output_dir, csv_reference):
 		filename:      Name of the study folder to compress.
 		output_dir:    Destination for the output .tgz file.
 		csv_reference: Path to crosswalk CSV with columns: mrn, accession, anon_mrn, anon_accession.
+
+	Returns:
+		List with the output archive path.
 	'''
 
-	ref_data = pd.read_csv(csv_reference).dropna().reset_index()
+	crosswalk = get_crosswalk(csv_reference, 'anonymize')['accession']
 	dicom_list = glob.glob(os.path.join(root_dir, filename,'*','*'))
 
-	try:
-		df = dcm.dcmread(dicom_list[1])
-		# Check if any dicoms have non greyscale 
-		df.PhotometricInterpretation = 'MONOCHROME2'
+	df = read_dicom_header(dicom_list[1], IDENTIFIER_TAGS)
+	# Process only if Accession Number is in crosswalk file
+	accession = df.AccessionNumber  
+	mrn = df.PatientID
 
-		# Process only if Accession Number is in crosswalk file
-		accession = df.AccessionNumber  
-		mrn = df.PatientID
-
-		# Possibility of MRN not being in crosswalk, but accession # will always match
-
-		if accession in ref_data['accession'].to_string():
-			mrn =  ref_data.loc[ref_data['accession'].astype(int).astype(str) == accession, 'anon_mrn'].values[0]
-			accession = ref_data.loc[ref_data['accession'].astype(int).astype(str) == accession, 'anon_accession'].values[0]
-			print(f'{bcolors.OK}Processing: {mrn}-{accession}{bcolors.END}')
-		else:
-			pass
-			print(f'{bcolors.ERR}No matching scan data in crosswalk for acc: {accession}{bcolors.END}')
+	# Possibility of MRN not being in crosswalk, but accession # will always match
 
-		# Dump entire thing as a tarfile with anonymized mrn as basename
-		folder_name = os.path.join(root_dir, filename)
-		tar = tarfile.open(os.path.join(output_dir, mrn+'-'+accession+'.tgz'), "w:gz")
-		tar.add(folder_name, arcname=filename)
-		tar.close()
+	if accession in crosswalk:
+		mrn, accession = crosswalk[accession]
+		print(f'{bcolors.OK}Processing: {mrn}-{accession}{bcolors.END}')
+	else:
+		pass
+		print(f'{bcolors.ERR}No matching scan data in crosswalk for acc: {accession}{bcolors.END}')
 
-	except Exception as e:
-		print("DICOM corrupted! Skipping...")
-		print(e)
+	# Dump entire thing as a tarfile with anonymized mrn as basename
+	folder_name = os.path.join(root_dir, filename)
+	tar = open_output_tar(output_dir, mrn+'-'+accession)
+	tar.add(folder_name, arcname=filename)
+	return [close_output_tar(tar)]
 
 def dcm_tarcompress(root_dir, filename, output_dir):
 	'''
@@ -96,95 +316,87 @@ def dcm_tarcompress(root_dir, filename, output_dir):
 		root_dir:   Path to directory containing DICOM study folders.
 		filename:   Name of the study folder to compress.
 		output_dir: Destination for the output .tgz file.
+
+	Returns:
+		List with the output archive path.
 	'''
 
 	dicom_list = glob.glob(os.path.join(root_dir,filename,'*','*'))
 
-	try:
-		#print(dicom_list[1])
-		df = dcm.dcmread(dicom_list[1])
-
-		# Check if any dicoms have non greyscale 
-		df.PhotometricInterpretation = 'MONOCHROME2'
-
-		# Save series name + frame location 
-		accession = df.AccessionNumber  
-		mrn = df.PatientID 
-		print('Processing:', mrn+'-'+accession)
+	#print(dicom_list[1])
+	df = read_dicom_header(dicom_list[1], IDENTIFIER_TAGS)
 
-		# Dump entire thing as a tarfile with anonymized mrn as basename
-		folder_name = os.path.join(root_dir, filename)
-		tar = tarfile.open(os.path.join(output_dir, mrn+'-'+accession+'.tgz'), "w:gz")
-		tar.add(folder_name, arcname=filename)
-		tar.close()
+	# Save series name + frame location 
+	accession = df.AccessionNumber  
+	mrn = df.PatientID 
+	print('Processing:', mrn+'-'+accession)
 
-	except:
-		print("DICOM corrupted! Skipping...")
+	# Dump entire thing as a tarfile with anonymized mrn as basename
+	folder_name = os.path.join(root_dir, filename)
+	tar = open_output_tar(output_dir, mrn+'-'+accession)
+	tar.add(folder_name, arcname=filename)
+	return [close_output_tar(tar)]
 
-def segmed_tarcompress(root_dir, filename, output_dir, csv_reference):
+def segmed_tarcompress(root_dir, filename, output_dir, csv_reference, stream=False):
 	'''
 	Anonymize and compress SegMed DICOM studies, rewriting tags in-place before archiving.
 
 	Looks up StudyInstanceUID in the crosswalk CSV to retrieve anon_mrn and anon_uid.
 	Rewrites PatientID and AccessionNumber on every DICOM file in TMP_DIR before
-	compressing to .tgz. Cleans up TMP_DIR after compression.
+	compressing to .tgz. Cleans up TMP_DIR after compression. With stream=True each
+	rewritten DICOM is serialized in memory and written directly as a tar member,
+	skipping the TMP_DIR copy entirely.
 
 	Args:
 		root_dir:      Path to directory containing DICOM study folders.
 		filename:      Name of the study folder to compress.
 		output_dir:    Destination for the output .tgz file.
 		csv_reference: Path to crosswalk CSV with columns: Study ID, anon_mrn, anon_uid.
+		stream:        Write rewritten DICOMs straight into the tar (no TMP_DIR staging).
+
+	Returns:
+		List with the output archive path.
 	'''
 
-	ref_data = pd.read_csv(csv_reference).dropna().reset_index()
+	crosswalk = get_crosswalk(csv_reference, 'segmed')['study_uid']
 	dicom_list = glob.glob(os.path.join(root_dir,filename,'*','*'))
 	os.chdir(root_dir)
 
-	try:
-		#print(dicom_list[1])
-		df = dcm.dcmread(dicom_list[1])
+	#print(dicom_list[1])
+	df = read_dicom_header(dicom_list[1], IDENTIFIER_TAGS)
 
-		# Check if any dicoms have non greyscale 
-		df.PhotometricInterpretation = 'MONOCHROME2'
+	# Save series name + frame location 
+	study_uid = str(df.StudyInstanceUID)
+	mrn = df.PatientID 
 
-		# Save series name + frame location 
-		study_uid = str(df.StudyInstanceUID)
-		mrn = df.PatientID 
+	# Possibility of MRN not being in crosswalk, but accession # will always match
+	if study_uid in crosswalk:
+		mrn, accession = crosswalk[study_uid]
+		print(f'{bcolors.BLUE}Processing{bcolors.ENDC}: {mrn}-{accession}')
+	else:
+		pass
+		print(f'{bcolors.ERR}No matching scan data in crosswalk for acc: {study_uid}{bcolors.END}')
 
-		# Possibility of MRN not being in crosswalk, but accession # will always match
-		if study_uid in ref_data['Study ID'].astype(str).values:
-			mrn =  ref_data.loc[ref_data['Study ID'].astype(str) == study_uid, 'anon_mrn'].values[0]
-			accession = ref_data.loc[ref_data['Study ID'].astype(str) == study_uid, 'anon_uid'].values[0]
-			print(f'{bcolors.BLUE}Processing{bcolors.ENDC}: {mrn}-{accession}')
-		else:
-			pass
-			print(f'{bcolors.ERR}No matching scan data in crosswalk for acc: {study_uid}{bcolors.END}')
+	updates = {'PatientID': mrn, 'AccessionNumber': accession}
 
+	if stream:
+		tar = open_output_tar(output_dir, mrn+'-'+accession)
 		for dcm_file in dicom_list:
-			tmp_path = os.path.join(TMP_DIR, os.path.relpath(dcm_file))
-			os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
-			
-			df = dcm.dcmread(dcm_file)
-			# Check if any dicoms have non greyscale 
-			df.PhotometricInterpretation = 'MONOCHROME2'
-			df.PatientID = mrn
-			df.AccessionNumber = accession
-			df.is_little_endian = True
-			df.is_implicit_VR = False
+			add_bytes_to_tar(tar, anonymize_dicom(dcm_file, updates, implicit_vr=False), os.path.relpath(dcm_file))
+		return [close_output_tar(tar)]
 
-			df.save_as(tmp_path, write_like_original=False)	
-
-		# Dump entire thing as a tarfile with anonymized mrn as basename
-		folder_name = os.path.join(TMP_DIR, os.path.basename(filename))
-		tar = tarfile.open(os.path.join(output_dir, mrn+'-'+accession+'.tgz'), "w:gz")
-		tar.add(folder_name, arcname=filename)
-		tar.close()
+	for dcm_file in dicom_list:
+		tmp_path = os.path.join(TMP_DIR, os.path.relpath(dcm_file))
+		write_output(anonymize_dicom(dcm_file, updates, implicit_vr=False), tmp_path)
 
-		shutil.rmtree(folder_name)
+	# Dump entire thing as a tarfile with anonymized mrn as basename
+	folder_name = os.path.join(TMP_DIR, os.path.basename(filename))
+	tar = open_output_tar(output_dir, mrn+'-'+accession)
+	tar.add(folder_name, arcname=filename)
+	output = close_output_tar(tar)
 
-	except Exception as e:
-		print("DICOM corrupted! Skipping...")
-		print(e)
+	shutil.rmtree(folder_name)
+	return [output]
 
 def ukb_unzip_and_organize(root_dir, target_prefix):
 	# Hunt for all scans with specific target eid prefix 
@@ -218,72 +430,149 @@ def ukb_unzip_and_organize(root_dir, target_prefix):
 
 
 
-def ukb_tarcompress(root_dir, filename, output_dir, csv_reference):
+def ukb_group_zips(root_dir, eid):
+	'''
+	Collect the UKB zip files of one participant, grouped by instance.
+
+	Args:
+		root_dir: Directory of zips named {eid}_{datafield}_{instance}_0.zip.
+		eid:      Participant EID.
+
+	Returns:
+		Dict of instance → sorted list of zip paths.
+	'''
+	instances = {}
+	for scan in sorted(glob.glob(os.path.join(root_dir, f'{eid}_*'))):
+		dat = str.split(os.path.basename(scan), '_')
+		if len(dat) < 3 or dat[0] != eid:
+			continue
+		instances.setdefault(dat[2], []).append(scan)
+	return instances
+
+def ukb_stream_tarcompress(root_dir, filename, output_dir, csv_reference):
+	'''
+	One-pass UK Biobank conversion: zip members → anonymized tar members.
+
+	Streaming counterpart of ukb_unzip_and_organize() + ukb_tarcompress(): each .dcm
+	member at the top level of every zip is read into memory, its SeriesDescription
+	is taken from a header-only parse, and the anonymized bytes are written to the
+	instance's tar as {eid}_{accession}/{SeriesDescription}/{basename}. Nothing is
+	written to TMP_DIR.
+
+	Args:
+		root_dir:      Path to directory containing UKB zip files named {eid}_{datafield}_{instance}_0.zip.
+		filename:      EID string.
+		output_dir:    Destination for output .tgz files (one per instance).
+		csv_reference: Path to crosswalk CSV with columns: f.eid, instance, anon_mrn, anon_accession.
+
+	Returns:
+		List of output archive paths (one per instance).
+	'''
+	crosswalk = get_crosswalk(csv_reference, 'ukbiobank')
+	patient_id = str(filename)
+	outputs, errors = [], []
+
+	for scan_instance, zips in ukb_group_zips(root_dir, patient_id).items():
+		try:
+			mrn = crosswalk['eid'][patient_id]
+			accession = crosswalk['eid_instance'][(patient_id, scan_instance)]
+			print(f'{bcolors.BLUE}Processing{bcolors.ENDC}: {mrn}-{accession}')
+
+			updates = {'PatientID': mrn, 'PatientName': f"redacted_{mrn}", 'AccessionNumber': accession}
+			tar = open_output_tar(output_dir, mrn+'-'+accession)
+			try:
+				for scan in zips:
+					try:
+						with zipfile.ZipFile(scan, 'r') as zf:
+							for member in zf.infolist():
+								if member.is_dir() or '/' in member.filename or not member.filename.endswith('.dcm'):
+									continue
+								data = zf.read(member)
+								series = read_dicom_header(io.BytesIO(data), ['SeriesDescription']).SeriesDescription
+								arcname = os.path.join(f'{filename}_{accession}', series, member.filename)
+								add_bytes_to_tar(tar, anonymize_dicom_bytes(data, updates, implicit_vr=False), arcname)
+
+					except zipfile.BadZipFile:
+						print(f"Error: '{scan}' is not a valid zip file or is corrupted.")
+			except Exception:
+				discard_output_tars([tar])
+				raise
+			outputs.append(close_output_tar(tar))
+
+		except Exception as e:
+			print("DICOM corrupted! Skipping...")
+			print(e)
+			errors.append(f'instance {scan_instance}: {e}')
+
+	if errors:
+		raise RuntimeError('; '.join(errors))
+	return outputs
+
+def ukb_tarcompress(root_dir, filename, output_dir, csv_reference, stream=False):
 	'''
 	Anonymize and compress a UK Biobank EID zip dump into per-accession .tgz archives.
 
 	Calls ukb_unzip_and_organize() to extract and reorganize zip files by instance/datafield,
 	then for each collected scan: looks up anon_mrn and anon_accession from the crosswalk,
 	rewrites PatientID, PatientName, and AccessionNumber on every DICOM, reorganizes files
-	into SeriesDescription subdirectories in TMP_DIR, and compresses to .tgz.
+	into SeriesDescription subdirectories in TMP_DIR, and compresses to .tgz. With
+	stream=True the zips are converted in one pass by ukb_stream_tarcompress() and
+	nothing is extracted to TMP_DIR.
 
 	Args:
 		root_dir:      Path to directory containing UKB zip files named {eid}_{datafield}_{instance}_0.zip.
 		filename:      EID string used to glob all zip files for this participant.
 		output_dir:    Destination for output .tgz files.
 		csv_reference: Path to crosswalk CSV with columns: f.eid, instance, anon_mrn, anon_accession.
+		stream:        Convert zip members straight into the tar (see ukb_stream_tarcompress).
+
+	Returns:
+		List of output archive paths (one per instance).
 	'''
+	if stream:
+		return ukb_stream_tarcompress(root_dir, filename, output_dir, csv_reference)
+
 	ukb_unzip_and_organize(root_dir, filename)
 	accession_folders = glob.glob(os.path.join(TMP_DIR, filename, '*'))
 
+	crosswalk = get_crosswalk(csv_reference, 'ukbiobank')
+	outputs, errors = [], []
+
 	for collected_scans in accession_folders:
-		ref_data = pd.read_csv(csv_reference).dropna().reset_index()
 		dicom_list = glob.glob(os.path.join(collected_scans,'*','*.dcm'))
 		os.chdir(root_dir)
 		
 		try:
 			#print(dicom_list[1])
-			df = dcm.dcmread(dicom_list[1])
-
-			# Check if any dicoms have non greyscale 
-			df.PhotometricInterpretation = 'MONOCHROME2'
+			df = read_dicom_header(dicom_list[1], IDENTIFIER_TAGS)
 
 			# Save series name + frame location 
 			patient_id = str(filename)
 			scan_instance = str(os.path.basename(collected_scans))
-			mrn =  ref_data.loc[ref_data['f.eid'].astype(str) == patient_id, 'anon_mrn'].values[0]
-			accession = ref_data.loc[(ref_data['f.eid'].astype(str) == patient_id) & (ref_data['instance'].astype(str) == scan_instance), 'anon_accession'].values[0]
+			mrn = crosswalk['eid'][patient_id]
+			accession = crosswalk['eid_instance'][(patient_id, scan_instance)]
 			print(f'{bcolors.BLUE}Processing{bcolors.ENDC}: {mrn}-{accession}')
 			
+			updates = {'PatientID': mrn, 'PatientName': f"redacted_{mrn}", 'AccessionNumber': accession}
 
 			for dcm_file in dicom_list:
-				df = dcm.dcmread(dcm_file)
-				series = df.SeriesDescription
+				series = read_dicom_header(dcm_file, ['SeriesDescription']).SeriesDescription
 				
 				tmp_path = os.path.join(TMP_DIR, f'{mrn}_{accession}', series, os.path.basename(dcm_file))
-				os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
-				
-				# Check if any dicoms have non greyscale 
-				df.PhotometricInterpretation = 'MONOCHROME2'
-				df.PatientID = mrn
-				df.PatientName = f"redacted_{mrn}"
-				df.AccessionNumber = accession
-				df.is_little_endian = True
-				df.is_implicit_VR = False
-
-				df.save_as(tmp_path, write_like_original=False)	
+				write_output(anonymize_dicom(dcm_file, updates, implicit_vr=False), tmp_path)
 
 			# Dump entire thing as a tarfile with anonymized mrn as basename
 			folder_name = os.path.join(TMP_DIR, f'{mrn}_{accession}')
-			tar = tarfile.open(os.path.join(output_dir, mrn+'-'+accession+'.tgz'), "w:gz")
+			tar = open_output_tar(output_dir, mrn+'-'+accession)
 			tar.add(folder_name, arcname=f'{filename}_{accession}')
-			tar.close()
+			outputs.append(close_output_tar(tar))
 
 			shutil.rmtree(folder_name)
 
 		except Exception as e:
 			print("DICOM corrupted! Skipping...")
 			print(e)
+			errors.append(f'instance {os.path.basename(collected_scans)}: {e}')
 
 
 	try:
@@ -291,70 +580,68 @@ def ukb_tarcompress(root_dir, filename, output_dir, csv_reference):
 	except Exception as e:
 		print(f"Failed to clear tmp for file: {filename}")
 
-def dasa_tarcompress(root_dir, filename, output_dir, csv_reference):
+	if errors:
+		raise RuntimeError('; '.join(errors))
+	return outputs
+
+def dasa_tarcompress(root_dir, filename, output_dir, csv_reference, stream=False):
 	'''
 	Anonymize and compress DASA DICOM studies, rewriting tags before archiving.
 
 	DASA uses PatientID as the accession number rather than MRN. Looks up anon_mrn
 	and anon_accession from the crosswalk CSV via PatientID match, rewrites DICOM
 	tags in TMP_DIR, and compresses to .tgz. Cleans up TMP_DIR after compression.
+	With stream=True the rewritten DICOMs are written directly as tar members.
 
 	Args:
 		root_dir:      Path to directory containing DICOM study folders.
 		filename:      Name of the study folder to compress.
 		output_dir:    Destination for the output .tgz file.
 		csv_reference: Path to crosswalk CSV with columns: accession, anon_mrn, anon_accession.
+		stream:        Write rewritten DICOMs straight into the tar (no TMP_DIR staging).
+
+	Returns:
+		List with the output archive path.
 	'''
 
-	ref_data = pd.read_csv(csv_reference).dropna().reset_index()
+	crosswalk = get_crosswalk(csv_reference, 'dasa')['accession']
 	dicom_list = glob.glob(os.path.join(root_dir,filename,'*','*'))
 	os.chdir(root_dir)
 
-	try:
-		#print(dicom_list[1])
-		df = dcm.dcmread(dicom_list[1])
-
-		# Check if any dicoms have non greyscale 
-		df.PhotometricInterpretation = 'MONOCHROME2'
+	#print(dicom_list[1])
+	df = read_dicom_header(dicom_list[1], IDENTIFIER_TAGS)
 
-		# Save series name + frame location 
-		# Dasa uses accession numbers == patient_id not mrn
-		study_uid = str(df.StudyInstanceUID)
-		patient_id = df.PatientID 
+	# Save series name + frame location 
+	# Dasa uses accession numbers == patient_id not mrn
+	study_uid = str(df.StudyInstanceUID)
+	patient_id = df.PatientID 
 
-		mrn =  ref_data.loc[ref_data['accession'].astype(str) == patient_id, 'anon_mrn'].values[0]
-		accession = ref_data.loc[ref_data['accession'].astype(str) == patient_id, 'anon_accession'].values[0]
-		print(f'{bcolors.BLUE}Processing{bcolors.ENDC}: {mrn}-{accession}')
-		
+	mrn, accession = crosswalk[patient_id]
+	print(f'{bcolors.BLUE}Processing{bcolors.ENDC}: {mrn}-{accession}')
+	
+	updates = {'PatientID': mrn, 'AccessionNumber': accession}
 
+	if stream:
+		tar = open_output_tar(output_dir, mrn+'-'+accession)
 		for dcm_file in dicom_list:
-			tmp_path = os.path.join(TMP_DIR, os.path.relpath(dcm_file))
-			os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
-
-			df = dcm.dcmread(dcm_file)
-			# Check if any dicoms have non greyscale 
-			df.PhotometricInterpretation = 'MONOCHROME2'
-			df.PatientID = mrn
-			df.AccessionNumber = accession
-			df.is_little_endian = True
-			df.is_implicit_VR = True
+			add_bytes_to_tar(tar, anonymize_dicom(dcm_file, updates, implicit_vr=True), os.path.relpath(dcm_file))
+		return [close_output_tar(tar)]
 
-			df.save_as(tmp_path, write_like_original=False)	
+	for dcm_file in dicom_list:
+		tmp_path = os.path.join(TMP_DIR, os.path.relpath(dcm_file))
+		write_output(anonymize_dicom(dcm_file, updates, implicit_vr=True), tmp_path)
 
-		# Dump entire thing as a tarfile with anonymized mrn as basename
-		folder_name = os.path.join(TMP_DIR, os.path.basename(filename))
-		tar = tarfile.open(os.path.join(output_dir, mrn+'-'+accession+'.tgz'), "w:gz")
-		tar.add(folder_name, arcname=filename)
-		tar.close()
+	# Dump entire thing as a tarfile with anonymized mrn as basename
+	folder_name = os.path.join(TMP_DIR, os.path.basename(filename))
+	tar = open_output_tar(output_dir, mrn+'-'+accession)
+	tar.add(folder_name, arcname=filename)
+	output = close_output_tar(tar)
 
-		shutil.rmtree(folder_name)
+	shutil.rmtree(folder_name)
+	return [output]
 
-	except Exception as e:
-		print("DICOM corrupted! Skipping...")
-		print(e)
 
-
-def dcm_rewrite_originals_tarcompress(root_dir, filename, output_dir):
+def dcm_rewrite_originals_tarcompress(root_dir, filename, output_dir, stream=False):
 	'''
 	Overwrite AccessionNumber on original DICOM files in-place, then compress to .tgz.
 
@@ -362,48 +649,51 @@ def dcm_rewrite_originals_tarcompress(root_dir, filename, output_dir):
 	compressing. Output filename is derived from PatientID and the rewritten AccessionNumber.
 	Modifies the source files directly — use with caution on non-copied data.
 
+	With stream=True the originals are left untouched: each rewritten DICOM is
+	serialized in memory and written directly into the tar instead.
+
 	Args:
 		root_dir:   Path to directory containing DICOM study folders.
 		filename:   Name of the study folder to process.
 		output_dir: Destination for the output .tgz file.
+		stream:     Write rewritten DICOMs straight into the tar instead of over the originals.
+
+	Returns:
+		List with the output archive path.
 	'''
 
 	dicom_list = glob.glob(os.path.join(root_dir,filename,'*','*'))
+	updates = {'AccessionNumber': 'scandata'}
 
-	for dcm_file in dicom_list:
-		df = dcm.dcmread(dcm_file)
-		# Check if any dicoms have non greyscale 
-		df.PhotometricInterpretation = 'MONOCHROME2'
-		df.AccessionNumber = 'scandata'	
+	if stream:
+		mrn = read_dicom_header(dicom_list[1], IDENTIFIER_TAGS).PatientID
+		accession = updates['AccessionNumber']
+		print('Processing:', mrn+'-'+accession)
 
-		df.is_little_endian = True
-		df.is_implicit_VR = True
+		tar = open_output_tar(output_dir, mrn+'-'+accession)
+		for dcm_file in dicom_list:
+			add_bytes_to_tar(tar, anonymize_dicom(dcm_file, updates, implicit_vr=True), os.path.relpath(dcm_file, root_dir))
+		return [close_output_tar(tar)]
 
-		df.save_as(dcm_file, write_like_original=False)	
+	for dcm_file in dicom_list:
+		write_output(anonymize_dicom(dcm_file, updates, implicit_vr=True), dcm_file)
 
 	print(f'Reset AccessionNumbers for {filename}')	
 
-	try:
-		#print(dicom_list[1])
-		df = dcm.dcmread(dicom_list[1])
-
+	#print(dicom_list[1])
+	df = read_dicom_header(dicom_list[1], IDENTIFIER_TAGS)
 
-		# Check if any dicoms have non greyscale 
-		df.PhotometricInterpretation = 'MONOCHROME2'
-
-		# Save series name + frame location 
-		accession = df.AccessionNumber  
-		mrn = df.PatientID 
-		print('Processing:', mrn+'-'+accession)
 
-		# Dump entire thing as a tarfile with anonymized mrn as basename
-		folder_name = os.path.join(root_dir, filename)
-		tar = tarfile.open(os.path.join(output_dir, mrn+'-'+accession+'.tgz'), "w:gz")
-		tar.add(folder_name, arcname=filename)
-		tar.close()
+	# Save series name + frame location 
+	accession = df.AccessionNumber  
+	mrn = df.PatientID 
+	print('Processing:', mrn+'-'+accession)
 
-	except:
-		print("DICOM corrupted! Skipping...")
+	# Dump entire thing as a tarfile with anonymized mrn as basename
+	folder_name = os.path.join(root_dir, filename)
+	tar = open_output_tar(output_dir, mrn+'-'+accession)
+	tar.add(folder_name, arcname=filename)
+	return [close_output_tar(tar)]
 
 
 def simple_tarcompress(root_dir, filename, output_dir):
@@ -417,12 +707,15 @@ def simple_tarcompress(root_dir, filename, output_dir):
 		root_dir:   Path to directory containing folders to compress.
 		filename:   Name of the folder to compress.
 		output_dir: Destination for the output .tgz file.
+
+	Returns:
+		List with the output archive path.
 	'''
 	folder_name = os.path.join(root_dir, filename)
 	print('Processing:', filename)
-	tar = tarfile.open(os.path.join(output_dir, filename+'.tgz'), "w:gz")
+	tar = open_output_tar(output_dir, filename)
 	tar.add(folder_name, arcname=filename)
-	tar.close()
+	return [close_output_tar(tar)]
 
 
 def nofolder_tarcompress(root_dir, filename, output_dir, csv_reference):
@@ -440,13 +733,16 @@ def nofolder_tarcompress(root_dir, filename, output_dir, csv_reference):
 		filename:      Name of the flat study folder to process.
 		output_dir:    Destination for the output .tgz file.
 		csv_reference: Path to crosswalk CSV, or None to use dcm_tarcompress (no anonymization).
+
+	Returns:
+		List with the output archive path.
 	'''
 
 	dicom_list = glob.glob(os.path.join(root_dir, filename, '*'))
 	counter = 0
 	for i in dicom_list:	
 		try:
-			df = dcm.dcmread(i, force=True)
+			df = read_dicom_header(i, ['SeriesDescription'], force=True)
 			series_description = df.SeriesDescription  
 
 			dicom_basename = os.path.split(i)[1]
@@ -461,13 +757,340 @@ def nofolder_tarcompress(root_dir, filename, output_dir, csv_reference):
 			print(f'DICOM corrupted! Skipping...')
 
 	# Final compression
-	if csv_reference is not None:
-		csv_tarcompress(TMP_DIR, filename, output_dir, csv_reference)
-	else:
-		dcm_tarcompress(TMP_DIR, filename, output_dir)
-	shutil.rmtree(os.path.join(TMP_DIR, filename))
+	try:
+		if csv_reference is not None:
+			outputs = csv_tarcompress(TMP_DIR, filename, output_dir, csv_reference)
+		else:
+			outputs = dcm_tarcompress(TMP_DIR, filename, output_dir)
+	finally:
+		shutil.rmtree(os.path.join(TMP_DIR, filename), ignore_errors=True)
 	print(f'Successfully exported {counter} dicom files to tar')
+	return outputs
+
+
+# Per-folder results of every run, appended in output_dir
+LEDGER_NAME = 'tar_compressor_ledger.csv'
+LEDGER_FIELDS = ['folder', 'mode', 'status', 'seconds', 'bytes_in', 'bytes_out', 'outputs', 'error', 'finished']
+
+# Folder sizes cached between runs in output_dir, keyed by path and folder mtime
+SIZE_CACHE_NAME = 'tar_compressor_sizes.json'
+
+# mode → (function, takes csv_reference, takes stream)
+MODES = {
+	'simple':           (simple_tarcompress, False, False),
+	'dicom':            (dcm_tarcompress, False, False),
+	'anonymize':        (csv_tarcompress, True, False),
+	'reset_dicom_meta': (dcm_rewrite_originals_tarcompress, False, True),
+	'penn':             (nofolder_tarcompress, True, False),
+	'segmed':           (segmed_tarcompress, True, True),
+	'dasa':             (dasa_tarcompress, True, True),
+	'ukbiobank':        (ukb_tarcompress, True, True),
+}
+
+# Modes that cannot run without -l/--csv_ref (penn falls back to dcm_tarcompress without one)
+CROSSWALK_REQUIRED = ('anonymize', 'segmed', 'dasa', 'ukbiobank')
+
+def input_bytes(root_dir, filename, mode):
+	'''
+	Bytes read for one job: the study folder, or the EID's zips for ukbiobank.
+	'''
+	if mode == 'ukbiobank':
+		return sum(os.path.getsize(z) for zips in ukb_group_zips(root_dir, str(filename)).values() for z in zips)
+	path = os.path.join(root_dir, filename)
+	if not os.path.isdir(path):
+		return os.path.getsize(path)
+	return folder_bytes(path)
+
+def tree_mtime(path):
+	'''
+	Newest mtime (ns) of path and every directory beneath it; a file's own mtime.
+	'''
+	mtime = os.stat(path).st_mtime_ns
+	for dirpath, dirnames, _ in os.walk(path):
+		for d in dirnames:
+			try:
+				mtime = max(mtime, os.stat(os.path.join(dirpath, d)).st_mtime_ns)
+			except OSError:
+				pass
+	return mtime
+
+def job_sizes(root_dir, filenames, mode, cache_path):
+	'''
+	Size every job for scheduling, reusing cached folder sizes.
+
+	A folder's cached size is reused while the newest mtime over the directories under
+	it is unchanged, so files added, removed or renamed at any depth invalidate it.
+	Walking only stats directories, not every file. A file overwritten in place keeps
+	its directory's mtime; delete the cache after such edits. ukbiobank sizes are a
+	stat of the EID's zips and are not cached.
+
+	Args:
+		root_dir:   Directory holding the study folders.
+		filenames:  Folder names (or EIDs) to size.
+		mode:       tar_compressor mode.
+		cache_path: JSON cache file, rewritten with the current sizes.
+
+	Returns:
+		Dict of filename → bytes (0 when the path cannot be read).
+	'''
+	cache = {}
+	if os.path.exists(cache_path):
+		try:
+			with open(cache_path) as f:
+				cache = json.load(f)
+		except ValueError:
+			print(f'{bcolors.WARN}Ignoring unreadable size cache {cache_path}{bcolors.END}')
+
+	sizes = {}
+	for f in filenames:
+		if mode == 'ukbiobank':
+			sizes[f] = input_bytes(root_dir, f, mode)
+			continue
+
+		path = os.path.join(root_dir, f)
+		try:
+			mtime = tree_mtime(path)
+		except OSError:
+			sizes[f] = 0
+			continue
+
+		entry = cache.get(path)
+		if entry is None or entry['mtime'] != mtime:
+			entry = {'mtime': mtime, 'bytes': input_bytes(root_dir, f, mode)}
+			cache[path] = entry
+		sizes[f] = entry['bytes']
+
+	if mode != 'ukbiobank':
+		tmp_path = cache_path + '.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(cache, f)
+		os.replace(tmp_path, cache_path)
+	return sizes
+
+def run_job(mode, root_dir, filename, output_dir, csv_reference, stream, bytes_in=None):
+	'''
+	Run one folder through its mode function and describe the outcome as a ledger row.
+
+	Exceptions are caught here (not swallowed inside the mode functions) so every
+	failure reaches the ledger with its error message, and any archive the job left
+	half-written is deleted. bytes_in can be passed when the scheduler already sized
+	the job.
+
+	Returns:
+		Dict with the LEDGER_FIELDS keys.
+	'''
+	function, takes_csv, takes_stream = MODES[mode]
+	args = [root_dir, filename, output_dir]
+	if takes_csv:
+		args.append(csv_reference)
+	if takes_stream:
+		args.append(stream)
+
+	row = {'folder': filename, 'mode': mode, 'status': 'failed', 'bytes_in': 0, 'bytes_out': 0, 'outputs': '', 'error': ''}
+	start = time.time()
+	try:
+		row['bytes_in'] = input_bytes(root_dir, filename, mode) if bytes_in is None else bytes_in
+		outputs = function(*args) or []
+		row['outputs'] = ';'.join(outputs)
+		row['bytes_out'] = sum(os.path.getsize(o) for o in outputs)
+		if outputs:
+			row['status'] = 'ok'
+		else:
+			row['error'] = 'no output written'
+
+	except Exception as e:
+		print(f'{bcolors.ERR}Failed: {filename}: {e}{bcolors.END}')
+		row['error'] = f'{type(e).__name__}: {e}'
+		discard_output_tars()
+
+	row['seconds'] = round(time.time() - start, 3)
+	row['finished'] = time.strftime('%Y-%m-%d %H:%M:%S')
+	return row
+
+def _run_job_star(task):
+	return run_job(*task)
+
+def load_ledger(ledger_path):
+	'''
+	Read the ledger, keeping the latest row per folder.
+
+	Every row is parsed on its own line, so a line cut short by a crash mid-append
+	(missing fields or an unclosed quote) is skipped rather than breaking the read or
+	swallowing the rows after it; its folder is simply redone.
 
+	Returns:
+		Dict of folder → ledger row (all values as strings).
+	'''
+	if not os.path.exists(ledger_path):
+		return {}
+	rows = {}
+	with open(ledger_path, newline='') as f:
+		fields = next(csv.reader([f.readline()]), [])
+		for line in f:
+			try:
+				values = next(csv.reader([line]))
+			except (csv.Error, StopIteration):
+				continue
+			if len(values) == len(fields) and line.endswith('\n'):
+				row = dict(zip(fields, values))
+				rows[row['folder']] = row
+	return rows
+
+def append_ledger(ledger_path, row):
+	'''
+	Append one result row, writing the header when the ledger is new.
+
+	Newlines inside values are flattened so each row stays on one line, and a last
+	line left unterminated by an earlier crash is closed off first.
+	'''
+	new_file = not os.path.exists(ledger_path)
+	terminated = True
+	if not new_file and os.path.getsize(ledger_path):
+		with open(ledger_path, 'rb') as f:
+			f.seek(-1, os.SEEK_END)
+			terminated = f.read(1) == b'\n'
+	with open(ledger_path, 'a', newline='') as f:
+		if not terminated:
+			f.write('\n')
+		writer = csv.DictWriter(f, fieldnames=LEDGER_FIELDS)
+		if new_file:
+			writer.writeheader()
+		writer.writerow({k: str(v).replace('\r', ' ').replace('\n', ' ') for k, v in row.items()})
+
+def pending_folders(filenames, mode, ledger_path):
+	'''
+	Drop the folders the ledger records as finished ok in this mode whose outputs
+	still validate (see output_is_valid); failed or invalid ones are kept to be redone.
+
+	Returns:
+		(folders still to run, number skipped as done)
+	'''
+	ledger = load_ledger(ledger_path)
+	done = {f for f in filenames
+	        if str(f) in ledger and ledger[str(f)]['mode'] == mode and output_is_valid(ledger[str(f)])}
+	return [f for f in filenames if f not in done], len(done)
+
+def output_is_valid(row):
+	'''
+	True when a ledger row finished ok and its outputs still exist with the recorded
+	total size and open as tar archives (first member readable).
+	'''
+	if row.get('status') != 'ok' or not row.get('outputs'):
+		return False
+	outputs = row['outputs'].split(';')
+	try:
+		if sum(os.path.getsize(o) for o in outputs) != int(row['bytes_out']):
+			return False
+		for o in outputs:
+			with open_tar_reader(o) as tar:
+				if tar.next() is None:
+					return False
+	except Exception:
+		return False
+	return True
+
+def schedule_jobs(p, tasks, sizes, cpus, huge_bytes, max_huge, job_timeout=float('inf')):
+	'''
+	Yield run_job results, submitting the largest jobs first.
+
+	At most cpus jobs are in flight, and at most max_huge of them may be huge
+	(>= huge_bytes), so several multi-GB studies never compete for scratch space and
+	memory at once. When only huge jobs are left and the cap is reached, the
+	scheduler waits for one to finish.
+
+	A pool worker that is killed (e.g. by the OOM killer) never reports back, so a job
+	with no result after job_timeout seconds is failed and its slot given to the next
+	job; a result that still turns up later is ignored.
+
+	Args:
+		p:           multiprocessing.Pool (unused when cpus == 1).
+		tasks:       run_job argument tuples; tasks[i][2] is the filename.
+		sizes:       Dict of filename → bytes.
+		cpus:        Maximum jobs in flight.
+		huge_bytes:  Size at or above which a job counts as huge.
+		max_huge:    Maximum huge jobs in flight.
+		job_timeout: Seconds to wait for a job's result before failing it.
+	'''
+	pending = sorted(tasks, key=lambda t: sizes.get(t[2], 0), reverse=True)
+
+	if cpus <= 1:
+		for task in pending:
+			yield _run_job_star(task + (sizes.get(task[2]),))
+		return
+
+	def failed_row(task, size, error):
+		return {'folder': task[2], 'mode': task[0], 'status': 'failed', 'seconds': 0, 'bytes_in': size,
+		        'bytes_out': 0, 'outputs': '', 'error': error, 'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+	finished = queue.Queue()
+	running = {}     # job id → (task, size, huge, deadline)
+	huge_running = 0
+	job_ids = itertools.count()
+	while pending or running:
+		# Fill free slots with the largest job the huge cap allows
+		while len(running) < cpus and pending:
+			index = next((i for i, t in enumerate(pending)
+			              if sizes.get(t[2], 0) < huge_bytes or huge_running < max_huge), None)
+			if index is None:
+				break
+			task = pending.pop(index)
+			size = sizes.get(task[2], 0)
+			huge = size >= huge_bytes
+			job_id = next(job_ids)
+			running[job_id] = (task, size, huge, time.time() + job_timeout)
+			huge_running += huge
+
+			# run_job catches Exception, so error_callback only sees pool-level failures
+			p.apply_async(_run_job_star, (task + (size,),),
+			              callback=lambda row, job_id=job_id: finished.put((job_id, row)),
+			              error_callback=lambda e, job_id=job_id, task=task, size=size:
+			                  finished.put((job_id, failed_row(task, size, f'{type(e).__name__}: {e}'))))
+
+		deadline = min(job[3] for job in running.values())
+		try:
+			job_id, row = finished.get(timeout=None if deadline == float('inf') else max(0, deadline - time.time()))
+		except queue.Empty:
+			job_id = min(running, key=lambda j: running[j][3])
+			task, size = running[job_id][:2]
+			print(f'{bcolors.ERR}No result for {task[2]} after {job_timeout:.0f} s, worker lost?{bcolors.END}')
+			row = failed_row(task, size, f'TimeoutError: no result after {job_timeout:.0f} s (worker killed?)')
+		if job_id not in running:
+			print(f'{bcolors.WARN}Ignoring late result for {row["folder"]} (already failed on timeout){bcolors.END}')
+			continue
+		huge_running -= running.pop(job_id)[2]
+		yield row
+
+def run_jobs(p, mode, filenames, root_dir, output_dir, csv_reference, stream, cpus, ledger_path,
+             huge_bytes=float('inf'), max_huge=1, job_timeout=float('inf')):
+	'''
+	Size every folder, dispatch them through schedule_jobs (largest first, capped
+	concurrent huge jobs, timed-out jobs failed), append each result to the ledger as it completes and
+	print a throughput summary.
+
+	Returns:
+		Counter of job statuses.
+	'''
+	tasks = [(mode, root_dir, f, output_dir, csv_reference, stream) for f in filenames]
+	sizes = job_sizes(root_dir, filenames, mode, os.path.join(output_dir, SIZE_CACHE_NAME))
+	n_huge = sum(size >= huge_bytes for size in sizes.values())
+	print(f'Scheduling {len(tasks)} jobs, {sum(sizes.values()) / 1e9:.2f} GB total, {n_huge} huge')
+
+	start_time = time.time()
+	statuses = Counter()
+	bytes_in = bytes_out = 0
+	for row in schedule_jobs(p, tasks, sizes, cpus, huge_bytes, max_huge, job_timeout):
+		append_ledger(ledger_path, row)
+		statuses[row['status']] += 1
+		bytes_in += row['bytes_in']
+		bytes_out += row['bytes_out']
+
+	elapsed = max(time.time() - start_time, 1e-9)
+	print('------------------------------------')
+	print(f'{bcolors.OK}Finished {statuses["ok"]} of {len(tasks)} folders{bcolors.END} ({statuses["failed"]} failed, see {ledger_path})')
+	print(f'Read {bytes_in / 1e6:.1f} MB, wrote {bytes_out / 1e6:.1f} MB in {elapsed:.1f} s: '
+	      f'{bytes_in / 1e6 / elapsed:.1f} MB/s in, {bytes_out / 1e6 / elapsed:.1f} MB/s out')
+	print('------------------------------------')
+	return statuses
 
 if __name__ == '__main__':
 	
@@ -481,89 +1104,64 @@ if __name__ == '__main__':
 	parser.add_argument('-o', '--output_dir', metavar='', required=False, help='Where all output files will be stored', default='/scratch/groups/willhies/ukbb_test/bulk_data/tar_outputs')
 	parser.add_argument('-c', '--cpus', metavar='', type=int, default='4',help='number of cores to use in multiprocessing')
 	parser.add_argument('-d', '--debug', action='store_true', default=False)
-	parser.add_argument('-m', '--mode', metavar='', type=str, default='simple')
+	parser.add_argument('-m', '--mode', metavar='', type=str, default='simple', choices=list(MODES), help=f'One of: {", ".join(MODES)}')
+	parser.add_argument('--stream', action='store_true', default=False, help='segmed/ukbiobank/dasa/reset_dicom_meta: write rewritten DICOMs straight into the tar from memory, no TMP_DIR copy')
+	parser.add_argument('--engine', metavar='', type=str, default='gzip', choices=ENGINES, help='Output compression: gzip (tarfile, single thread), pigz (multithreaded gzip, same .tgz format) or zstd (.tar.zst, internal hops only)')
+	parser.add_argument('--resume', action='store_true', default=False, help='Skip folders the ledger in output_dir records as done whose outputs still exist and validate')
+	parser.add_argument('--huge_threshold_gb', metavar='', type=float, default=5.0, help='Folders at least this large (GB) count as huge jobs')
+	parser.add_argument('--max_huge', metavar='', type=int, default=1, help='Maximum huge jobs running at once')
+	parser.add_argument('--job_timeout_hours', metavar='', type=float, default=12.0, help='Fail a folder whose worker has not reported back after this many hours (e.g. killed by the OOM killer)')
+	parser.add_argument('--full_reencode', action='store_true', default=False, help='Anonymizing modes: always decode and re-encode each DICOM with pydicom instead of patching the header bytes')
+	parser.add_argument('--compress_threads', metavar='', type=int, default=4, help='Compression threads per worker for the pigz/zstd engines')
 
 	args = vars(parser.parse_args())
 	print(args)
 
+	# Check arguments before the crosswalk load and worker pool, so a bad invocation exits cleanly
+	if args['csv_ref'] is None and args['mode'] in CROSSWALK_REQUIRED:
+		parser.error(f'mode {args["mode"]} needs a crosswalk: pass it with -l/--csv_ref')
+
 
 	root_dir = args['root_dir']
 	csv_reference = args['csv_ref']
 	cpus = args['cpus']
 	debug = args['debug']
 	mode = args['mode']
-	output_dir = args['output_dir']
+	stream = args['stream']
+	engine = args['engine']
+	compress_threads = args['compress_threads']
+	full_reencode = args['full_reencode']
+	resume = args['resume']
+	huge_bytes = args['huge_threshold_gb'] * 1e9
+	max_huge = max(1, args['max_huge'])
+	job_timeout = args['job_timeout_hours'] * 3600
+	output_dir = os.path.abspath(args['output_dir'])
 	os.makedirs(output_dir, exist_ok=True)	
 
+	# Load the crosswalk once and share the lookup tables with every worker
+	crosswalk = None
+	if csv_reference is not None and mode in ('anonymize', 'penn', 'segmed', 'dasa', 'ukbiobank'):
+		crosswalk = load_crosswalk(csv_reference, mode)
+	init_worker(crosswalk, engine, compress_threads, full_reencode)
+
 	# Start worker pool
-	p = multiprocessing.Pool(processes=cpus)
+	p = multiprocessing.Pool(processes=cpus, initializer=init_worker, initargs=(crosswalk, engine, compress_threads, full_reencode))
 
 	start_time = time.time()
 	filenames = os.listdir(root_dir)
 	filenames = [i for i in filenames if i[0] != "."]
 
 
-	if mode == 'simple':
-		for f in filenames:
-			if cpus > 1:
-				p.apply_async(simple_tarcompress, [root_dir, f, output_dir])
-			else:
-				simple_tarcompress(root_dir, f, output_dir)
-
-
-	elif mode == 'dicom':
-		for f in filenames:
-			if cpus > 1:
-				p.apply_async(dcm_tarcompress, [root_dir, f, output_dir])
-			else:
-				dcm_tarcompress(root_dir, f, output_dir)
-
-	elif mode == 'anonymize':
-		for f in filenames:
-			if cpus > 1:
-				p.apply_async(csv_tarcompress, [root_dir, f, output_dir, csv_reference])
-			else:
-				csv_tarcompress(root_dir, f, output_dir, csv_reference)
-
-	elif mode == 'reset_dicom_meta':
-		for f in filenames:
-			if cpus > 1:
-				p.apply_async(dcm_rewrite_originals_tarcompress, [root_dir, f, output_dir])
-			else:
-				dcm_rewrite_originals_tarcompress(root_dir, f, output_dir)
-
-	elif mode == 'penn':
-		for f in filenames:
-			if cpus > 1:
-				p.apply_async(nofolder_tarcompress, [root_dir, f, output_dir, csv_reference])
-			else:
-				nofolder_tarcompress(root_dir, f, output_dir, csv_reference)	
+	if mode == 'ukbiobank':
+		filenames = list(crosswalk['eid'])
 
-	elif mode == 'segmed':
-
-		for f in filenames:
-			if cpus > 1:
-				p.apply_async(segmed_tarcompress, [root_dir, f, output_dir, csv_reference])
-			else:
-				segmed_tarcompress(root_dir, f, output_dir, csv_reference)	
-
-	elif mode == 'dasa':
-
-		for f in filenames:
-			if cpus > 1:
-				p.apply_async(dasa_tarcompress, [root_dir, f, output_dir, csv_reference])
-			else:
-				dasa_tarcompress(root_dir, f, output_dir, csv_reference)	
-
-	elif mode == 'ukbiobank':
-		df = pd.read_csv(csv_reference)
-		filenames = df['f.eid'].unique().astype('str')
-		for f in filenames:
-			if cpus > 1:
-				p.apply_async(ukb_tarcompress, [root_dir, f, output_dir, csv_reference])
-			else:
-				ukb_tarcompress(root_dir, f, output_dir, csv_reference)	
+	# Skip folders the ledger says finished ok, as long as their outputs still validate
+	ledger_path = os.path.join(output_dir, LEDGER_NAME)
+	if resume:
+		filenames, n_done = pending_folders(filenames, mode, ledger_path)
+		print(f'Resuming: {n_done} folders already done, {len(filenames)} to go')
 
+	run_jobs(p, mode, filenames, root_dir, output_dir, csv_reference, stream, cpus, ledger_path, huge_bytes, max_huge, job_timeout)
 
 	p.close()
 	p.join()
@@ -0,0 +1,230 @@
+'''
+Helper functions for writing compressed tar archives.
+
+Engines:
+    gzip  — tarfile's built-in single-threaded "w:gz" (compresslevel 9)
+    pigz  — pigz-style multithreaded gzip: the tar stream is split into blocks that are
+            deflated in parallel threads (zlib releases the GIL) and stitched into one
+            standard gzip member, so outputs stay readable by tarfile.open(..., 'r:gz')
+    zstd  — zstd-compressed tar (.tar.zst) for internal hops; needs the optional
+            zstandard package
+
+Benchmark the engines on a folder:
+    python tarutils.py -i /path/to/study_folder -t 8
+'''
+
+import os
+import zlib
+import time
+import struct
+import shutil
+import tarfile
+import tempfile
+import argparse as ap
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+ENGINES = ('gzip', 'pigz', 'zstd')
+ENGINE_EXTENSIONS = {'gzip': '.tgz', 'pigz': '.tgz', 'zstd': '.tar.zst'}
+
+BLOCK_SIZE = 1 << 20     # 1 MiB of tar stream per parallel deflate job
+DICT_SIZE = 1 << 15      # 32 KiB deflate window primed from the previous block (as pigz does)
+
+
+def _deflate_block(block, zdict, level, last):
+	'''
+	Raw-deflate one block, priming the window with the tail of the previous block.
+	Non-final blocks end with a sync flush (byte aligned, not BFINAL) so the
+	compressed blocks concatenate into a single valid deflate stream.
+	'''
+	if zdict:
+		compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+		                              zlib.Z_DEFAULT_STRATEGY, zdict)
+	else:
+		compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+	data = compressor.compress(block)
+	return data + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter:
+	'''
+	Write-only file object producing a standard single-member gzip stream, with the
+	deflate work spread across threads.
+
+	Incoming data is cut into block_size blocks; each block is compressed on the
+	thread pool while the CRC32 and length are accumulated in order on the calling
+	thread. At most 2 x threads blocks are in flight, so memory stays bounded.
+
+	Args:
+		path:       Output file path.
+		threads:    Number of compression threads.
+		level:      zlib compression level (pigz default: 6).
+		block_size: Bytes of input per compression job.
+	'''
+	def __init__(self, path, threads=4, level=6, block_size=BLOCK_SIZE):
+		self.fileobj = open(path, 'wb')
+		self.level = level
+		self.block_size = block_size
+		self.executor = ThreadPoolExecutor(max_workers=max(1, threads))
+		self.max_pending = 2 * max(1, threads)
+		self.pending = deque()
+		self.buffer = bytearray()
+		self.prev_tail = b''
+		self.crc = 0
+		self.size = 0
+		self.closed = False
+
+		# gzip header: magic, deflate, no flags, mtime, no extra flags, OS unknown
+		self.fileobj.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + b'\x00\xff')
+
+	def write(self, data):
+		self.buffer += data
+		while len(self.buffer) >= self.block_size:
+			block = bytes(self.buffer[:self.block_size])
+			del self.buffer[:self.block_size]
+			self._submit(block, last=False)
+		return len(data)
+
+	def _submit(self, block, last):
+		self.crc = zlib.crc32(block, self.crc)
+		self.size += len(block)
+		self.pending.append(self.executor.submit(_deflate_block, block, self.prev_tail, self.level, last))
+		self.prev_tail = block[-DICT_SIZE:]
+		while len(self.pending) > self.max_pending:
+			self.fileobj.write(self.pending.popleft().result())
+
+	def close(self):
+		if self.closed:
+			return
+		self.closed = True
+		try:
+			self._submit(bytes(self.buffer), last=True)
+			while self.pending:
+				self.fileobj.write(self.pending.popleft().result())
+			self.fileobj.write(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+		finally:
+			self.executor.shutdown()
+			self.fileobj.close()
+
+
+class _OwnedStreamTarFile(tarfile.TarFile):
+	'''
+	Stream-mode TarFile that also closes the compressor it was opened on, so callers
+	can keep the usual tar = open(...); tar.add(...); tar.close() pattern.
+	'''
+	def close(self):
+		try:
+			super().close()
+		finally:
+			self._owned.close()
+
+
+def open_tar_writer(path, engine='gzip', threads=4, level=None):
+	'''
+	Open a tar archive for writing with the requested compression engine.
+
+	Args:
+		path:    Output path (use ENGINE_EXTENSIONS for the matching extension).
+		engine:  One of ENGINES.
+		threads: Compression threads for the pigz and zstd engines.
+		level:   Compression level; engine default when None.
+
+	Returns:
+		tarfile.TarFile opened for writing; closing it finalizes the compressed stream.
+	'''
+	if engine == 'gzip':
+		return tarfile.open(path, 'w:gz', compresslevel=9 if level is None else level)
+
+	if engine == 'pigz':
+		writer = ParallelGzipWriter(path, threads=threads, level=6 if level is None else level)
+
+	elif engine == 'zstd':
+		if zstandard is None:
+			raise ImportError('The zstd engine requires the zstandard package (pip install zstandard)')
+		raw = open(path, 'wb')
+		compressor = zstandard.ZstdCompressor(level=3 if level is None else level, threads=threads)
+		writer = compressor.stream_writer(raw, closefd=True)
+
+	else:
+		raise ValueError(f'Unknown compression engine: {engine} (expected one of {ENGINES})')
+
+	tar = _OwnedStreamTarFile.open(path, mode='w|', fileobj=writer)
+	tar._owned = writer
+	return tar
+
+
+def open_tar_reader(path):
+	'''
+	Open a tar archive written by any engine for reading (zstd detected by extension).
+	'''
+	if path.endswith(ENGINE_EXTENSIONS['zstd']):
+		if zstandard is None:
+			raise ImportError('Reading .tar.zst archives requires the zstandard package (pip install zstandard)')
+		reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+		tar = _OwnedStreamTarFile.open(path, mode='r|', fileobj=reader)
+		tar._owned = reader
+		return tar
+	return tarfile.open(path)
+
+
+def folder_bytes(folder):
+	'''
+	Total size in bytes of all regular files below folder (scandir-based du).
+	'''
+	total = 0
+	stack = [folder]
+	while stack:
+		with os.scandir(stack.pop()) as it:
+			for entry in it:
+				if entry.is_dir(follow_symlinks=False):
+					stack.append(entry.path)
+				elif entry.is_file(follow_symlinks=False):
+					total += entry.stat(follow_symlinks=False).st_size
+	return total
+
+
+if __name__ == '__main__':
+
+	parser = ap.ArgumentParser(description="Benchmark tar compression engines on a folder")
+	parser.add_argument('-i', '--input_dir', metavar='', required=True, help='Folder to compress')
+	parser.add_argument('-t', '--threads', metavar='', type=int, nargs='+', default=[1, 4, 8], help='Thread counts to benchmark for pigz/zstd')
+	parser.add_argument('-o', '--output_dir', metavar='', default=None, help='Scratch directory for the outputs (default: system temp)')
+	args = vars(parser.parse_args())
+
+	input_dir = os.path.normpath(args['input_dir'])
+	scratch = tempfile.mkdtemp(dir=args['output_dir'])
+	size_in = folder_bytes(input_dir)
+	n_files = sum(len(files) for _, _, files in os.walk(input_dir))
+
+	runs = [('gzip', 1)] + [(engine, t) for engine in ('pigz', 'zstd') for t in args['threads']]
+
+	print('------------------------------------')
+	print(f'Input: {input_dir} ({size_in / 1e6:.1f} MB, {n_files} files)')
+	print('------------------------------------')
+	try:
+		for engine, threads in runs:
+			if engine == 'zstd' and zstandard is None:
+				print('zstd: skipped (zstandard not installed)')
+				break
+			out_path = os.path.join(scratch, f'bench_{engine}_{threads}{ENGINE_EXTENSIONS[engine]}')
+			start = time.time()
+			tar = open_tar_writer(out_path, engine=engine, threads=threads)
+			tar.add(input_dir, arcname=os.path.basename(input_dir))
+			tar.close()
+			elapsed = time.time() - start
+
+			# Round trip through the reader to prove the output is a valid archive
+			with open_tar_reader(out_path) as check:
+				n_members = sum(1 for m in check if m.isfile())
+			size_out = os.path.getsize(out_path)
+			print(f'{engine:5s} threads={threads:<3d} {size_in / 1e6 / elapsed:8.1f} MB/s  '
+			      f'ratio={size_out / max(1, size_in):.3f}  files={n_members}  time={elapsed:.2f}s')
+			os.remove(out_path)
+	finally:
+		shutil.rmtree(scratch, ignore_errors=True)
+	print('------------------------------------')